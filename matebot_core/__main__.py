@@ -3,13 +3,16 @@
 import os
 import sys
 import getpass
+import datetime
 import logging
 import argparse
 
 import uvicorn
 
 from matebot_core import settings as _settings
+from matebot_core.api import export
 from matebot_core.api.api import create_app
+from matebot_core.persistence import database
 
 
 def _handle_systemd() -> int:
@@ -123,9 +126,74 @@ def _get_parser(program: str) -> argparse.ArgumentParser:
         help="Configure the systemd service and exit"
     )
 
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    export_parser = subparsers.add_parser(
+        "export",
+        description="Export the transactions to a file (or stdout) and exit",
+        help="Export the transactions and exit"
+    )
+    export_parser.add_argument(
+        "--format",
+        choices=sorted(export.FORMATS.keys()),
+        default="ndjson",
+        help="Export format (default: ndjson)"
+    )
+    export_parser.add_argument(
+        "--since",
+        type=datetime.datetime.fromisoformat,
+        metavar="date",
+        help="Only export transactions at or after this ISO date (or date and time)"
+    )
+    export_parser.add_argument(
+        "--until",
+        type=datetime.datetime.fromisoformat,
+        metavar="date",
+        help="Only export transactions before this ISO date (or date and time)"
+    )
+    export_parser.add_argument(
+        "--output",
+        type=str,
+        default="-",
+        metavar="file",
+        help="Write the export to this file instead of stdout"
+    )
+    export_parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=export.DEFAULT_CHUNK_SIZE,
+        metavar="n",
+        help=f"Number of rows fetched at once (default: {export.DEFAULT_CHUNK_SIZE})"
+    )
+
     return parser
 
 
+def run_export(args: argparse.Namespace) -> int:
+    if args.chunk_size < 1:
+        print("The chunk size must be positive!", file=sys.stderr)
+        return 1
+
+    # The export only reads the database, so neither the schema nor the
+    # persistent journal mode of a sqlite3 database must be changed
+    settings = _settings.Settings()
+    pragmas = None
+    if settings.database.sqlite_profile:
+        pragmas = settings.database.sqlite_profile.dict(exclude={"journal_mode"})
+    database.init(settings.database.connection, args.echo, create_all=False, sqlite_pragmas=pragmas)
+
+    chunks = export.generate(args.format, args.since, args.until, args.chunk_size)
+    if args.output == "-":
+        for chunk in chunks:
+            sys.stdout.write(chunk)
+        sys.stdout.flush()
+        return 0
+
+    with open(args.output, "w", encoding="UTF-8", newline="") as f:
+        for chunk in chunks:
+            f.write(chunk)
+    return 0
+
+
 def run_server(args: argparse.Namespace):
     if args.systemd:
         exit(_handle_systemd())
@@ -165,4 +233,6 @@ def run_server(args: argparse.Namespace):
 if __name__ == '__main__':
     program_name = sys.argv[0] if not sys.argv[0].endswith("__main__.py") else "matebot_core"
     namespace = _get_parser(program_name).parse_args(sys.argv[1:])
+    if namespace.command == "export":
+        exit(run_export(namespace))
     run_server(namespace)
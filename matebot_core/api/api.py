@@ -19,6 +19,12 @@ the implementation in the user agent -- clients should never see any data
 of the Unprocessable Entity responses, since the `details` field may
 contain arbitrary data which is usually not user-friendly.
 
+User agents may request MessagePack or CBOR instead of JSON using the
+`Accept` header (e.g. `Accept: application/msgpack`), if the optional
+packages are installed on the server. Request bodies may be sent in
+those formats with the matching `Content-Type` header, too. Entity tags
+of those representations carry a suffix of their format (e.g. `-msgpack`).
+
 This API supports conditional HTTP requests and will enforce them for
 various types of request that change a resource's state. Any resource
 delivered or created by a request will carry the `ETag` header
@@ -57,10 +63,10 @@ except ImportError:
     StaticFiles = None
     static_docs = False
 
-from . import base
+from . import base, compression, negotiation, notifier
 from .routers import all_routers
 from .. import schemas, __api_version__
-from ..persistence import database
+from ..persistence import database, models, tracking
 from ..settings import Settings
 from .. import __file__ as _package_init_path
 
@@ -94,7 +100,40 @@ def create_app(
     logger.debug("Starting application...")
 
     if configure_database:
-        database.init(settings.database.connection, settings.database.echo)
+        database.init(
+            settings.database.connection,
+            settings.database.echo,
+            pool_options={
+                "pool_size": settings.database.pool_size,
+                "max_overflow": settings.database.max_overflow,
+                "pool_timeout": settings.database.pool_timeout,
+                "pool_recycle": settings.database.pool_recycle,
+                "pool_pre_ping": settings.database.pool_pre_ping
+            },
+            sqlite_pragmas=(
+                settings.database.sqlite_profile and settings.database.sqlite_profile.dict()
+            ),
+            replica_urls=settings.database.replicas,
+            replica_check_interval=settings.database.replica_check_interval,
+            use_asyncio=settings.database.asyncio,
+            async_database_url=settings.database.async_connection
+        )
+
+    # The change log always keeps the events which may be replayed, zero keeps all entries
+    change_log_size = settings.server.change_log_size
+    if change_log_size:
+        change_log_size = max(change_log_size, settings.server.event_replay_limit)
+    tracking.set_change_log_size(change_log_size)
+
+    # The shards of the community balance remain part of the total once they exist
+    if settings.general.community_shards > 0:
+        models.set_community_shards(True)
+    elif configure_database:
+        session = database.get_new_session()
+        try:
+            models.set_community_shards(session.query(models.CommunityShard.id).first() is not None)
+        finally:
+            session.close()
 
     app = fastapi.FastAPI(
         title="MateBot core REST API",
@@ -102,8 +141,30 @@ def create_app(
         docs_url=None if static_docs and configure_static_docs else "/docs",
         redoc_url=None if static_docs and configure_static_docs else "/redoc",
         description=__doc__,
-        responses={422: {"model": schemas.APIError}}
+        responses={422: {"model": schemas.APIError}},
+        default_response_class=negotiation.NegotiatedResponse
+    )
+
+    app.state.notifier = notifier.Notifier(
+        settings.server.long_poll_timeout,
+        settings.server.long_poll_interval
     )
+    app.add_event_handler("shutdown", app.state.notifier.close)
+
+    if configure_database and settings.database.asyncio:
+        @app.on_event("shutdown")
+        async def dispose_async_engine():
+            await database.get_async_engine().dispose()
+
+    compression_config = settings.server.compression
+    if compression_config.enabled:
+        app.add_middleware(
+            compression.CompressionMiddleware,
+            minimum_size=compression_config.minimum_size,
+            gzip_level=compression_config.gzip_level,
+            brotli_quality=compression_config.brotli_quality
+        )
+    app.add_middleware(negotiation.NegotiationMiddleware)
 
     app.add_exception_handler(base.APIException, base.APIException.handle)
     app.add_exception_handler(RequestValidationError, base.APIException.handle)
@@ -128,7 +189,24 @@ def create_app(
         logger.warning("More than one static directory found! Though unexpected, it may be fine.")
 
     if static_docs and configure_static_docs and StaticFiles and len(static_dirs) > 0:
-        app.mount("/static", StaticFiles(directory=static_dirs[0]), name="static")
+        cache_directory = os.path.abspath(compression_config.static_cache_directory)
+        if compression_config.enabled and compression_config.precompress_static:
+            try:
+                for path in compression.compress_static_files(
+                        static_dirs[0], cache_directory, compression_config.minimum_size
+                ):
+                    logger.debug(f"Created compressed static file {path!r}")
+            except OSError as exc:
+                logger.warning(f"Compressing the static files failed: {exc}")
+        app.mount(
+            "/static",
+            compression.PrecompressedStaticFiles(
+                directory=static_dirs[0],
+                variants_directory=cache_directory if compression_config.enabled else None,
+                max_age=compression_config.static_max_age
+            ),
+            name="static"
+        )
 
         @app.get("/redoc", include_in_schema=False)
         async def get_redoc():
@@ -12,8 +12,8 @@ from typing import Any, Dict, List, Optional, Union
 import pydantic
 from fastapi import HTTPException, Request, Response
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
 
+from .negotiation import NegotiatedResponse
 from .. import schemas
 
 
@@ -87,7 +87,7 @@ class APIException(HTTPException):
                 f"{type(exc).__name__}: {exc} @ '{request.method} "
                 f"{request.url.path}' (details: {details})"
             )
-            return JSONResponse(jsonable_encoder(schemas.APIError(
+            return NegotiatedResponse(jsonable_encoder(schemas.APIError(
                 status=status_code,
                 method=request.method,
                 request=request.url.path,
@@ -110,7 +110,10 @@ class APIException(HTTPException):
             f"{type(exc).__name__}: {message} @ '{request.method} "
             f"{request.url.path}' (details: {exc.detail}"
         )
-        return JSONResponse(jsonable_encoder(schemas.APIError(
+        if status_code == 304:
+            # A 304 (Not Modified) response must not contain a message body
+            return Response(status_code=status_code, headers=exc.headers)
+        return NegotiatedResponse(jsonable_encoder(schemas.APIError(
             status=status_code,
             method=request.method,
             request=request.url.path,
@@ -120,17 +123,32 @@ class APIException(HTTPException):
         )), status_code=status_code, headers=exc.headers)
 
 
+class BadRequest(APIException):
+    """
+    Exception for requests with invalid or unsupported parameters
+    """
+
+    def __init__(self, message: str, detail: Optional[str] = None):
+        super().__init__(
+            status_code=400,
+            detail=detail,
+            repeat=False,
+            message=message
+        )
+
+
 class NotModified(APIException):
     """
     Exception when a requested resource hasn't changed since last request
     """
 
-    def __init__(self, resource: str, detail: Optional[str] = None):
+    def __init__(self, resource: str, detail: Optional[str] = None, tag: Optional[str] = None):
         super().__init__(
             status_code=304,
             detail=detail,
             repeat=True,
-            message=f"Resource '{str(resource)}' has not been modified."
+            message=f"Resource '{str(resource)}' has not been modified.",
+            headers=tag and {"ETag": f'"{tag}"'}
         )
 
 
@@ -0,0 +1,321 @@
+"""
+Compression of responses and precompressed static files for the core REST API
+
+Responses are compressed using brotli or gzip, depending on the ``Accept-Encoding``
+header of the request. Brotli is only available if the optional ``brotli``
+package is installed. Small responses, responses which are already encoded
+(e.g. precompressed static files) and event streams are sent unchanged.
+Streamed responses (e.g. exports) are compressed chunk by chunk, where each
+chunk is flushed, so that the client receives it without further delay.
+
+Since the compressed representation of a resource must not share the entity
+tag of the uncompressed one, the name of the content coding is appended to
+the ``ETag`` of compressed responses (like ``"<tag>-gzip"``). The suffix is
+stripped from the conditional headers of incoming requests again, just like
+the suffixes of the binary media types (see the ``negotiation`` module).
+
+The static files are served with long-lived cache headers. If an up-to-date
+compressed variant of a file exists (with the suffix ``.br`` or ``.gz``) in
+the directory of the variants, it will be sent instead of the original file
+to clients accepting its encoding. Those variants can be created at build
+time or in a cache directory at startup using ``compress_static_files``,
+so that the (possibly read-only) directory of the package isn't changed.
+"""
+
+import os
+import gzip
+import zlib
+from typing import Iterable, List, Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .negotiation import strip_etag_suffixes
+
+# Supported content codings in the order of preference with the file suffixes
+# of their precompressed variants (brotli is only supported if it's installed)
+ENCODINGS = {"br": ".br", "gzip": ".gz"} if brotli is not None else {"gzip": ".gz"}
+
+# Media types which are never compressed, because they are streamed to the client
+_UNCOMPRESSED_TYPES = ("text/event-stream",)
+
+# File suffixes of static files which are already compressed
+_COMPRESSED_SUFFIXES = (".br", ".gz", ".png", ".jpg", ".jpeg", ".gif", ".webp", ".woff2", ".zip")
+
+
+def choose_encoding(accept_encoding: str, available: Iterable[str]) -> Optional[str]:
+    """
+    Choose the preferred content coding of the client out of the available ones
+
+    :param accept_encoding: value of the ``Accept-Encoding`` header of the request
+    :param available: names of the available content codings in the order of preference
+    :return: name of the chosen content coding or None (identity)
+    """
+
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, *params = [part.strip() for part in item.split(";")]
+        weight = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    weight = float(param[2:])
+                except ValueError:
+                    weight = 0.0
+        if name:
+            weights[name.lower()] = weight
+
+    best, best_weight = None, 0.0
+    for encoding in available:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def _make_compressor(encoding: str, gzip_level: int, brotli_quality: int):
+    if encoding == "br":
+        return brotli.Compressor(quality=brotli_quality)
+    return zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing the bodies of responses exceeding a minimum size
+    """
+
+    def __init__(
+            self,
+            app: ASGIApp,
+            minimum_size: int = 1024,
+            gzip_level: int = 6,
+            brotli_quality: int = 4
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = MutableHeaders(scope={"headers": list(scope["headers"])})
+        if "If-Match" in request_headers:
+            request_headers["If-Match"] = strip_etag_suffixes(
+                request_headers["If-Match"], [_get_suffix(encoding) for encoding in ENCODINGS]
+            )
+        encoding = choose_encoding(request_headers.get("Accept-Encoding", ""), ENCODINGS)
+        matched = False
+        if encoding is not None and "If-None-Match" in request_headers:
+            tags = request_headers["If-None-Match"]
+            request_headers["If-None-Match"] = strip_etag_suffixes(tags, [_get_suffix(encoding)])
+            matched = request_headers["If-None-Match"] != tags
+        scope = dict(scope, headers=request_headers.raw)
+
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _Responder(self, encoding, matched, send).send)
+
+
+def _get_suffix(encoding: str) -> str:
+    return "-" + encoding
+
+
+def _add_suffix(headers: MutableHeaders, encoding: str):
+    tag: Optional[str] = headers.get("ETag")
+    if tag is not None and tag.endswith('"'):
+        headers["ETag"] = tag[:-1] + _get_suffix(encoding) + '"'
+
+
+class _Responder:
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, matched: bool, send: Send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self.matched = matched
+        self.next_send = send
+        self.start_message: Optional[Message] = None
+        self.compressor = None
+        self.passthrough = False
+
+    def _is_compressible(self, headers: MutableHeaders, body: bytes, more_body: bool) -> bool:
+        if self.start_message["status"] in (204, 206, 304) or "Content-Encoding" in headers:
+            return False
+        if headers.get("Content-Type", "").startswith(_UNCOMPRESSED_TYPES):
+            return False
+        if "no-transform" in headers.get("Cache-Control", ""):
+            return False
+        return more_body or len(body) >= self.middleware.minimum_size
+
+    def _compress(self, data: bytes, final: bool) -> bytes:
+        result = self.compressor.compress(data)
+        if self.encoding == "br":
+            return result + (self.compressor.finish() if final else self.compressor.flush())
+        return result + self.compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+    async def send(self, message: Message):
+        if self.passthrough:
+            await self.next_send(message)
+            return
+        if message["type"] == "http.response.start":
+            # Not modified responses carry the tag of the compressed representation
+            # if the client asked for it (the empty body is sent without encoding)
+            if message["status"] == 304 and self.matched:
+                _add_suffix(MutableHeaders(raw=message["headers"]), self.encoding)
+            self.start_message = message
+            return
+        if message["type"] != "http.response.body":
+            await self.next_send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compressor is None:
+            headers = MutableHeaders(raw=self.start_message["headers"])
+            if not self._is_compressible(headers, body, more_body):
+                self.passthrough = True
+                await self.next_send(self.start_message)
+                await self.next_send(message)
+                return
+
+            self.compressor = _make_compressor(
+                self.encoding,
+                self.middleware.gzip_level,
+                self.middleware.brotli_quality
+            )
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            _add_suffix(headers, self.encoding)
+            if more_body:
+                del headers["Content-Length"]
+                await self.next_send(self.start_message)
+            else:
+                body = self._compress(body, True)
+                headers["Content-Length"] = str(len(body))
+                await self.next_send(self.start_message)
+                await self.next_send({"type": "http.response.body", "body": body})
+                return
+
+        await self.next_send({
+            "type": "http.response.body",
+            "body": self._compress(body, not more_body),
+            "more_body": more_body
+        })
+
+
+def _is_up_to_date(path: str, variant: str) -> bool:
+    return os.path.isfile(variant) and os.path.getmtime(variant) >= os.path.getmtime(path)
+
+
+def compress_static_files(
+        directory: str,
+        target_directory: Optional[str] = None,
+        minimum_size: int = 1024,
+        gzip_level: int = 9,
+        brotli_quality: int = 11
+) -> List[str]:
+    """
+    Create the missing or outdated compressed variants of the static files in a directory
+
+    Every supported content coding gets its own file, which is named like the
+    original file with an additional suffix (e.g. ``redoc.standalone.js.gz``).
+    The variants are stored in the same relative paths below the target directory,
+    which defaults to the directory of the static files themselves (useful at
+    build time). Small files and files which are compressed by themselves are skipped.
+
+    :param directory: path of the directory containing the static files
+    :param target_directory: optional path of the directory to store the variants in
+    :param minimum_size: minimum size of a file to create its compressed variants
+    :param gzip_level: gzip compression level
+    :param brotli_quality: brotli compression quality (only used if brotli is installed)
+    :return: list of the paths of the newly written files
+    :raises OSError: when the directory or its files can't be read or written
+    """
+
+    compressors = {
+        ".gz": lambda data: gzip.compress(data, compresslevel=gzip_level, mtime=0),
+    }
+    if brotli is not None:
+        compressors[".br"] = lambda data: brotli.compress(data, quality=brotli_quality)
+
+    written = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.endswith(_COMPRESSED_SUFFIXES) or os.path.getsize(path) < minimum_size:
+                continue
+            target = os.path.join(target_directory or directory, os.path.relpath(path, directory))
+            data = None
+            for suffix, compress in compressors.items():
+                if _is_up_to_date(path, target + suffix):
+                    continue
+                if data is None:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target + suffix, "wb") as f:
+                    f.write(compress(data))
+                written.append(target + suffix)
+    return written
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    Static files application serving precompressed variants with long-lived cache headers
+
+    See ``compress_static_files`` to create the compressed variants in the
+    ``variants_directory`` (which may be the directory of the static files, too).
+    Outdated variants are ignored and no variants are served at all without
+    such a directory. The ``max_age`` (in seconds) is used for the ``Cache-Control``
+    header.
+    """
+
+    def __init__(
+            self,
+            *args,
+            variants_directory: Optional[str] = None,
+            max_age: int = 604800,
+            **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.variants_directory = variants_directory
+        self.max_age = max_age
+
+    def _get_variant(self, path: str, response: FileResponse, scope: Scope) -> Optional[Response]:
+        request_headers = Headers(scope=scope)
+        target = os.path.join(self.variants_directory, path)
+        available = [
+            encoding for encoding, suffix in ENCODINGS.items()
+            if _is_up_to_date(response.path, target + suffix)
+        ]
+        encoding = choose_encoding(request_headers.get("Accept-Encoding", ""), available)
+        if encoding is None:
+            return None
+
+        variant = FileResponse(
+            target + ENCODINGS[encoding],
+            media_type=response.media_type,
+            headers={"Content-Encoding": encoding}
+        )
+        if self.is_not_modified(variant.headers, request_headers):
+            return NotModifiedResponse(variant.headers)
+        return variant
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        response = await super().get_response(path, scope)
+        compressible = self.variants_directory is not None and response.status_code == 200
+        if compressible and isinstance(response, FileResponse):
+            response = self._get_variant(path, response, scope) or response
+        if response.status_code in (200, 304):
+            response.headers["Cache-Control"] = f"public, max-age={self.max_age}"
+            response.headers.add_vary_header("Accept-Encoding")
+        return response
@@ -3,26 +3,38 @@ MateBot API dependency library
 """
 
 import logging
-from typing import Generator, Optional
+from typing import Any, AsyncGenerator, Callable, Generator, List, Optional, Tuple, Type, Union
 
+import pydantic
+import sqlalchemy
 import sqlalchemy.exc
 from fastapi import Depends, Request, Response
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
 from . import base, etag
-from ..persistence import database
+from ..persistence import database, models
+from ..persistence.database import AsyncSession
 from ..settings import Settings
 
 
 logger = logging.getLogger(__name__)
 
+_READ_ONLY_METHODS = ("GET", "HEAD")
 
-def _get_session() -> Generator[Session, None, bool]:
+# Maximum number of objects per page of paginated collections
+MAX_PAGE_SIZE = 1000
+
+
+def _get_session(request: Request) -> Generator[Session, None, bool]:
     """
     Return a generator to handle database sessions gracefully
+
+    Safe requests (``GET`` and ``HEAD``) only read from the database,
+    so their sessions may be bound to a read-only replica, if configured.
     """
 
-    session = database.get_new_session()
+    session = database.get_new_session(read_only=request.method in _READ_ONLY_METHODS)
     try:
         yield session
         session.flush()
@@ -42,6 +54,45 @@ def _get_session() -> Generator[Session, None, bool]:
     return True
 
 
+async def _get_async_session(
+        request: Request
+) -> AsyncGenerator[Union[Session, AsyncSession], None]:
+    """
+    Return an asynchronous generator to handle asyncio database sessions gracefully
+
+    Without the asyncio mode of the database, a synchronous session is used instead
+    (see ``_get_session``), which is rolled back and closed in the thread pool.
+    """
+
+    if not database.has_async_engine():
+        session = database.get_new_session(read_only=request.method in _READ_ONLY_METHODS)
+        try:
+            yield session
+        except sqlalchemy.exc.SQLAlchemyError as exc:
+            logger.error(f"{type(exc).__name__}: {str(exc)}")
+            await run_in_threadpool(session.rollback)
+            raise
+        finally:
+            await run_in_threadpool(session.close)
+        return
+
+    session = database.get_new_async_session()
+    try:
+        yield session
+        await session.flush()
+    except sqlalchemy.exc.DBAPIError as exc:
+        details = exc.statement.replace("\n", "")
+        logger.error(f"{type(exc).__name__}: {', '.join(exc.args)} @ {details!r}")
+        await session.rollback()
+        raise
+    except sqlalchemy.exc.SQLAlchemyError as exc:
+        logger.error(f"{type(exc).__name__}: {str(exc)}")
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
+
+
 class LocalRequestData:
     """
     Collection of core dependencies used by all path operations
@@ -79,19 +130,251 @@ class LocalRequestData:
 
         self._config: Optional[Settings] = None
 
-    def attach_headers(self, model: base.ModelType, **kwargs) -> base.ModelType:
+    def attach_headers(
+            self,
+            model: base.ModelType,
+            tag: Optional[str] = None,
+            **kwargs
+    ) -> base.ModelType:
         """
         Attach the specified headers (excl. ETag) to the response and return the model
+
+        The ETag header will be calculated from the model, unless its ``tag`` is given.
         """
 
         for k in kwargs:
             if k.lower() != "etag":
                 self.response.headers.append(k, kwargs[k])
-        self.entity.add_header(self.response, model)
+        self.entity.add_header(self.response, model, tag)
         return model
 
+    def check_version(
+            self,
+            model: Type[models.Base],
+            object_id: Optional[int] = None,
+            variant: Optional[str] = None,
+            versions: Optional[List[Tuple[str, int, int]]] = None
+    ) -> str:
+        """
+        Compare the conditional request headers with the version of a row or collection
+
+        The ETag is calculated from version counters only, so that requests whose
+        conditional headers already decide the response (e.g. 304 Not Modified for
+        a matching ``If-None-Match``) are answered before any rows are loaded.
+        Only the wildcard ``*`` requires a lookup whether the row exists.
+
+        :param model: class of a SQLAlchemy model
+        :param object_id: optional ID of a row (or the whole collection if omitted)
+        :param variant: optional string distinguishing different representations
+        :param versions: optional list of version counters (see ``tracking.get_versions``)
+            which determine the ETag instead of those of the row or collection
+        :return: current ETag value, which should be attached to the response
+        :raises NotModified: if the user agent already has the most recent version
+        :raises PreconditionFailed: if any of the preconditions were not met
+        """
+
+        self.entity.model_name = model.__name__
+        if versions is not None:
+            tag = self.entity.make_tag_from_versions(versions, variant)
+        else:
+            tag = self.entity.make_version_tag(self.session, model, object_id, variant)
+        exists = True
+        if object_id is not None and self.entity.has_wildcard:
+            exists = self.session.execute(
+                sqlalchemy.select(model.id).where(model.id == object_id)
+            ).first() is not None
+        self.entity.compare(tag=tag, exists=exists)
+        return tag
+
     @property
     def config(self) -> Settings:
         if self._config is None:
             self._config = Settings()
         return self._config
+
+
+class AsyncLocalRequestData(LocalRequestData):
+    """
+    Collection of core dependencies used by asynchronous path operations
+
+    This class works like ``LocalRequestData``, but the database work has to be
+    done by a synchronous function awaited using ``run``. In the asyncio mode of
+    the database config, that function is run on the event loop with the asyncio
+    session (using ``run_sync``), so that waiting for the database doesn't occupy
+    a thread of the pool. Otherwise, it's run in the thread pool as usual. The
+    ``session`` attribute may only be used by those functions, which allows to
+    reuse the helper library for both modes (see ``helpers.get_all_of_model_async``):
+
+    .. code-block:: python3
+
+        @app.get("/users")
+        async def get_users(local: AsyncLocalRequestData = Depends(AsyncLocalRequestData)):
+            return await local.run(helpers.get_all_of_model, models.User, local)
+
+    Note that asyncio sessions are always bound to the primary database.
+    """
+
+    def __init__(
+            self,
+            request: Request,
+            response: Response,
+            session: Union[Session, AsyncSession] = Depends(_get_async_session)
+    ):
+        self.async_session: Optional[AsyncSession] = None
+        if AsyncSession is not None and isinstance(session, AsyncSession):
+            self.async_session = session
+            session = session.sync_session
+        super().__init__(request, response, session)
+
+    async def run(self, function: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Call the function with the given arguments, which may use the session of this object
+        """
+
+        if self.async_session is not None:
+            return await self.async_session.run_sync(lambda _: function(*args, **kwargs))
+        return await run_in_threadpool(function, *args, **kwargs)
+
+
+class Pagination:
+    """
+    Query parameters for the keyset pagination of collections
+
+    Add a dependency for this class to a path operation to support the query
+    parameters ``limit``, ``after_id`` and ``before_id``. Pages are defined by
+    the IDs of the objects instead of offsets, so each page is found by an
+    index lookup of the primary key, no matter how far it's into the collection.
+    If none of the parameters are given, the whole collection will be returned.
+
+    Pages are sorted by the ID in ascending order. With ``after_id``, the first
+    objects after that ID will be returned. With only ``before_id``, the last
+    objects before that ID will be returned (i.e. the previous page). After
+    loading a page, use ``get_links`` to get the value of the ``Link`` header
+    pointing to the next and previous pages, if there are any.
+    """
+
+    def __init__(
+            self,
+            limit: Optional[pydantic.conint(ge=1, le=MAX_PAGE_SIZE)] = None,
+            after_id: Optional[pydantic.NonNegativeInt] = None,
+            before_id: Optional[pydantic.NonNegativeInt] = None
+    ):
+        self.limit = limit
+        self.after_id = after_id
+        self.before_id = before_id
+
+        self._first: Optional[int] = None
+        self._last: Optional[int] = None
+        self._has_next = False
+        self._has_prev = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.limit is not None or self.after_id is not None or self.before_id is not None
+
+    @property
+    def backwards(self) -> bool:
+        return self.before_id is not None and self.after_id is None and self.limit is not None
+
+    @property
+    def variant(self) -> str:
+        """
+        Return a string identifying the page (to distinguish the ETags of different pages)
+        """
+
+        return f"limit={self.limit}&after_id={self.after_id}&before_id={self.before_id}"
+
+    def get_criteria(self, model: Type) -> List[Any]:
+        """
+        Return the SQL expressions to filter the objects of the given model
+        """
+
+        criteria = []
+        if self.after_id is not None:
+            criteria.append(model.id > self.after_id)
+        if self.before_id is not None:
+            criteria.append(model.id < self.before_id)
+        return criteria
+
+    def get_order(self, model: Type) -> Any:
+        """
+        Return the SQL expression to sort the objects of the given model before limiting them
+        """
+
+        return model.id.desc() if self.backwards else model.id.asc()
+
+    @property
+    def query_limit(self) -> Optional[int]:
+        """
+        Return the number of objects to query (one more than the limit to find further pages)
+        """
+
+        return self.limit and self.limit + 1
+
+    def finish(
+            self,
+            objects: List[Any],
+            get_id: Callable[[Any], int] = lambda obj: obj["id"]
+    ) -> List[Any]:
+        """
+        Cut the queried objects to the page in ascending order and remember the adjacent pages
+
+        :param objects: list of objects queried using the criteria, order and query limit
+        :param get_id: callable returning the ID of an object
+        :return: list of the objects of the page
+        """
+
+        more = self.limit is not None and len(objects) > self.limit
+        objects = objects[:self.limit] if self.limit is not None else objects
+        if self.backwards:
+            objects.reverse()
+        if objects:
+            self._first = get_id(objects[0])
+            self._last = get_id(objects[-1])
+            self._has_next = self.backwards or more
+            self._has_prev = more if self.backwards else self.after_id is not None
+        return objects
+
+    def get_links(self, request: Request) -> Optional[str]:
+        """
+        Return the value of the ``Link`` header for the page loaded before (or None)
+        """
+
+        if self.limit is None:
+            return None
+        url = request.url.remove_query_params(["after_id", "before_id"])
+        links = []
+        if self._has_next:
+            links.append(f'<{url.include_query_params(after_id=self._last)}>; rel="next"')
+        if self._has_prev:
+            links.append(f'<{url.include_query_params(before_id=self._first)}>; rel="prev"')
+        return ", ".join(links) or None
+
+
+class SparseFields:
+    """
+    Query parameter ``fields`` to select a subset of the fields of the returned objects
+
+    The value is a comma-separated list of field names of the schema. Only the
+    columns and relationships required for those fields will be loaded from the
+    database. The ``id`` of the objects is always included. Without the query
+    parameter, all fields will be returned. The names are validated against
+    the model by the helpers using them (see ``helpers.get_all_of_model``).
+    """
+
+    def __init__(self, fields: Optional[str] = None):
+        self.names: Optional[List[str]] = None
+        if fields is not None:
+            self.names = sorted({name.strip() for name in fields.split(",") if name.strip()})
+
+    @property
+    def enabled(self) -> bool:
+        return self.names is not None
+
+    @property
+    def variant(self) -> str:
+        """
+        Return a string identifying the fieldset (to distinguish the ETags of different ones)
+        """
+
+        return f"fields={','.join(self.names or [])}"
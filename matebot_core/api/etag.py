@@ -5,8 +5,8 @@ ETag helper library for the core REST API
 import uuid
 import hashlib
 import logging
-import collections
-from typing import Any, Optional
+import collections.abc
+from typing import Any, List, Optional, Tuple, Type
 
 try:
     import ujson as json
@@ -14,10 +14,12 @@ except ImportError:
     import json
 
 import pydantic
+import sqlalchemy.orm
 from fastapi import Request, Response
 from fastapi.encoders import jsonable_encoder
 
 from . import base
+from ..persistence import models, tracking
 
 
 logger = logging.getLogger(__name__)
@@ -35,21 +37,28 @@ class ETag:
         self.request = request
         self.model_name = None
 
-        for field in ["If-None-Match", "If-Modified-Since", "If-Unmodified-Since", "If-Range"]:
+        for field in ["If-Modified-Since", "If-Unmodified-Since", "If-Range"]:
             if request.headers.get(field):
                 logger.warning(f"'{field}' header not supported or not fully implemented.")
                 logger.debug(f"Field value: {request.headers.get(field)!r}")
 
-    def add_header(self, response: Response, model: base.ModelType) -> bool:
+    def add_header(
+            self,
+            response: Response,
+            model: base.ModelType,
+            tag: Optional[str] = None
+    ) -> bool:
         """
         Add the ETag header field of the model to the response
 
         :param response: Response object of the handled request
         :param model: generated model of the completely finished request
+        :param tag: optional precomputed ETag of the model (e.g. using ``make_version_tag``)
         :return: whether the ETag header has been set on the response
         """
 
-        tag = self.make_etag(model, self.model_name)
+        if tag is None:
+            tag = self.make_etag(model, self.model_name)
         if tag is not None:
             if not tag.startswith('"'):
                 tag = '"' + tag
@@ -58,7 +67,23 @@ class ETag:
             response.headers.append("ETag", tag)
         return tag is not None
 
-    def compare(self, current_model: Optional[base.ModelType] = None) -> bool:
+    @property
+    def has_wildcard(self) -> bool:
+        """
+        Determine whether a conditional header of the request uses the wildcard ``*``
+        """
+
+        return any(
+            (self.request.headers.get(field) or "").strip() == "*"
+            for field in ("If-Match", "If-None-Match")
+        )
+
+    def compare(
+            self,
+            current_model: Optional[base.ModelType] = None,
+            tag: Optional[str] = None,
+            exists: bool = True
+    ) -> bool:
         """
         Calculate and compare the ETag of the given model with the known client ETag
 
@@ -67,14 +92,21 @@ class ETag:
         means that the value in the header field matches the current state of
         the model. For GET requests, this allows to use the client's cached
         version. For modifying requests, this allows to detect mid-air collisions.
+        A matching ``If-None-Match`` header results in a 304 (Not Modified) for
+        GET and HEAD requests and in a 412 (Precondition Failed) for the others.
+        The wildcard ``*`` only matches if a current representation exists.
 
         :param current_model: any subclass of a base model or list thereof
+        :param tag: optional precomputed ETag of the model, which makes the model itself
+            unnecessary (this allows comparisons before loading it from the database)
+        :param exists: whether the resource currently exists (a precomputed tag is
+            available for missing rows as well, but they must not match ``*``)
         :return: ``True`` if everything went smoothly
         :raises NotModified: if the user agent already has the most recent version of a resource
         :raises PreconditionFailed: if any of the preconditions were not met
         """
 
-        model_tag = self.make_etag(current_model, self.model_name)
+        model_tag = tag if tag is not None else self.make_etag(current_model, self.model_name)
 
         precondition_failed = base.PreconditionFailed(
             self.request.url.path,
@@ -85,30 +117,95 @@ class ETag:
         if len(self.request.headers.getlist("If-Match")) > 1:
             logger.warning(f"More than one 'If-Match' header: {self.request.headers.items()}")
 
+        matched = False
         if match is not None and match != "":
             if match.strip() == "*":
-                if model_tag is None:
+                if model_tag is None or not exists:
                     raise precondition_failed
                 logger.warning(
                     f"Request for '{self.request.method} {self.request.url.path}' "
                     f"had 'If-Match' header value '*' for current model {model_tag}."
                 )
-                return True
-
-            for tag in map(str.strip, match.split(",")):
-                if tag.startswith('"'):
-                    tag = tag[1:]
-                if tag.endswith('"'):
-                    tag = tag[:-1]
-                if tag != "" and not tag.startswith("W/") and tag == model_tag:
-                    if self.request.method == "GET":
-                        raise base.NotModified(self.request.url.path)
-                    return True
-
-        if self.request.method not in ("GET", "POST"):
+                matched = True
+
+            elif model_tag is not None and model_tag in self._parse_tags(match, False):
+                if self.request.method == "GET":
+                    raise base.NotModified(self.request.url.path, tag=model_tag)
+                matched = True
+
+        none_match = self.request.headers.get("If-None-Match")
+        if none_match is not None and none_match != "" and model_tag is not None:
+            if (none_match.strip() == "*" and exists) or \
+                    model_tag in self._parse_tags(none_match, True):
+                if self.request.method in ("GET", "HEAD"):
+                    raise base.NotModified(self.request.url.path, tag=model_tag)
+                raise precondition_failed
+
+        if not matched and self.request.method not in ("GET", "HEAD", "POST"):
             raise precondition_failed
         return True
 
+    @staticmethod
+    def _parse_tags(header: str, weak: bool) -> List[str]:
+        """
+        Parse the list of entity tags of a conditional header field
+
+        Weak entity tags (prefixed with ``W/``) will be stripped of their prefix when
+        using the weak comparison (for ``If-None-Match``), otherwise they are ignored.
+        """
+
+        tags = []
+        for tag in map(str.strip, header.split(",")):
+            if tag.startswith("W/"):
+                if not weak:
+                    continue
+                tag = tag[2:]
+            if tag.startswith('"'):
+                tag = tag[1:]
+            if tag.endswith('"'):
+                tag = tag[:-1]
+            if tag != "":
+                tags.append(tag)
+        return tags
+
+    @staticmethod
+    def make_version_tag(
+            session: sqlalchemy.orm.Session,
+            model: Type[models.Base],
+            object_id: Optional[int] = None,
+            variant: Optional[str] = None
+    ) -> str:
+        """
+        Create the ETag value of a row or collection based on its version counters
+
+        This only requires a lookup of a few version counters, so the
+        resource doesn't need to be loaded or serialized for comparisons.
+
+        :param session: database session which should be used to perform the queries
+        :param model: class of a SQLAlchemy model
+        :param object_id: optional ID of a row (or the whole collection if omitted)
+        :param variant: optional string distinguishing different representations
+            of the same versions, e.g. filtered views of a collection
+        :return: ETag value as a string
+        """
+
+        versions = tracking.get_versions(session, model, object_id)
+        return ETag.make_tag_from_versions(versions, variant)
+
+    @staticmethod
+    def make_tag_from_versions(
+            versions: List[Tuple[str, int, int]],
+            variant: Optional[str] = None
+    ) -> str:
+        """
+        Create the ETag value out of a list of version counters (see ``make_version_tag``)
+        """
+
+        content = ";".join(f"{name}:{object_id}:{version}" for name, object_id, version in versions)
+        if variant:
+            content += "?" + variant
+        return str(uuid.UUID(hashlib.md5(content.encode("UTF-8")).hexdigest()))
+
     @staticmethod
     def make_etag(obj: Any, name: Optional[str] = None) -> Optional[str]:
         """
@@ -127,13 +224,16 @@ class ETag:
         weak = False
         if isinstance(obj, pydantic.BaseModel):
             representation = obj.dict()
-        elif isinstance(obj, collections.Sequence):
-            if any(map(lambda x: not isinstance(x, pydantic.BaseModel), obj)):
+        elif isinstance(obj, collections.abc.Sequence):
+            if all(map(lambda x: isinstance(x, pydantic.BaseModel), obj)):
+                representation = [e.dict() for e in obj]
+            elif all(map(lambda x: isinstance(x, dict), obj)):
+                # Rows of the raw serializers equal the dict of their models
+                representation = list(obj)
+            else:
                 logger.warning(f"Not all elements of the sequence of length {len(obj)} are models")
                 representation = jsonable_encoder(obj)
                 weak = True
-            else:
-                representation = [e.dict() for e in obj]
         else:
             logger.warning(f"Object {obj!r} ({type(object)}) is no valid model")
             representation = jsonable_encoder(obj)
@@ -0,0 +1,157 @@
+"""
+Streaming export of the transaction history for the core REST API
+
+The export reads the transactions with a server-side cursor (if supported by
+the database driver) and encodes them in chunks of a fixed number of rows,
+so that the memory usage stays constant, no matter how many rows are
+exported. The generator of the encoded chunks uses its own database session,
+which allows it to outlive the request's session (e.g. in a ``StreamingResponse``)
+and to be used outside the API, too (e.g. by the ``export`` command line tool).
+"""
+
+import io
+import csv
+import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+import sqlalchemy
+import sqlalchemy.orm
+
+from ..persistence import database, models
+
+
+# Supported export formats with their media types
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv"
+}
+
+# Names of the exported fields of every transaction (in their order)
+FIELDS = ["id", "sender", "receiver", "amount", "reason", "transaction_type", "timestamp"]
+
+# Default number of rows fetched from the database and encoded at once
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def select_transactions(
+        since: Optional[datetime.datetime] = None,
+        until: Optional[datetime.datetime] = None
+) -> sqlalchemy.sql.Select:
+    """
+    Return the statement selecting the exported fields of the transactions in a time range
+
+    The transactions are ordered by their timestamp (and ID), so that the
+    index on the timestamp can be used for both the range and the order.
+
+    :param since: optional inclusive lower bound of the transactions' timestamps
+    :param until: optional exclusive upper bound of the transactions' timestamps
+    """
+
+    statement = sqlalchemy.select(
+        models.Transaction.id.label("id"),
+        models.Transaction.sender_id.label("sender"),
+        models.Transaction.receiver_id.label("receiver"),
+        models.Transaction.amount.label("amount"),
+        models.Transaction.reason.label("reason"),
+        models.TransactionType.name.label("transaction_type"),
+        models.Transaction.registered.label("timestamp")
+    ).select_from(sqlalchemy.outerjoin(
+        models.Transaction,
+        models.TransactionType,
+        models.Transaction.transaction_types_id == models.TransactionType.id
+    )).order_by(models.Transaction.registered, models.Transaction.id)
+
+    if since is not None:
+        statement = statement.where(models.Transaction.registered >= since)
+    if until is not None:
+        statement = statement.where(models.Transaction.registered < until)
+    return statement
+
+
+def iter_transactions(
+        session: sqlalchemy.orm.Session,
+        since: Optional[datetime.datetime] = None,
+        until: Optional[datetime.datetime] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Iterate over chunks of exported transactions in a time range
+
+    :param session: database session which should be used to perform the query
+    :param since: optional inclusive lower bound of the transactions' timestamps
+    :param until: optional exclusive upper bound of the transactions' timestamps
+    :param chunk_size: maximum number of transactions per chunk
+    :return: iterator over lists of dictionaries with the ``FIELDS`` as keys
+    """
+
+    statement = select_transactions(since, until).execution_options(
+        stream_results=True,
+        yield_per=chunk_size
+    )
+    for partition in session.execute(statement).partitions(chunk_size):
+        chunk = []
+        for row in partition:
+            item = dict(row._mapping)
+            item["timestamp"] = int(item["timestamp"].timestamp())
+            chunk.append(item)
+        yield chunk
+
+
+def _encode_ndjson(chunk: List[Dict[str, Any]]) -> str:
+    return "".join(json.dumps(item) + "\n" for item in chunk)
+
+
+def _encode_csv(chunk: List[Dict[str, Any]]) -> str:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, FIELDS, lineterminator="\n")
+    writer.writerows(chunk)
+    return buffer.getvalue()
+
+
+def _generate(
+        encode: Callable[[List[Dict[str, Any]]], str],
+        header: Optional[str],
+        since: Optional[datetime.datetime],
+        until: Optional[datetime.datetime],
+        chunk_size: int
+) -> Iterator[str]:
+    session = database.get_new_session(read_only=True)
+    try:
+        if header is not None:
+            yield header
+        for chunk in iter_transactions(session, since, until, chunk_size):
+            yield encode(chunk)
+    finally:
+        session.close()
+
+
+def generate(
+        export_format: str,
+        since: Optional[datetime.datetime] = None,
+        until: Optional[datetime.datetime] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Iterator[str]:
+    """
+    Return a generator of the encoded transactions in a time range, chunk by chunk
+
+    The generator opens a new read-only database session on its first
+    iteration and closes it when it's exhausted or closed. CSV exports
+    start with a header line containing the names of the fields.
+
+    :param export_format: one of the keys of ``FORMATS``
+    :param since: optional inclusive lower bound of the transactions' timestamps
+    :param until: optional exclusive upper bound of the transactions' timestamps
+    :param chunk_size: maximum number of transactions per chunk
+    :raises ValueError: for unknown export formats
+    """
+
+    if export_format == "csv":
+        return _generate(_encode_csv, ",".join(FIELDS) + "\n", since, until, chunk_size)
+    if export_format == "ndjson":
+        return _generate(_encode_ndjson, None, since, until, chunk_size)
+    raise ValueError(f"Unknown export format {export_format!r}")
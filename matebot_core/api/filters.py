@@ -0,0 +1,250 @@
+"""
+Filtering and sorting of collections for the core REST API
+
+Collection endpoints accept a small query language, which is compiled into
+the ``WHERE`` and ``ORDER BY`` clauses of the database query, so that clients
+don't need to download whole collections to find the objects they are
+interested in. Only the fields whitelisted per model can be used. Most of
+them are backed by indexes (e.g. the timestamps, senders and receivers of
+transactions or the creators of refunds), so that the database does the work.
+
+The field names are those of the schemas. A query parameter ``field=value``
+filters for equality, ``field__op=value`` uses one of the operators ``ne``,
+``lt``, ``le``, ``gt``, ``ge`` or ``in`` (the latter with a comma-separated
+list of values). Timestamps are given in seconds since the epoch, just like
+they are reported by the API. The parameter ``sort`` takes a comma-separated
+list of fields, each prefixed by ``-`` for descending order. Rows with equal
+values of all sort fields are sorted by their ID (which is the default order).
+
+Example: ``GET /transactions?timestamp__ge=1640995200&sender__in=1,2&sort=-amount``
+"""
+
+import datetime
+from typing import Any, Callable, Dict, List, Type
+
+from fastapi import Request
+from sqlalchemy.sql.elements import ColumnElement
+
+from .base import BadRequest
+from ..persistence import models
+
+
+# Name of the query parameter defining the sort order
+SORT = "sort"
+
+# Separator of a field name and an operator in the name of a query parameter
+_SEPARATOR = "__"
+
+# Maximum number of values for the ``in`` operator
+_MAX_IN_VALUES = 100
+
+_OPERATORS: Dict[str, Callable[[ColumnElement, Any], ColumnElement]] = {
+    "eq": lambda column, value: column == value,
+    "ne": lambda column, value: column != value,
+    "lt": lambda column, value: column < value,
+    "le": lambda column, value: column <= value,
+    "gt": lambda column, value: column > value,
+    "ge": lambda column, value: column >= value,
+    "in": lambda column, values: column.in_(values)
+}
+
+
+def _parse_bool(value: str) -> bool:
+    if value.lower() in ("1", "true", "yes"):
+        return True
+    if value.lower() in ("0", "false", "no"):
+        return False
+    raise ValueError(f"invalid boolean {value!r}")
+
+
+def _parse_timestamp(value: str) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(int(value))
+
+
+class Field:
+    """
+    Whitelisted field of a collection which can be used for filtering and sorting
+
+    The ``parse`` function converts a value of a query parameter into the value
+    compared with the ``column``, raising a ``ValueError`` for invalid values.
+    The ``operators`` restrict the allowed operators (besides equality).
+    """
+
+    def __init__(
+            self,
+            column: ColumnElement,
+            parse: Callable[[str], Any] = int,
+            operators: tuple = ("ne", "lt", "le", "gt", "ge", "in")
+    ):
+        self.column = column
+        self.parse = parse
+        self.operators = ("eq", *operators)
+
+
+class Filtering:
+    """
+    Filter criteria and sort order of one request for a collection
+    """
+
+    def __init__(self, criteria: List[ColumnElement], order: List[ColumnElement], variant: str):
+        self.criteria = criteria
+        self.order = order
+        self.variant = variant
+
+    @property
+    def sorted(self) -> bool:
+        """
+        Determine whether the request changes the default order (by ascending ID)
+        """
+
+        return bool(self.order)
+
+
+class Filter:
+    """
+    Dependency parsing the filter and sort query parameters of a collection's endpoint
+
+    Query parameters with a name of a field (optionally followed by an operator)
+    and the ``sort`` parameter are compiled into the resulting ``Filtering``.
+    Other query parameters of the path operation are silently ignored, unless
+    they look like a filter for an unknown field (i.e. contain an operator).
+    Invalid names, operators or values result in a 400 error.
+    """
+
+    def __init__(self, model: Type[models.Base], **fields: Field):
+        self.model = model
+        self.fields = fields
+
+    @property
+    def openapi(self) -> Dict[str, Any]:
+        """
+        Get the OpenAPI description of the query parameters (for a route's ``openapi_extra``)
+
+        Those parameters are read from the request directly, so FastAPI doesn't know them.
+        """
+
+        parameters = [
+            {
+                "name": name,
+                "in": "query",
+                "required": False,
+                "schema": {"type": "string"},
+                "description": self._describe(name, field)
+            }
+            for name, field in self.fields.items()
+        ]
+        parameters.append({
+            "name": SORT,
+            "in": "query",
+            "required": False,
+            "schema": {"type": "string"},
+            "description": "Comma-separated list of fields to sort by, prefixed by `-` for "
+                           f"descending order (one of {', '.join(self.fields)})"
+        })
+        return {"parameters": parameters}
+
+    @staticmethod
+    def _describe(name: str, field: Field) -> str:
+        description = f"Filter by equality of `{name}`"
+        if len(field.operators) > 1:
+            operators = ", ".join(f"`{op}`" for op in field.operators[1:])
+            description += f", use `{name}__op` for one of the operators {operators}"
+            if "in" in field.operators:
+                description += " (`in` takes a comma-separated list)"
+        if field.parse is _parse_timestamp:
+            description += "; timestamps are given in seconds since the epoch"
+        return description
+
+    def _parse(self, name: str, operator: str, raw_value: str) -> ColumnElement:
+        field = self.fields.get(name)
+        if field is None:
+            raise BadRequest("Unknown filter field.", f"field={name!r}, known={list(self.fields)}")
+        if operator not in field.operators:
+            raise BadRequest(
+                "Unsupported filter operator.",
+                f"field={name!r}, operator={operator!r}, supported={list(field.operators)}"
+            )
+
+        try:
+            if operator == "in":
+                values = [field.parse(v) for v in raw_value.split(",") if v != ""]
+                if not 0 < len(values) <= _MAX_IN_VALUES:
+                    raise ValueError(f"expected 1 to {_MAX_IN_VALUES} values")
+                return _OPERATORS[operator](field.column, values)
+            return _OPERATORS[operator](field.column, field.parse(raw_value))
+        except (ValueError, OverflowError, OSError) as exc:
+            raise BadRequest("Invalid filter value.", f"field={name!r}, error={exc}") from exc
+
+    def _parse_order(self, raw_value: str) -> List[ColumnElement]:
+        order = []
+        for name in raw_value.split(","):
+            descending = name.startswith("-")
+            name = name.lstrip("-+")
+            if name not in self.fields:
+                raise BadRequest(
+                    "Unknown sort field.",
+                    f"field={name!r}, known={list(self.fields)}"
+                )
+            column = self.fields[name].column
+            order.append(column.desc() if descending else column.asc())
+        return order
+
+    def __call__(self, request: Request) -> Filtering:
+        criteria = []
+        order = []
+        used = []
+        for key, value in request.query_params.multi_items():
+            if key == SORT:
+                order.extend(self._parse_order(value))
+            elif _SEPARATOR in key:
+                criteria.append(self._parse(*key.split(_SEPARATOR, 1), value))
+            elif key in self.fields:
+                criteria.append(self._parse(key, "eq", value))
+            else:
+                continue
+            used.append(f"{key}={value}")
+        return Filtering(criteria, order, "&".join(sorted(used)))
+
+
+FILTERS: Dict[Type[models.Base], Filter] = {
+    models.User: Filter(
+        models.User,
+        id=Field(models.User.id),
+        balance=Field(models.User.total_balance),
+        permission=Field(models.User.permission, _parse_bool, ()),
+        active=Field(models.User.active, _parse_bool, ()),
+        external=Field(models.User.external, _parse_bool, ()),
+        voucher=Field(models.User.voucher_id)
+    ),
+    models.Transaction: Filter(
+        models.Transaction,
+        id=Field(models.Transaction.id),
+        sender=Field(models.Transaction.sender_id),
+        receiver=Field(models.Transaction.receiver_id),
+        amount=Field(models.Transaction.amount),
+        timestamp=Field(models.Transaction.registered, _parse_timestamp)
+    ),
+    models.Vote: Filter(
+        models.Vote,
+        id=Field(models.Vote.id),
+        user_id=Field(models.Vote.user_id),
+        ballot_id=Field(models.Vote.ballot_id),
+        vote=Field(models.Vote.vote),
+        modified=Field(models.Vote.modified, _parse_timestamp)
+    ),
+    models.Refund: Filter(
+        models.Refund,
+        id=Field(models.Refund.id),
+        amount=Field(models.Refund.amount),
+        creator=Field(models.Refund.creator_id),
+        active=Field(models.Refund.active, _parse_bool, ()),
+        ballot=Field(models.Refund.ballot_id)
+    ),
+    models.Communism: Filter(
+        models.Communism,
+        id=Field(models.Communism.id),
+        amount=Field(models.Communism.amount),
+        creator=Field(models.Communism.creator_id),
+        active=Field(models.Communism.active, _parse_bool, ())
+    )
+}
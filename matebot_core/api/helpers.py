@@ -4,15 +4,24 @@ Generic helper library for the core REST API
 
 import sys
 import logging
-from typing import Any, Callable, List, Optional, Type
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union
+
+try:
+    import ujson as json
+except ImportError:
+    import json
 
 import pydantic
+import sqlalchemy
 import sqlalchemy.exc
 import sqlalchemy.orm
+from fastapi.responses import Response
 
-from .base import APIException, Conflict, NotFound
-from .dependency import LocalRequestData
-from ..persistence import models
+from . import negotiation, serializers
+from .base import APIException, BadRequest, Conflict, NotFound
+from .dependency import AsyncLocalRequestData, LocalRequestData, Pagination, SparseFields
+from .filters import Filtering
+from ..persistence import database, models, tracking
 
 
 def _handle_db_exception(
@@ -54,7 +63,8 @@ def _handle_db_exception(
 def return_one(
         object_id: int,
         model: Type[models.Base],
-        session: sqlalchemy.orm.Session
+        session: sqlalchemy.orm.Session,
+        options: Optional[list] = None
 ) -> models.Base:
     """
     Return the object of a given model that's identified by its object ID
@@ -62,11 +72,12 @@ def return_one(
     :param object_id: internal ID (primary key in the database) of the model
     :param model: class of a SQLAlchemy model
     :param session: database session which should be used to perform the query
+    :param options: optional list of loader options applied to the query
     :return: resulting entity as SQLAlchemy model
     :raises NotFound: when the specified object ID returned no result
     """
 
-    obj = session.get(model, object_id)
+    obj = session.get(model, object_id, options=options)
     if obj is None:
         raise NotFound(f"{model.__name__} ID {object_id!r}")
     return obj
@@ -100,56 +111,242 @@ def get_one_of_model(
         object_id: int,
         model: Type[models.Base],
         local: LocalRequestData,
-        headers: Optional[dict] = None
-) -> pydantic.BaseModel:
+        headers: Optional[dict] = None,
+        fields: Optional[SparseFields] = None
+) -> Union[pydantic.BaseModel, Response]:
     """
     Get the object of a given model that's identified by its object ID
 
     This method will also take care of handling any conditional request headers
     and setting the correct ``ETag`` header (besides the others) in the response.
+    The ETag is derived from version counters, so that conditional requests are
+    handled before the object itself is loaded from the database. With a sparse
+    fieldset, only the selected fields are loaded and returned (as raw response).
 
     :param object_id: internal ID (primary key in the database) of the model
     :param model: class of a SQLAlchemy model
     :param local: contextual local data
     :param headers: additional headers for the response
-    :return: resulting entity as pydantic schema instance
+    :param fields: optional sparse fieldset of the request
+    :return: resulting entity as pydantic schema instance or a finished response
     :raises NotFound: when the specified object ID returned no result
+    :raises BadRequest: when the sparse fieldset contains unknown fields
     """
 
-    obj = return_one(object_id, model, local.session)
+    names = _get_field_names(model, fields)
+    tag = local.check_version(model, object_id, variant=_get_variant({}, None, None, fields))
+    if names is not None:
+        item = _query_one(local.session, model, object_id, names)
+        return _make_raw_response(item, local, headers, tag)
+    obj = return_one(object_id, model, local.session, models.schema_loader_options(model))
     schema = obj.schema
-    local.entity.model_name = model.__name__
-    local.entity.compare(schema)
     if headers and isinstance(headers, dict):
-        return local.attach_headers(schema, **headers)
-    return local.attach_headers(schema)
+        return local.attach_headers(schema, tag, **headers)
+    return local.attach_headers(schema, tag)
+
+
+def _make_raw_response(
+        rows: Union[List[Dict[str, Any]], Dict[str, Any]],
+        local: LocalRequestData,
+        headers: Optional[dict] = None,
+        tag: Optional[str] = None
+) -> Response:
+    """
+    Create a response out of the rows of a raw serializer in the negotiated media type
+
+    The response is returned by the path operation directly, so that the response
+    model won't be validated and encoded again. Therefore, the headers attached to
+    the dependency's response (e.g. the ``ETag``) have to be copied into it.
+    """
+
+    if headers and isinstance(headers, dict):
+        local.attach_headers(rows, tag, **headers)
+    else:
+        local.attach_headers(rows, tag)
+    if negotiation.get_media_type() == negotiation.JSON:
+        response = Response(content=json.dumps(rows).encode("UTF-8"), media_type="application/json")
+    else:
+        response = negotiation.NegotiatedResponse(rows)
+    for key, value in local.response.headers.items():
+        response.headers.append(key, value)
+    return response
+
+
+def _get_field_names(
+        model: Type[models.Base],
+        fields: Optional[SparseFields]
+) -> Optional[List[str]]:
+    if fields is None or not fields.enabled:
+        return None
+    if model in serializers.SERIALIZERS:
+        serializer = serializers.SERIALIZERS[model]
+        try:
+            serializer.get_fields(fields.names)
+        except KeyError as exc:
+            raise BadRequest(
+                "Unknown field in the sparse fieldset.",
+                f"unknown=[{exc.args[0]}], known={list(serializer.fields)}"
+            ) from exc
+    return fields.names
+
+
+def _query_one(
+        session: sqlalchemy.orm.Session,
+        model: Type[models.Base],
+        object_id: int,
+        names: List[str]
+) -> Dict[str, Any]:
+    if model in serializers.SERIALIZERS:
+        rows = serializers.SERIALIZERS[model].load(session, model.id == object_id, fields=names)
+        if not rows:
+            raise NotFound(f"{model.__name__} ID {object_id!r}")
+        return rows[0]
+    obj = return_one(object_id, model, session, models.schema_loader_options(model))
+    return obj.schema.dict(include={"id", *names})
+
+
+def _get_variant(
+        kwargs: dict,
+        pagination: Optional[Pagination],
+        filtering: Optional[Filtering],
+        fields: Optional[SparseFields],
+        extra: Optional[str] = None
+) -> Optional[str]:
+    variant = [extra] if extra else []
+    if kwargs:
+        variant.append(repr(kwargs))
+    if pagination is not None and pagination.enabled:
+        if filtering is not None and filtering.sorted:
+            raise BadRequest(
+                "Pagination is only supported in the default order of the collection.",
+                "Remove the 'sort' query parameter or the pagination parameters."
+            )
+        variant.append(pagination.variant)
+    if filtering is not None and filtering.variant:
+        variant.append(filtering.variant)
+    if fields is not None and fields.enabled:
+        variant.append(fields.variant)
+    return "&".join(variant) or None
+
+
+def _query_all(
+        session: sqlalchemy.orm.Session,
+        model: Type[models.Base],
+        pagination: Optional[Pagination],
+        filtering: Optional[Filtering],
+        names: Optional[List[str]],
+        criteria: Optional[list],
+        **kwargs
+) -> List[Union[Dict[str, Any], pydantic.BaseModel]]:
+    criteria, order_by, limit = list(criteria or []), [model.id], None
+    paginated = pagination is not None and pagination.enabled
+    if paginated:
+        criteria.extend(pagination.get_criteria(model))
+        order_by, limit = [pagination.get_order(model)], pagination.query_limit
+    if filtering is not None:
+        criteria.extend(filtering.criteria)
+        if filtering.sorted:
+            order_by = [*filtering.order, model.id]
+
+    if model in serializers.SERIALIZERS:
+        result = serializers.SERIALIZERS[model].load(
+            session, *criteria, order_by=order_by, limit=limit, fields=names, **kwargs
+        )
+        return pagination.finish(result) if paginated else result
+
+    query = session.query(model).options(*models.schema_loader_options(model))
+    query = query.filter(*criteria).filter_by(**kwargs).order_by(*order_by).limit(limit)
+    result = [obj.schema for obj in query.all()]
+    if names is not None:
+        result = [schema.dict(include={"id", *names}) for schema in result]
+        return pagination.finish(result) if paginated else result
+    return pagination.finish(result, lambda obj: obj.id) if paginated else result
+
+
+def _respond_all(
+        result: List[Union[Dict[str, Any], pydantic.BaseModel]],
+        model: Type[models.Base],
+        local: LocalRequestData,
+        headers: Optional[dict],
+        pagination: Optional[Pagination],
+        tag: str,
+        raw: bool
+) -> Union[List[pydantic.BaseModel], Response]:
+    links = pagination and pagination.get_links(local.request)
+    if links is not None:
+        headers = dict(headers or {}, Link=links)
+    if raw or model in serializers.SERIALIZERS:
+        return _make_raw_response(result, local, headers, tag)
+    if headers and isinstance(headers, dict):
+        return local.attach_headers(result, tag, **headers)
+    return local.attach_headers(result, tag)
 
 
 def get_all_of_model(
         model: Type[models.Base],
         local: LocalRequestData,
         headers: Optional[dict] = None,
+        pagination: Optional[Pagination] = None,
+        filtering: Optional[Filtering] = None,
+        fields: Optional[SparseFields] = None,
+        criteria: Optional[list] = None,
+        versions: Optional[List[Tuple[str, int, int]]] = None,
+        variant: Optional[str] = None,
         **kwargs
-) -> List[pydantic.BaseModel]:
+) -> Union[List[pydantic.BaseModel], Response]:
     """
     Get a list of all known objects of a given model
 
     This method will also take care of handling any conditional request headers
     and setting the correct ``ETag`` header (besides the others) in the response.
+    Models with a raw serializer skip the ORM and are encoded directly into JSON.
+    With pagination, only one page will be returned (with its own ``ETag``) and
+    the ``Link`` header will point to the adjacent pages. Filter criteria and
+    sort orders are applied by the database query; a custom sort order can't
+    be combined with pagination (this will raise a ``BadRequest`` exception).
+    With a sparse fieldset, only the columns and relationships of the selected
+    fields are loaded (unknown fields will raise a ``BadRequest`` exception, too).
 
     :param model: class of a SQLAlchemy model
     :param local: contextual local data
     :param headers: additional headers for the response
+    :param pagination: optional pagination parameters of the request
+    :param filtering: optional filter criteria and sort order of the request
+    :param fields: optional sparse fieldset of the request
+    :param criteria: optional list of additional SQL expressions to filter the objects
+        (they are not part of the ETag, so describe them in the ``variant`` or ``versions``)
+    :param versions: optional list of version counters determining the ETag instead of
+        the collection's version counters (e.g. when a subset can be tracked more precisely)
+    :param variant: optional string distinguishing different representations
     :param kwargs: additional filter arguments for the database query
-    :return: resulting list of entities
+    :return: resulting list of entities or a finished response
     """
 
-    all_schemas = [obj.schema for obj in local.session.query(model).filter_by(**kwargs).all()]
-    local.entity.model_name = model.__name__
-    local.entity.compare(all_schemas)
-    if headers and isinstance(headers, dict):
-        return local.attach_headers(all_schemas, **headers)
-    return local.attach_headers(all_schemas)
+    names = _get_field_names(model, fields)
+    variant = _get_variant(kwargs, pagination, filtering, fields, variant)
+    tag = local.check_version(model, variant=variant, versions=versions)
+    result = _query_all(local.session, model, pagination, filtering, names, criteria, **kwargs)
+    return _respond_all(result, model, local, headers, pagination, tag, names is not None)
+
+
+async def get_all_of_model_async(
+        model: Type[models.Base],
+        local: AsyncLocalRequestData,
+        **kwargs
+) -> Union[List[pydantic.BaseModel], Response]:
+    """
+    Get a list of all known objects of a given model in an asynchronous path operation
+
+    This function works exactly like ``get_all_of_model`` (which accepts the same
+    keyword arguments), but uses the asyncio session if it has been enabled.
+
+    :param model: class of a SQLAlchemy model
+    :param local: contextual local data of the asynchronous path operation
+    :param kwargs: keyword arguments passed to ``get_all_of_model``
+    :return: resulting list of entities or a finished response
+    """
+
+    return await local.run(get_all_of_model, model, local, **kwargs)
 
 
 def create_new_of_model(
@@ -214,7 +411,187 @@ def create_new_of_model(
         headers["Location"] = location_format.format(model.id)
         if content_location:
             headers["Content-Location"] = headers["Location"]
-    return local.attach_headers(model.schema, **headers)
+    tag = local.entity.make_version_tag(local.session, type(model), model.id)
+    return local.attach_headers(model.schema, tag, **headers)
+
+
+def create_new_of_models(
+        instances: List[models.Base],
+        local: LocalRequestData,
+        logger: Optional[logging.Logger] = None,
+        more_models: Optional[List[models.Base]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Create the entries of many new instances of one model in the database at once
+
+    All instances (and the additional models) are committed in one database
+    transaction, so either all or none of them are stored. The created objects
+    are loaded with one query by the raw serializer of the model afterwards,
+    instead of refreshing every single instance after the commit.
+
+    :param instances: list of new instances of one SQLAlchemy model without any session
+    :param local: contextual local data
+    :param logger: optional logger that should be used for INFO and ERROR messages
+    :param more_models: list of additional models to be committed in the same transaction
+    :return: list of the created objects as rows of the raw serializer (in the same order)
+    :raises APIException: when the database operation went wrong (to report the problem)
+    """
+
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    if not instances:
+        return []
+
+    model = type(instances[0])
+    local.entity.model_name = model.__name__
+    local.entity.compare(None)
+
+    logger.info(f"Adding {len(instances)} new models of {model.__name__}...")
+    try:
+        local.session.add_all(instances)
+        if more_models is not None:
+            local.session.add_all(more_models)
+        local.session.flush()
+        ids = [instance.id for instance in instances]
+        local.session.commit()
+
+    except sqlalchemy.exc.DBAPIError as exc:
+        raise _handle_db_exception(local.session, exc, logger) from exc
+
+    rows = {
+        row["id"]: row
+        for row in serializers.SERIALIZERS[model].load(local.session, model.id.in_(ids))
+    }
+    return [rows[instance_id] for instance_id in ids]
+
+
+def add_to_column(
+        session: sqlalchemy.orm.Session,
+        column: sqlalchemy.orm.attributes.InstrumentedAttribute,
+        values: Dict[int, int]
+):
+    """
+    Atomically add values to a numeric column of rows of a model identified by their IDs
+
+    Every row is changed by an ``UPDATE`` computing the new value from the current value
+    in the database (e.g. ``SET balance = balance + :value``), instead of writing a value
+    computed from an earlier read, which would lose the changes of concurrent requests.
+    The rows are updated in the order of their IDs, so that concurrent transactions
+    acquire their row locks in the same order. The changes are tracked, but the
+    attributes of loaded instances are not refreshed before the end of the transaction.
+
+    :param session: database session which will be used to perform the changes
+    :param column: column of a SQLAlchemy model, e.g. ``models.User.balance``
+    :param values: mapping of the rows' IDs to the values added to their column
+    """
+
+    model = column.class_
+    changed = [object_id for object_id, value in sorted(values.items()) if value != 0]
+    for object_id in changed:
+        session.execute(
+            sqlalchemy.update(model)
+            .where(model.id == object_id)
+            .values({column.key: column + values[object_id]})
+            .execution_options(synchronize_session=False)
+        )
+    if changed:
+        tracking.touch(session, model, *changed)
+
+
+def take_from_column(
+        session: sqlalchemy.orm.Session,
+        column: sqlalchemy.orm.attributes.InstrumentedAttribute,
+        object_id: int,
+        value: int
+) -> bool:
+    """
+    Atomically subtract a value from a numeric column of a row, unless it's not sufficient
+
+    The check and the change are done by one conditional ``UPDATE`` statement (e.g.
+    ``SET stock = stock - :value WHERE stock >= :value``), so that concurrent requests
+    can't take more than available without waiting for each other's checks.
+    The change is tracked, like with ``add_to_column``.
+
+    :param session: database session which will be used to perform the change
+    :param column: column of a SQLAlchemy model, e.g. ``models.Consumable.stock``
+    :param object_id: ID of the row whose column should be changed
+    :param value: positive value subtracted from the column
+    :return: whether the row has been changed (i.e. the value of the column was sufficient)
+    """
+
+    model = column.class_
+    result = session.execute(
+        sqlalchemy.update(model)
+        .where(model.id == object_id, column >= value)
+        .values({column.key: column - value})
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        return False
+    tracking.touch(session, model, object_id)
+    return True
+
+
+def get_shard_id(session: sqlalchemy.orm.Session, user_id: int, shard: int) -> int:
+    """
+    Return the ID of a shard of a user's balance, which will be created if it doesn't exist
+
+    Missing shards are created by a separate database transaction, which is committed
+    immediately (it's fine when another request created the shard concurrently).
+    Call this function before changing anything using the given session, because
+    sqlite3 would otherwise block the creation until the session's transaction ends.
+    The shards are enabled in the total balances of users (see ``models``), too.
+
+    :param session: database session which should be used to perform the query
+    :param user_id: ID of the user owning the shard (usually the community user)
+    :param shard: number of the shard (starting at zero)
+    :return: ID of the ``CommunityShard`` row
+    """
+
+    table = models.CommunityShard.__table__
+    statement = sqlalchemy.select(table.c.id).where(
+        table.c.user_id == user_id,
+        table.c.shard == shard
+    )
+    shard_id = session.execute(statement).scalar()
+    models.set_community_shards(True)
+    if shard_id is not None:
+        return shard_id
+
+    creation = database.get_new_session()
+    try:
+        creation.execute(
+            sqlalchemy.insert(table).values(user_id=user_id, shard=shard, balance=0, version=0)
+        )
+        creation.commit()
+    except sqlalchemy.exc.IntegrityError:
+        creation.rollback()
+    finally:
+        creation.close()
+    return session.execute(statement).scalar()
+
+
+def add_to_shard(session: sqlalchemy.orm.Session, user_id: int, shard_id: int, value: int):
+    """
+    Atomically add a value to a shard of a user's balance (see ``get_shard_id``)
+
+    The shards of a user are part of its balance, so the change of the user is
+    logged. Neither the row of the user nor any shared version counter is locked
+    by the update, since it increments the shard's own version counter instead.
+
+    :param session: database session which will be used to perform the changes
+    :param user_id: ID of the user owning the shard
+    :param shard_id: ID of the ``CommunityShard`` row
+    :param value: value added to the balance of the shard
+    """
+
+    table = models.CommunityShard.__table__
+    session.execute(
+        sqlalchemy.update(table)
+        .where(table.c.id == shard_id)
+        .values(balance=table.c.balance + value, version=table.c.version + 1)
+    )
+    tracking.touch(session, models.User, user_id, increment=False)
 
 
 def delete_one_of_model(
@@ -255,8 +632,7 @@ def delete_one_of_model(
     obj = return_one(instance_id, model, local.session)
 
     if require_conditional_header:
-        local.entity.model_name = models.User.__name__
-        local.entity.compare(obj.schema)
+        local.check_version(model, instance_id)
 
     if schema is not None and obj.schema != schema:
         raise Conflict(
@@ -273,3 +649,4 @@ def delete_one_of_model(
 
     except sqlalchemy.exc.DBAPIError as exc:
         raise _handle_db_exception(local.session, exc, logger) from exc
+
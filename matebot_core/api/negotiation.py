@@ -0,0 +1,258 @@
+"""
+Content negotiation of binary formats for the core REST API
+
+Besides JSON, responses can be encoded as MessagePack or CBOR, which are
+much faster to decode for user agents parsing large collections frequently.
+The format is chosen by the ``Accept`` header of the request, where JSON is
+used unless a binary format is preferred explicitly (i.e. with a higher
+quality than JSON). The binary formats are only available if the optional
+``msgpack`` or ``cbor2`` packages are installed. Request bodies may be
+encoded in the same formats, as declared by their ``Content-Type`` header.
+
+The middleware stores the negotiated media type of the request, which is
+then used by every ``NegotiatedResponse`` to encode its content. Since
+different representations of a resource must not share the same entity
+tag, the media type's suffix is appended to the ``ETag`` of binary responses
+(like ``"<tag>-msgpack"``). The suffix is stripped from the conditional
+headers of incoming requests again. Suffixes of other formats are kept in
+the ``If-None-Match`` header, so that a cached representation in another
+format never results in a 304 response, but are stripped from ``If-Match``,
+because the preconditions of modifying requests are about the resource itself.
+"""
+
+import contextvars
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .. import schemas
+
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+CBOR = "application/cbor"
+
+# Encoders and decoders of the available binary media types with their ETag suffixes
+ENCODERS: Dict[str, Callable[[Any], bytes]] = {}
+DECODERS: Dict[str, Callable[[bytes], Any]] = {}
+SUFFIXES: Dict[str, str] = {}
+if msgpack is not None:
+    ENCODERS[MSGPACK] = lambda content: msgpack.packb(content, use_bin_type=True)
+    DECODERS[MSGPACK] = lambda body: msgpack.unpackb(body, raw=False)
+    SUFFIXES[MSGPACK] = "-msgpack"
+if cbor2 is not None:
+    ENCODERS[CBOR] = cbor2.dumps
+    DECODERS[CBOR] = cbor2.loads
+    SUFFIXES[CBOR] = "-cbor"
+
+# Alternative names of the media types, which are used by some clients
+_ALIASES = {"application/x-msgpack": MSGPACK, "application/vnd.msgpack": MSGPACK}
+
+_media_type: contextvars.ContextVar[str] = contextvars.ContextVar("media_type", default=JSON)
+
+
+def _parse_media_type(value: str) -> str:
+    name = value.split(";", 1)[0].strip().lower()
+    return _ALIASES.get(name, name)
+
+
+def choose_media_type(accept: str, available: Iterable[str]) -> str:
+    """
+    Choose the media type of the response out of JSON and the available binary types
+
+    JSON is the default, so that a binary type is only chosen if it's accepted with a
+    higher quality than JSON (e.g. with ``Accept: application/msgpack`` or
+    ``Accept: application/msgpack, application/json;q=0.5``).
+
+    :param accept: value of the ``Accept`` header of the request
+    :param available: names of the available binary media types in the order of preference
+    :return: name of the chosen media type
+    """
+
+    weights: List[Tuple[str, float]] = []
+    for item in accept.split(","):
+        name = _parse_media_type(item)
+        weight = 1.0
+        for param in item.split(";")[1:]:
+            param = param.strip()
+            if param.startswith("q="):
+                try:
+                    weight = float(param[2:])
+                except ValueError:
+                    weight = 0.0
+        if name:
+            weights.append((name, weight))
+
+    def get_weight(media_type: str) -> float:
+        exact = [w for n, w in weights if n == media_type]
+        if exact:
+            return max(exact)
+        ranges = [w for n, w in weights if n == media_type.split("/")[0] + "/*"]
+        if ranges:
+            return max(ranges)
+        return max([w for n, w in weights if n == "*/*"] or [0.0])
+
+    best, best_weight = JSON, get_weight(JSON)
+    for media_type in available:
+        if not [n for n, _ in weights if n == media_type]:
+            continue
+        weight = get_weight(media_type)
+        if weight > best_weight:
+            best, best_weight = media_type, weight
+    return best
+
+
+def get_media_type() -> str:
+    """
+    Return the negotiated media type of the currently handled request
+    """
+
+    return _media_type.get()
+
+
+class NegotiatedResponse(JSONResponse):
+    """
+    Response encoding its content in the negotiated media type of the current request
+
+    The content must already be JSON compatible (e.g. using ``jsonable_encoder``).
+    """
+
+    def __init__(self, content: Any, status_code: int = 200, **kwargs):
+        self.media_type = get_media_type()
+        super().__init__(content, status_code, **kwargs)
+
+    def render(self, content: Any) -> bytes:
+        if self.media_type in ENCODERS:
+            return ENCODERS[self.media_type](content)
+        return super().render(content)
+
+
+def strip_etag_suffixes(value: str, suffixes: Iterable[str]) -> str:
+    """
+    Strip the given suffixes from the entity tags in the value of a conditional header
+    """
+
+    tags = []
+    for tag in value.split(","):
+        tag = tag.strip()
+        for suffix in suffixes:
+            if tag.endswith(suffix + '"'):
+                tag = tag[:-len(suffix) - 1] + '"'
+        tags.append(tag)
+    return ", ".join(tags)
+
+
+class NegotiationMiddleware:
+    """
+    ASGI middleware negotiating the media type of responses and decoding binary request bodies
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not ENCODERS:
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        media_type = choose_media_type(headers.get("Accept", ""), ENCODERS)
+        token = _media_type.set(media_type)
+        try:
+            request_headers = MutableHeaders(scope={"headers": list(scope["headers"])})
+            suffix = SUFFIXES.get(media_type)
+            if "If-None-Match" in request_headers and suffix is not None:
+                request_headers["If-None-Match"] = strip_etag_suffixes(
+                    request_headers["If-None-Match"], [suffix]
+                )
+            if "If-Match" in request_headers:
+                request_headers["If-Match"] = strip_etag_suffixes(
+                    request_headers["If-Match"], SUFFIXES.values()
+                )
+
+            content_type = _parse_media_type(headers.get("Content-Type", ""))
+            if content_type in DECODERS:
+                body = await _read_body(receive)
+                if body:
+                    try:
+                        body = json.dumps(DECODERS[content_type](body)).encode("UTF-8")
+                    except Exception as exc:
+                        response = NegotiatedResponse(jsonable_encoder(schemas.APIError(
+                            status=400,
+                            method=scope["method"],
+                            request=scope["path"],
+                            repeat=False,
+                            message="Invalid request body.",
+                            details=f"Decoding the {content_type} body failed: {exc}"
+                        )), status_code=400)
+                        await response(scope, receive, send)
+                        return
+                    request_headers["Content-Type"] = JSON
+                    request_headers["Content-Length"] = str(len(body))
+                receive = _replay_body(body, receive)
+
+            scope = dict(scope, headers=request_headers.raw)
+            await self.app(scope, receive, _Responder(media_type, send).send)
+        finally:
+            _media_type.reset(token)
+
+
+async def _read_body(receive: Receive) -> bytes:
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        more_body = message.get("more_body", False)
+    return b"".join(chunks)
+
+
+def _replay_body(body: bytes, receive: Receive) -> Receive:
+    sent = False
+
+    async def replay() -> Message:
+        nonlocal sent
+        if sent:
+            return await receive()
+        sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return replay
+
+
+class _Responder:
+    def __init__(self, media_type: str, send: Send):
+        self.media_type = media_type
+        self.suffix = SUFFIXES.get(media_type)
+        self.next_send = send
+
+    async def send(self, message: Message):
+        if message["type"] == "http.response.start":
+            headers = MutableHeaders(raw=message["headers"])
+            content_type = _parse_media_type(headers.get("Content-Type", ""))
+            negotiated = content_type in (JSON, *ENCODERS)
+            if negotiated:
+                headers.add_vary_header("Accept")
+            tag: Optional[str] = headers.get("ETag")
+            if self.suffix is not None and tag is not None and tag.endswith('"'):
+                if content_type == self.media_type or message["status"] == 304:
+                    headers["ETag"] = tag[:-1] + self.suffix + '"'
+        await self.next_send(message)
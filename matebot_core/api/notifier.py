@@ -0,0 +1,192 @@
+"""
+Notification library of committed database changes for the core REST API
+"""
+
+import asyncio
+import logging
+from typing import Callable, List, Optional, Set
+
+from starlette.concurrency import run_in_threadpool
+
+from ..persistence import tracking
+
+
+logger = logging.getLogger(__name__)
+
+
+class Notifier:
+    """
+    Broadcast of committed database changes to asyncio tasks waiting for them
+
+    The notifier registers itself as commit listener of the version tracking,
+    so that every commit of changes wakes up all waiting tasks. Commits may
+    happen in any thread, the waiters are always woken up in the event loop
+    which they are running in. Changes committed by other processes using the
+    same database are not noticed, therefore waiters should recheck the database
+    at least every ``recheck_interval`` seconds. The ``max_timeout`` limits the
+    time a single request may wait for changes (see ``GET /updates``). Call
+    ``close`` when the notifier isn't used anymore to remove the commit listener.
+    """
+
+    def __init__(self, max_timeout: float = 60.0, recheck_interval: float = 5.0):
+        self.max_timeout = max_timeout
+        self.recheck_interval = recheck_interval
+        self._generation = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._condition: Optional[asyncio.Condition] = None
+        tracking.add_commit_listener(self.notify)
+
+    def _get_condition(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._loop is not loop:
+            self._loop = loop
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    @property
+    def generation(self) -> int:
+        """
+        Return the number of notifications so far (read it before checking for changes)
+        """
+
+        return self._generation
+
+    async def wait(self, generation: int, timeout: float) -> bool:
+        """
+        Wait until a notification after the given generation happened or the timeout elapsed
+
+        :param generation: value of the ``generation`` read before the last check for changes
+        :param timeout: maximum number of seconds to wait for a notification
+        :return: whether a notification happened
+        """
+
+        condition = self._get_condition()
+        async with condition:
+            try:
+                await asyncio.wait_for(
+                    condition.wait_for(lambda: self._generation != generation),
+                    timeout
+                )
+            except asyncio.TimeoutError:
+                return False
+            return True
+
+    async def _notify_all(self):
+        self._generation += 1
+        condition = self._get_condition()
+        async with condition:
+            condition.notify_all()
+
+    def close(self):
+        """
+        Stop listening for commits, so that the notifier can be garbage collected
+        """
+
+        tracking.remove_commit_listener(self.notify)
+
+    def notify(self):
+        """
+        Wake up all waiting tasks (this method is thread-safe)
+        """
+
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            self._generation += 1
+            return
+        try:
+            loop.call_soon_threadsafe(lambda: loop.create_task(self._notify_all()))
+        except RuntimeError as exc:
+            logger.debug(f"Could not notify waiting tasks: {exc}")
+
+
+class Subscription:
+    """
+    Bounded buffer of the pages of events broadcast to one client by an ``EventFeed``
+
+    The buffer receives all events after the ``position`` of the feed at the time
+    of subscribing. It's marked as ``overflowed`` when the client didn't keep up.
+    """
+
+    def __init__(self, position: int, size: int):
+        self.position = position
+        self.queue: asyncio.Queue = asyncio.Queue(size)
+        self.overflowed = False
+
+
+class EventFeed:
+    """
+    Broadcast of events read from the database once to all subscribed clients
+
+    A single task reads the pages of events after its position using the blocking
+    ``read`` function (which gets the ID of the last known event and returns a list
+    of up to ``page_size`` events, each a dictionary with an ``id``). It's woken up
+    by the notifier and puts every page into the buffers of all subscriptions.
+    A subscription whose buffer of ``buffer_size`` pages is full is removed and
+    marked as overflowed, so that the memory used per client is bounded. Such a
+    client needs to read the missed events on its own and subscribe again.
+    The task is started by the first subscription and stops after the last one.
+    """
+
+    def __init__(
+            self,
+            notifier: Notifier,
+            read: Callable[[int], List[dict]],
+            read_cursor: Callable[[], int],
+            page_size: int,
+            buffer_size: int = 10
+    ):
+        self.notifier = notifier
+        self.read = read
+        self.read_cursor = read_cursor
+        self.page_size = page_size
+        self.buffer_size = buffer_size
+        self.position = 0
+        self._subscriptions: Set[Subscription] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def subscribe(self) -> Subscription:
+        """
+        Subscribe to the events after the current position of the feed
+        """
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._task is None or self._task.done():
+                self.position = await run_in_threadpool(self.read_cursor)
+                self._task = asyncio.get_running_loop().create_task(self._run())
+            subscription = Subscription(self.position, self.buffer_size)
+            self._subscriptions.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """
+        Remove the subscription, so that no further events will be put into its buffer
+        """
+
+        self._subscriptions.discard(subscription)
+
+    def _publish(self, events: List[dict]):
+        for subscription in list(self._subscriptions):
+            try:
+                subscription.queue.put_nowait(events)
+            except asyncio.QueueFull:
+                subscription.overflowed = True
+                self._subscriptions.discard(subscription)
+
+    async def _run(self):
+        try:
+            while self._subscriptions:
+                generation = self.notifier.generation
+                events = await run_in_threadpool(self.read, self.position)
+                if events:
+                    self.position = events[-1]["id"]
+                    self._publish(events)
+                if len(events) < self.page_size:
+                    await self.notifier.wait(generation, self.notifier.recheck_interval)
+        except Exception:
+            logger.exception("Reading the events failed")
+            for subscription in self._subscriptions:
+                subscription.overflowed = True
+            self._subscriptions.clear()
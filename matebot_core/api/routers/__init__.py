@@ -10,6 +10,7 @@ from .aliases import router as aliases_router
 from .applications import router as applications_router
 from .ballots import router as ballots_router
 from .callbacks import router as callbacks_router
+from .changes import router as changes_router
 from .communisms import router as communisms_router
 from .consumables import router as consumables_router
 from .generic import router as generic_router
@@ -25,6 +26,7 @@ all_routers = [
     applications_router,
     ballots_router,
     callbacks_router,
+    changes_router,
     communisms_router,
     consumables_router,
     refunds_router,
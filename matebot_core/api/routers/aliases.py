@@ -9,7 +9,7 @@ import pydantic
 from fastapi import APIRouter, Depends
 
 from ..base import Conflict, NotFound
-from ..dependency import LocalRequestData
+from ..dependency import AsyncLocalRequestData, LocalRequestData, SparseFields
 from .. import helpers
 from ...persistence import models
 from ... import schemas
@@ -27,12 +27,19 @@ router = APIRouter(
     "",
     response_model=List[schemas.Alias]
 )
-def get_all_known_aliases(local: LocalRequestData = Depends(LocalRequestData)):
+async def get_all_known_aliases(
+        fields: SparseFields = Depends(SparseFields),
+        local: AsyncLocalRequestData = Depends(AsyncLocalRequestData)
+):
     """
     Return a list of all known user aliases of all applications.
+
+    Use the `fields` query parameter (a comma-separated list of field names)
+    to return only those fields of the objects (the `id` is always included).
+    Unknown field names result in a 400 error.
     """
 
-    return helpers.get_all_of_model(models.UserAlias, local)
+    return await helpers.get_all_of_model_async(models.UserAlias, local, fields=fields)
 
 
 @router.post(
@@ -149,15 +156,20 @@ def delete_existing_alias(
 )
 def get_alias_by_id(
         alias_id: pydantic.NonNegativeInt,
+        fields: SparseFields = Depends(SparseFields),
         local: LocalRequestData = Depends(LocalRequestData)
 ):
     """
     Return the alias model of a specific alias ID.
 
+    Use the `fields` query parameter (a comma-separated list of field names)
+    to return only those fields of the object (the `id` is always included).
+    Unknown field names result in a 400 error.
+
     A 404 error will be returned in case the alias ID is unknown.
     """
 
-    return helpers.get_one_of_model(alias_id, models.UserAlias, local)
+    return helpers.get_one_of_model(alias_id, models.UserAlias, local, fields=fields)
 
 
 @router.get(
@@ -167,15 +179,20 @@ def get_alias_by_id(
 )
 def get_aliases_by_application_name(
         application: pydantic.constr(max_length=255),
+        fields: SparseFields = Depends(SparseFields),
         local: LocalRequestData = Depends(LocalRequestData)
 ):
     """
     Return a list of all users aliases for a given application name.
 
+    Use the `fields` query parameter (a comma-separated list of field names)
+    to return only those fields of the objects (the `id` is always included).
+    Unknown field names result in a 400 error.
+
     A 404 error will be returned for unknown `application` arguments.
     """
 
     app = local.session.query(models.Application).filter_by(name=application).first()
     if app is None:
         raise NotFound(f"Application name {application!r}")
-    return helpers.get_all_of_model(models.UserAlias, local, app_id=app.id)
+    return helpers.get_all_of_model(models.UserAlias, local, app_id=app.id, fields=fields)
@@ -8,7 +8,7 @@ from typing import List
 from fastapi import APIRouter, Depends
 
 from ..base import MissingImplementation
-from ..dependency import LocalRequestData
+from ..dependency import AsyncLocalRequestData, LocalRequestData, SparseFields
 from .. import helpers
 from ...persistence import models
 from ... import schemas
@@ -26,12 +26,19 @@ router = APIRouter(
     "",
     response_model=List[schemas.Application]
 )
-def get_all_applications(local: LocalRequestData = Depends(LocalRequestData)):
+async def get_all_applications(
+        fields: SparseFields = Depends(SparseFields),
+        local: AsyncLocalRequestData = Depends(AsyncLocalRequestData)
+):
     """
     Return a list of all known applications.
+
+    Use the `fields` query parameter (a comma-separated list of field names)
+    to return only those fields of the objects (the `id` is always included).
+    Unknown field names result in a 400 error.
     """
 
-    return helpers.get_all_of_model(models.Application, local)
+    return await helpers.get_all_of_model_async(models.Application, local, fields=fields)
 
 
 @router.post(
@@ -63,12 +70,17 @@ def add_new_application(
 )
 def get_application_by_id(
         application_id: int,
+        fields: SparseFields = Depends(SparseFields),
         local: LocalRequestData = Depends(LocalRequestData)
 ):
     """
     Return the application model specified by its application ID.
 
+    Use the `fields` query parameter (a comma-separated list of field names)
+    to return only those fields of the object (the `id` is always included).
+    Unknown field names result in a 400 error.
+
     A 404 error will be returned in case the ID is not found.
     """
 
-    return helpers.get_one_of_model(application_id, models.Application, local)
+    return helpers.get_one_of_model(application_id, models.Application, local, fields=fields)
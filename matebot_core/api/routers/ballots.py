@@ -9,7 +9,7 @@ import pydantic
 from fastapi import APIRouter, Depends
 
 from ..base import MissingImplementation
-from ..dependency import LocalRequestData
+from ..dependency import AsyncLocalRequestData, LocalRequestData, SparseFields
 from .. import helpers
 from ...persistence import models
 from ... import schemas
@@ -27,12 +27,19 @@ router = APIRouter(
     "",
     response_model=List[schemas.Ballot]
 )
-def get_all_ballots(local: LocalRequestData = Depends(LocalRequestData)):
+async def get_all_ballots(
+        fields: SparseFields = Depends(SparseFields),
+        local: AsyncLocalRequestData = Depends(AsyncLocalRequestData)
+):
     """
     Return a list of all ballots with all associated data, including the votes.
+
+    Use the `fields` query parameter (a comma-separated list of field names)
+    to return only those fields of the objects (the `id` is always included).
+    Unknown field names result in a 400 error.
     """
 
-    return helpers.get_all_of_model(models.Ballot, local)
+    return await helpers.get_all_of_model_async(models.Ballot, local, fields=fields)
 
 
 @router.post(
@@ -57,15 +64,20 @@ def add_new_ballot(
 )
 def get_ballot_by_id(
         ballot_id: pydantic.NonNegativeInt,
+        fields: SparseFields = Depends(SparseFields),
         local: LocalRequestData = Depends(LocalRequestData)
 ):
     """
     Return the ballot identified by a specific ballot ID.
 
+    Use the `fields` query parameter (a comma-separated list of field names)
+    to return only those fields of the object (the `id` is always included).
+    Unknown field names result in a 400 error.
+
     A 404 error will be returned in case the ballot ID is unknown.
     """
 
-    return helpers.get_one_of_model(ballot_id, models.Ballot, local)
+    return helpers.get_one_of_model(ballot_id, models.Ballot, local, fields=fields)
 
 
 @router.patch(
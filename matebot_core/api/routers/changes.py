@@ -0,0 +1,251 @@
+"""
+MateBot router module for following the changes of the database
+"""
+
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+import pydantic
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from .. import serializers
+from ..base import BadRequest
+from ..dependency import LocalRequestData
+from ..etag import ETag
+from ..notifier import EventFeed, Notifier
+from ... import schemas
+from ...persistence import database, models, tracking
+
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    tags=["Changes"]
+)
+
+# Maximum number of change log entries read from the database at once
+_PAGE_SIZE = 100
+
+# Maximum number of pages of events buffered per client of the event stream
+_BUFFER_SIZE = 10
+
+
+def _read_events(cursor: int) -> List[dict]:
+    session = database.get_new_session(read_only=True)
+    try:
+        return [
+            {
+                "id": change.id,
+                "model": change.model,
+                "object_id": change.object_id,
+                "action": change.action,
+                "etag": ETag.make_tag_from_versions(versions)
+            }
+            for change, versions in tracking.get_changes_with_versions(session, cursor, _PAGE_SIZE)
+        ]
+    finally:
+        session.close()
+
+
+def _read_cursor() -> int:
+    session = database.get_new_session(read_only=True)
+    try:
+        return tracking.get_cursor(session)
+    finally:
+        session.close()
+
+
+def _read_pruned() -> int:
+    session = database.get_new_session(read_only=True)
+    try:
+        return tracking.get_pruned(session)
+    finally:
+        session.close()
+
+
+def _get_feed(local: LocalRequestData) -> EventFeed:
+    state = local.request.app.state
+    if getattr(state, "event_feed", None) is None:
+        state.event_feed = EventFeed(
+            state.notifier, _read_events, _read_cursor, _PAGE_SIZE, _BUFFER_SIZE
+        )
+    return state.event_feed
+
+
+def _format_event(event: dict) -> str:
+    data = json.dumps({k: v for k, v in event.items() if k != "id"})
+    return f"id: {event['id']}\nevent: {event['action']}\ndata: {data}\n\n"
+
+
+@router.get(
+    "/events",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"text/event-stream": {}}}}
+)
+async def get_events(local: LocalRequestData = Depends(LocalRequestData)):
+    """
+    Stream the changes of the database as Server-Sent Events (SSE).
+
+    Every event has the ID of its entry in the change log, the action (`create`,
+    `update` or `delete`) as event type and a JSON object with the `model` name,
+    the `object_id`, the `action` and the current `etag` of the row as data.
+    The stream starts with the changes after the latest change, unless the
+    `Last-Event-ID` header is set, which replays the changes after that
+    event. If that event is unknown or too far behind (the number of replayed
+    events is limited by the `event_replay_limit` setting, while the change
+    log keeps the number of entries given by the `change_log_size` setting),
+    a `reset` event with the current `cursor` is sent instead, so that the
+    client should reload all its data.
+    A comment is sent as keep-alive message when there were no changes.
+
+    The events are read from the change log once and broadcast to all clients.
+    Every client buffers a limited number of pages of events, so the memory
+    used per client is bounded. Clients which are behind (e.g. when replaying
+    events or when they didn't keep up) read the missed pages on their own.
+    """
+
+    notifier: Notifier = local.request.app.state.notifier
+    feed = _get_feed(local)
+    replay_limit = local.config.server.event_replay_limit
+    request = local.request
+    last_event_id = local.headers.get("Last-Event-ID")
+
+    current = await run_in_threadpool(_read_cursor)
+    reset = False
+    cursor = current
+    if last_event_id is not None:
+        try:
+            cursor = int(last_event_id)
+        except ValueError:
+            cursor = -1
+        if (
+                not 0 <= cursor <= current
+                or current - cursor > replay_limit
+                or cursor < await run_in_threadpool(_read_pruned)
+        ):
+            logger.debug(f"Resetting event stream from {last_event_id!r} to {current}")
+            reset = True
+            cursor = current
+
+    async def stream(position: int) -> AsyncIterator[str]:
+        yield f"retry: {int(notifier.recheck_interval * 1000)}\n\n"
+        if reset:
+            yield f"id: {position}\nevent: reset\ndata: {json.dumps({'cursor': position})}\n\n"
+
+        while not await request.is_disconnected():
+            subscription = await feed.subscribe()
+            try:
+                while position < subscription.position:
+                    events = await run_in_threadpool(_read_events, position)
+                    if not events:
+                        break
+                    for event in events:
+                        yield _format_event(event)
+                        position = event["id"]
+
+                while not await request.is_disconnected():
+                    if subscription.overflowed and subscription.queue.empty():
+                        break
+                    try:
+                        events = await asyncio.wait_for(
+                            subscription.queue.get(),
+                            notifier.recheck_interval
+                        )
+                    except asyncio.TimeoutError:
+                        yield ": keep-alive\n\n"
+                        continue
+                    for event in events:
+                        if event["id"] > position:
+                            yield _format_event(event)
+                            position = event["id"]
+            finally:
+                feed.unsubscribe(subscription)
+
+    return StreamingResponse(
+        stream(cursor),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.get(
+    "/changes",
+    response_model=schemas.Changes
+)
+def get_changes(
+        cursor: pydantic.NonNegativeInt = 0,
+        limit: pydantic.conint(ge=1, le=500) = 100,
+        model: Optional[List[str]] = Query(None),
+        local: LocalRequestData = Depends(LocalRequestData)
+):
+    """
+    Return the rows which have been created, updated or deleted after the cursor.
+
+    This operation allows user agents to keep a local mirror of some collections
+    in sync by only transferring the changed rows. The changes are ordered by
+    their appearance in the change log (which is the order of the commits) and
+    contain the current data of the row (or `null` for deleted rows). A row
+    changed multiple times within one page is only returned once, at the
+    position of its latest change. Pass the `cursor` of the response to get
+    the next page, as long as `more` is set. The optional `model` query
+    parameter (which can be repeated) restricts the changes to those models.
+    The change log only keeps its newest entries (see `change_log_size` in
+    the server config), so a client whose cursor is too old must reload all
+    its data and continue with the `cursor` of the `/updates` endpoint.
+
+    A `400` error will be returned for unknown model names or when
+    the entries after the cursor have already been removed.
+    """
+
+    names = [m.__name__ for m in serializers.SERIALIZERS]
+    if model:
+        unknown = set(model) - set(names)
+        if unknown:
+            raise BadRequest("Unknown model name.", f"unknown={sorted(unknown)}, known={names}")
+        names = model
+
+    pruned = tracking.get_pruned(local.session)
+    if cursor < pruned:
+        raise BadRequest(
+            "The cursor is too old, since the change log has been pruned in the meantime.",
+            f"cursor={cursor}, pruned={pruned}"
+        )
+
+    entries = tracking.get_changes(local.session, cursor, limit + 1, names)
+    more = len(entries) > limit
+    entries = entries[:limit]
+
+    latest: Dict[Tuple[str, int], models.Change] = {}
+    for entry in entries:
+        latest.pop((entry.model, entry.object_id), None)
+        latest[(entry.model, entry.object_id)] = entry
+
+    data = {}
+    for name in {name for name, _ in latest}:
+        cls = tracking.get_model(name)
+        ids = [object_id for n, object_id in latest if n == name]
+        for row in serializers.SERIALIZERS[cls].load(local.session, cls.id.in_(ids)):
+            data[(name, row["id"])] = row
+
+    return schemas.Changes(
+        changes=[
+            schemas.Change(
+                id=entry.id,
+                model=entry.model,
+                object_id=entry.object_id,
+                action=entry.action,
+                data=data.get(key)
+            )
+            for key, entry in latest.items()
+        ],
+        cursor=entries[-1].id if entries else cursor,
+        more=more
+    )
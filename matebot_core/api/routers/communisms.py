@@ -10,7 +10,8 @@ from fastapi import APIRouter, Depends
 
 from .. import helpers
 from ..base import MissingImplementation
-from ..dependency import LocalRequestData
+from ..dependency import AsyncLocalRequestData, LocalRequestData, Pagination, SparseFields
+from ..filters import FILTERS, Filtering
 from ... import schemas
 from ...persistence import models
 
@@ -25,14 +26,35 @@ router = APIRouter(
 
 @router.get(
     "",
-    response_model=List[schemas.Communism]
+    response_model=List[schemas.Communism],
+    openapi_extra=FILTERS[models.Communism].openapi
 )
-def get_all_communisms(local: LocalRequestData = Depends(LocalRequestData)):
+async def get_all_communisms(
+        pagination: Pagination = Depends(Pagination),
+        filtering: Filtering = Depends(FILTERS[models.Communism]),
+        fields: SparseFields = Depends(SparseFields),
+        local: AsyncLocalRequestData = Depends(AsyncLocalRequestData)
+):
     """
     Return a list of all communisms in the system.
+
+    Use the `limit`, `after_id` and `before_id` query parameters to get only one
+    page of the list, ordered by ID. The `Link` header of the response points
+    to the next and previous pages (if there are any).
+
+    Filter the list by the fields `id`, `amount`, `creator` and `active` and
+    sort it using the `sort` query parameter (see the descriptions of the query
+    parameters). A 400 error will be returned for invalid filters or when a
+    custom sort order is combined with pagination.
+
+    Use the `fields` query parameter (a comma-separated list of field names)
+    to return only those fields of the objects (the `id` is always included).
+    Unknown field names result in a 400 error.
     """
 
-    return helpers.get_all_of_model(models.Communism, local)
+    return await helpers.get_all_of_model_async(
+        models.Communism, local, pagination=pagination, filtering=filtering, fields=fields
+    )
 
 
 @router.post(
@@ -86,15 +108,20 @@ def update_existing_communism(
 )
 def get_communism_by_id(
         communism_id: pydantic.NonNegativeInt,
+        fields: SparseFields = Depends(SparseFields),
         local: LocalRequestData = Depends(LocalRequestData)
 ):
     """
     Return an existing communism by its `communism_id`.
 
+    Use the `fields` query parameter (a comma-separated list of field names)
+    to return only those fields of the object (the `id` is always included).
+    Unknown field names result in a 400 error.
+
     A 404 error will be returned if the specified ID was not found.
     """
 
-    return helpers.get_one_of_model(communism_id, models.Communism, local)
+    return helpers.get_one_of_model(communism_id, models.Communism, local, fields=fields)
 
 
 @router.get(
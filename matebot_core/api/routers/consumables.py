@@ -9,7 +9,7 @@ import pydantic
 from fastapi import APIRouter, Depends
 
 from ..base import Conflict, MissingImplementation
-from ..dependency import LocalRequestData
+from ..dependency import AsyncLocalRequestData, LocalRequestData, SparseFields
 from .. import helpers
 from ...persistence import models
 from ... import schemas
@@ -27,12 +27,19 @@ router = APIRouter(
     "",
     response_model=List[schemas.Consumable]
 )
-def get_all_consumables(local: LocalRequestData = Depends(LocalRequestData)):
+async def get_all_consumables(
+        fields: SparseFields = Depends(SparseFields),
+        local: AsyncLocalRequestData = Depends(AsyncLocalRequestData)
+):
     """
     Return a list of all current consumables.
+
+    Use the `fields` query parameter (a comma-separated list of field names)
+    to return only those fields of the objects (the `id` is always included).
+    Unknown field names result in a 400 error.
     """
 
-    return helpers.get_all_of_model(models.Consumable, local)
+    return await helpers.get_all_of_model_async(models.Consumable, local, fields=fields)
 
 
 @router.post(
@@ -121,12 +128,17 @@ def delete_existing_consumable(
 )
 def get_consumable_by_id(
         consumable_id: pydantic.NonNegativeInt,
+        fields: SparseFields = Depends(SparseFields),
         local: LocalRequestData = Depends(LocalRequestData)
 ):
     """
     Return the consumable model of a specific consumable ID.
 
+    Use the `fields` query parameter (a comma-separated list of field names)
+    to return only those fields of the object (the `id` is always included).
+    Unknown field names result in a 400 error.
+
     A 404 error will be returned in case the consumable ID is unknown.
     """
 
-    return helpers.get_one_of_model(consumable_id, models.Consumable, local)
+    return helpers.get_one_of_model(consumable_id, models.Consumable, local, fields=fields)
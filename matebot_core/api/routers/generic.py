@@ -3,15 +3,18 @@ MateBot router module for various different requests without specialized purpose
 """
 
 import uuid
+import asyncio
 import logging
 import datetime
-from typing import Type
+from typing import List, Optional, Type
 
+import pydantic
 from fastapi import APIRouter, Depends
 
-from ..dependency import LocalRequestData
+from ..dependency import AsyncLocalRequestData, LocalRequestData
+from ..notifier import Notifier
 from ... import schemas, __version__, __api_version__
-from ...persistence import models
+from ...persistence import database, models, tracking
 from ...schemas import config
 
 
@@ -52,6 +55,35 @@ def get_status(local: LocalRequestData = Depends(LocalRequestData)):
         api_version=api_version,
         project_version=project_version,
         localtime=datetime.datetime.now(),
+        timestamp=datetime.datetime.now().timestamp(),
+        pools=_get_pool_status()
+    )
+
+
+def _get_pool_status() -> List[schemas.PoolStatus]:
+    return [
+        schemas.PoolStatus(**metrics.as_dict())
+        for metrics in database.get_pool_metrics().values()
+    ]
+
+
+@router.get(
+    "/metrics",
+    response_model=schemas.Metrics
+)
+def get_metrics():
+    """
+    Return runtime metrics of the server, e.g. the usage of the database connection pools.
+
+    For every connection pool, the number of currently checked out, idle and
+    overflow connections is reported as well as the total number of checkouts
+    and timeouts. The wait times (in seconds) describe how long the requests
+    had to wait for a connection of the pool. High wait times or any timeouts
+    indicate an exhausted pool, i.e. the pool size may need to be increased.
+    """
+
+    return schemas.Metrics(
+        pools=_get_pool_status(),
         timestamp=datetime.datetime.now().timestamp()
     )
 
@@ -60,7 +92,11 @@ def get_status(local: LocalRequestData = Depends(LocalRequestData)):
     "/updates",
     response_model=schemas.Updates
 )
-def get_updates(local: LocalRequestData = Depends(LocalRequestData)):
+async def get_updates(
+        cursor: Optional[pydantic.NonNegativeInt] = None,
+        timeout: pydantic.NonNegativeFloat = 0.0,
+        local: AsyncLocalRequestData = Depends(AsyncLocalRequestData)
+):
     """
     Return a collection of the current ETags of all important model collections.
 
@@ -68,24 +104,52 @@ def get_updates(local: LocalRequestData = Depends(LocalRequestData)):
     has changed in them meantime. This allows user agents to implement polling.
     Of course, user-agent caching is required for that. An alternative way to
     stay informed about updates are HTTP callbacks, which will be introduced later.
+
+    The `cursor` of the response identifies the latest change of the database.
+    Passing it as query parameter together with a `timeout` in seconds enables
+    long-polling: the request waits until any collection has changed after
+    that cursor or the timeout elapsed (which is limited by the server config).
     """
 
-    def _get(model: Type[models.Base]) -> uuid.UUID:
-        all_objects = [obj.schema for obj in local.session.query(model).all()]
-        return uuid.UUID(local.entity.make_etag(all_objects, model.__name__))
-
-    return schemas.Updates(
-        aliases=_get(models.UserAlias),
-        applications=_get(models.Application),
-        ballots=_get(models.Ballot),
-        communisms=_get(models.Communism),
-        consumables=_get(models.Consumable),
-        refunds=_get(models.Refund),
-        transactions=_get(models.Transaction),
-        users=_get(models.User),
-        votes=_get(models.Vote),
-        timestamp=datetime.datetime.now().timestamp()
-    )
+    notifier: Notifier = local.request.app.state.notifier
+
+    def _read() -> schemas.Updates:
+        try:
+            current_cursor = tracking.get_cursor(local.session)
+            versions = tracking.get_collection_versions(local.session, [
+                models.UserAlias, models.Application, models.Ballot, models.Communism,
+                models.Consumable, models.Refund, models.Transaction, models.User, models.Vote
+            ])
+        finally:
+            # Don't hold a connection of the pool while waiting for changes
+            local.session.close()
+
+        def _get(model: Type[models.Base]) -> uuid.UUID:
+            return uuid.UUID(local.entity.make_tag_from_versions(versions[model]))
+
+        return schemas.Updates(
+            aliases=_get(models.UserAlias),
+            applications=_get(models.Application),
+            ballots=_get(models.Ballot),
+            communisms=_get(models.Communism),
+            consumables=_get(models.Consumable),
+            refunds=_get(models.Refund),
+            transactions=_get(models.Transaction),
+            users=_get(models.User),
+            votes=_get(models.Vote),
+            cursor=current_cursor,
+            timestamp=datetime.datetime.now().timestamp()
+        )
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + min(timeout, notifier.max_timeout)
+    generation = notifier.generation
+    updates = await local.run(_read)
+    while cursor is not None and updates.cursor == cursor and loop.time() < deadline:
+        await notifier.wait(generation, min(deadline - loop.time(), notifier.recheck_interval))
+        generation = notifier.generation
+        updates = await local.run(_read)
+    return updates
 
 
 @router.get(
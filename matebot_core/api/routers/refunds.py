@@ -9,7 +9,8 @@ import pydantic
 from fastapi import APIRouter, Depends
 
 from ..base import MissingImplementation
-from ..dependency import LocalRequestData
+from ..dependency import AsyncLocalRequestData, LocalRequestData, Pagination, SparseFields
+from ..filters import FILTERS, Filtering
 from .. import helpers
 from ...persistence import models
 from ... import schemas
@@ -25,14 +26,35 @@ router = APIRouter(
 
 @router.get(
     "",
-    response_model=List[schemas.Refund]
+    response_model=List[schemas.Refund],
+    openapi_extra=FILTERS[models.Refund].openapi
 )
-def get_all_refunds(local: LocalRequestData = Depends(LocalRequestData)):
+async def get_all_refunds(
+        pagination: Pagination = Depends(Pagination),
+        filtering: Filtering = Depends(FILTERS[models.Refund]),
+        fields: SparseFields = Depends(SparseFields),
+        local: AsyncLocalRequestData = Depends(AsyncLocalRequestData)
+):
     """
     Return a list of all known refunds.
+
+    Use the `limit`, `after_id` and `before_id` query parameters to get only one
+    page of the list, ordered by ID. The `Link` header of the response points
+    to the next and previous pages (if there are any).
+
+    Filter the list by the fields `id`, `amount`, `creator`, `active` and
+    `ballot` and sort it using the `sort` query parameter (see the descriptions
+    of the query parameters). A 400 error will be returned for invalid filters
+    or when a custom sort order is combined with pagination.
+
+    Use the `fields` query parameter (a comma-separated list of field names)
+    to return only those fields of the objects (the `id` is always included).
+    Unknown field names result in a 400 error.
     """
 
-    return helpers.get_all_of_model(models.Refund, local)
+    return await helpers.get_all_of_model_async(
+        models.Refund, local, pagination=pagination, filtering=filtering, fields=fields
+    )
 
 
 @router.post(
@@ -89,15 +111,20 @@ def close_refund_by_id(
 )
 def get_refund_by_id(
         refund_id: pydantic.NonNegativeInt,
+        fields: SparseFields = Depends(SparseFields),
         local: LocalRequestData = Depends(LocalRequestData)
 ):
     """
     Return an existing refund.
 
+    Use the `fields` query parameter (a comma-separated list of field names)
+    to return only those fields of the object (the `id` is always included).
+    Unknown field names result in a 400 error.
+
     A 404 error will be returned if the specified refund ID was not found.
     """
 
-    return helpers.get_one_of_model(refund_id, models.Refund, local)
+    return helpers.get_one_of_model(refund_id, models.Refund, local, fields=fields)
 
 
 @router.get(
@@ -3,15 +3,21 @@ MateBot router module for /transactions requests
 """
 
 import logging
-from typing import List
+import datetime
+from typing import Dict, List, Optional, Tuple, Union
 
 import pydantic
-from fastapi import APIRouter, Depends
-
-from ..base import APIException, Conflict, NotFound, MissingImplementation
-from ..dependency import LocalRequestData
+import sqlalchemy
+import sqlalchemy.orm
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import StreamingResponse
+
+from .. import export
+from ..base import APIException, BadRequest, Conflict, NotFound
+from ..dependency import AsyncLocalRequestData, LocalRequestData, Pagination, SparseFields
+from ..filters import FILTERS, Filtering
 from .. import helpers
-from ...persistence import models
+from ...persistence import models, tracking
 from ... import schemas
 
 
@@ -29,7 +35,8 @@ def _make_transaction(
         amount: int,
         reason: str,
         local: LocalRequestData,
-        more_models: List[models.Base] = None
+        more_models: List[models.Base] = None,
+        receiver_shard: Optional[int] = None
 ) -> pydantic.BaseModel:
     if more_models is None:
         more_models = []
@@ -46,21 +53,120 @@ def _make_transaction(
         amount=amount,
         reason=reason
     )
-    sender.balance -= amount
-    receiver.balance += amount
-    return helpers.create_new_of_model(model, local, logger, more_models=more_models.extend([sender, receiver]))
+    balances = {sender.id: -amount, receiver.id: amount}
+    if receiver_shard is not None:
+        del balances[receiver.id]
+        helpers.add_to_shard(local.session, receiver.id, receiver_shard, amount)
+    helpers.add_to_column(local.session, models.User.balance, balances)
+    return helpers.create_new_of_model(model, local, logger, more_models=more_models)
+
+
+def _load_users(
+        session: sqlalchemy.orm.Session,
+        transactions: List[schemas.TransactionCreation]
+) -> Tuple[Dict[int, models.UserAlias], Dict[int, models.User]]:
+    references = [ref for t in transactions for ref in (t.sender, t.receiver)]
+    alias_ids = {ref.id for ref in references if isinstance(ref, schemas.Alias)}
+    aliases = {}
+    if alias_ids:
+        aliases = {
+            alias.id: alias
+            for alias in session.query(models.UserAlias).filter(models.UserAlias.id.in_(alias_ids))
+        }
+    user_ids = {ref for ref in references if isinstance(ref, int)}
+    user_ids.update(alias.user_id for alias in aliases.values())
+    users = {
+        user.id: user
+        for user in session.query(models.User).filter(models.User.id.in_(user_ids))
+    }
+    return aliases, users
+
+
+def _get_user(
+        data: Union[int, schemas.Alias],
+        target: str,
+        aliases: Dict[int, models.UserAlias],
+        users: Dict[int, models.User]
+) -> models.User:
+    if isinstance(data, schemas.Alias):
+        alias = aliases.get(data.id)
+        if alias is None:
+            raise NotFound(f"Alias ID {data.id!r}")
+        if alias.schema != data:
+            raise Conflict(
+                "Invalid state of the user alias. Query the aliases to update.",
+                f"Expected: {alias.schema!r}; actual: {data!r}"
+            )
+        user_id = alias.user_id
+    elif isinstance(data, int):
+        user_id = data
+    else:
+        raise TypeError(f"Unexpected type {type(data)} for {data!r}")
+
+    user = users.get(user_id)
+    if user is None:
+        raise NotFound(f"User ID {user_id} as {target}")
+    return user
+
+
+def _get_users(
+        transaction: schemas.TransactionCreation,
+        aliases: Dict[int, models.UserAlias],
+        users: Dict[int, models.User]
+) -> Tuple[models.User, models.User]:
+    sender = _get_user(transaction.sender, "sender", aliases, users)
+    receiver = _get_user(transaction.receiver, "receiver", aliases, users)
+    if sender.id == receiver.id:
+        raise Conflict("The sender can't be the receiver of a transaction.", f"user={sender.id}")
+    return sender, receiver
+
+
+def _get_time_range(
+        since: Optional[int],
+        until: Optional[int]
+) -> Tuple[Optional[datetime.datetime], Optional[datetime.datetime]]:
+    if since is not None and until is not None and until <= since:
+        raise BadRequest(
+            "The end of the time range must be after its start.",
+            f"since={since}, until={until}"
+        )
+    return tuple(
+        None if timestamp is None else datetime.datetime.fromtimestamp(timestamp)
+        for timestamp in (since, until)
+    )
 
 
 @router.get(
     "",
-    response_model=List[schemas.Transaction]
+    response_model=List[schemas.Transaction],
+    openapi_extra=FILTERS[models.Transaction].openapi
 )
-def get_all_transactions(local: LocalRequestData = Depends(LocalRequestData)):
+async def get_all_transactions(
+        pagination: Pagination = Depends(Pagination),
+        filtering: Filtering = Depends(FILTERS[models.Transaction]),
+        fields: SparseFields = Depends(SparseFields),
+        local: AsyncLocalRequestData = Depends(AsyncLocalRequestData)
+):
     """
     Return a list of all transactions in the system.
+
+    Use the `limit`, `after_id` and `before_id` query parameters to get only one
+    page of the list, ordered by ID. The `Link` header of the response points
+    to the next and previous pages (if there are any).
+
+    Filter the list by the fields `id`, `sender`, `receiver`, `amount` and
+    `timestamp` and sort it using the `sort` query parameter (see the
+    descriptions of the query parameters). A 400 error will be returned for
+    invalid filters or when a custom sort order is combined with pagination.
+
+    Use the `fields` query parameter (a comma-separated list of field names)
+    to return only those fields of the objects (the `id` is always included).
+    Unknown field names result in a 400 error.
     """
 
-    return helpers.get_all_of_model(models.Transaction, local)
+    return await helpers.get_all_of_model_async(
+        models.Transaction, local, pagination=pagination, filtering=filtering, fields=fields
+    )
 
 
 @router.post(
@@ -85,33 +191,122 @@ def make_a_new_transaction(
     accurate (e.g. outdated), or when the sender equals the receiver.
     """
 
-    def _get_user(data, target: str) -> models.User:
-        if isinstance(data, schemas.Alias):
-            alias = local.session.get(models.UserAlias, data.id)
-            if alias is None:
-                raise NotFound(f"Alias ID {data.id!r}")
-            if alias.schema != transaction.sender:
-                raise Conflict(
-                    "Invalid state of the user alias. Query the aliases to update.",
-                    f"Expected: {alias.schema!r}; actual: {transaction.sender!r}"
-                )
-            user_id = alias.user_id
-        elif isinstance(data, int):
-            user_id = data
-        else:
-            raise TypeError(f"Unexpected type {type(data)} for {data!r}")
-
-        user = local.session.get(models.User, user_id)
-        if user is None:
-            raise NotFound(f"User ID {user_id} as {target}")
-        return user
-
-    sender = _get_user(transaction.sender, "sender")
-    receiver = _get_user(transaction.receiver, "receiver")
-
+    aliases, users = _load_users(local.session, [transaction])
+    sender, receiver = _get_users(transaction, aliases, users)
     return _make_transaction(sender, receiver, transaction.amount, transaction.reason, local)
 
 
+@router.post(
+    "/batch",
+    status_code=201,
+    response_model=List[schemas.TransactionBatchResult],
+    responses={404: {"model": schemas.APIError}, 409: {"model": schemas.APIError}}
+)
+def make_new_transactions(
+        batch: schemas.TransactionBatchCreation,
+        local: LocalRequestData = Depends(LocalRequestData)
+):
+    """
+    Make many new transactions at once using the specified data and return them.
+
+    All senders and receivers (or their aliases) are looked up together and the
+    transactions are stored in one database transaction. The result contains
+    one item per transaction (in the same order), which holds either the new
+    `transaction` or the `error` which prevented it. By default, the batch is
+    `atomic`, i.e. either all transactions are made or none of them. Set it
+    to `false` to make all valid transactions, even if some of them failed.
+
+    Note that transactions can't be edited after being sent to this
+    endpoint by design, so take care doing that. The frontend application
+    might want to request explicit user approval ahead of time.
+
+    For atomic batches, a 404 error will be returned if the sender or receiver
+    users of any transaction can't be determined. A 409 error will be returned if
+    any supplied aliases are not accurate (e.g. outdated), or when the sender
+    equals the receiver. The details of those errors start with the index of
+    the failed transaction. Non-atomic batches report them as item errors.
+    """
+
+    aliases, users = _load_users(local.session, batch.transactions)
+    results = []
+    created = []
+    balances = {}
+    for index, transaction in enumerate(batch.transactions):
+        try:
+            sender, receiver = _get_users(transaction, aliases, users)
+        except APIException as exc:
+            exc.detail = f"transactions[{index}]: {exc.detail}"
+            if batch.atomic:
+                raise
+            results.append(schemas.APIError(
+                status=exc.status_code,
+                method=local.request.method,
+                request=local.request.url.path,
+                repeat=exc.repeat,
+                message=exc.message or type(exc).__name__,
+                details=exc.detail
+            ))
+            continue
+
+        logger.info(
+            f"Incoming transaction from {sender} to {receiver} about "
+            f"{transaction.amount} for {transaction.reason!r} in batch."
+        )
+        created.append(models.Transaction(
+            sender_id=sender.id,
+            receiver_id=receiver.id,
+            amount=transaction.amount,
+            reason=transaction.reason
+        ))
+        balances[sender.id] = balances.get(sender.id, 0) - transaction.amount
+        balances[receiver.id] = balances.get(receiver.id, 0) + transaction.amount
+        results.append(None)
+
+    helpers.add_to_column(local.session, models.User.balance, balances)
+    rows = iter(helpers.create_new_of_models(created, local, logger))
+    return [
+        schemas.TransactionBatchResult(error=result)
+        if result is not None else
+        schemas.TransactionBatchResult(transaction=schemas.Transaction(**next(rows)))
+        for result in results
+    ]
+
+
+@router.get(
+    "/export",
+    response_class=StreamingResponse,
+    responses={
+        200: {"content": {media_type: {} for media_type in export.FORMATS.values()}},
+        400: {"model": schemas.APIError}
+    }
+)
+def export_transactions(
+        export_format: str = Query("ndjson", alias="format", regex="^(ndjson|csv)$"),
+        since: Optional[pydantic.NonNegativeInt] = None,
+        until: Optional[pydantic.NonNegativeInt] = None
+):
+    """
+    Export all transactions as newline-delimited JSON (default) or CSV.
+
+    The transactions are streamed ordered by their timestamp, so that
+    exports of arbitrarily large histories use constant memory. The
+    optional `since` (inclusive) and `until` (exclusive) query parameters
+    restrict the export to a time range, given in seconds since the epoch.
+    Each row contains the fields `id`, `sender`, `receiver`, `amount`,
+    `reason`, `transaction_type` (the name of the type or `null`) and
+    `timestamp`. CSV exports start with a header line.
+
+    A 400 error will be returned if `until` is not after `since`.
+    """
+
+    since, until = _get_time_range(since, until)
+    return StreamingResponse(
+        export.generate(export_format, since, until),
+        media_type=export.FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="transactions.{export_format}"'}
+    )
+
+
 @router.get(
     "/{transaction_id}",
     response_model=schemas.Transaction,
@@ -119,32 +314,98 @@ def make_a_new_transaction(
 )
 def get_transaction_by_id(
         transaction_id: pydantic.NonNegativeInt,
+        fields: SparseFields = Depends(SparseFields),
         local: LocalRequestData = Depends(LocalRequestData)
 ):
     """
     Return details about a specific transaction identified by its transaction ID.
 
+    Use the `fields` query parameter (a comma-separated list of field names)
+    to return only those fields of the object (the `id` is always included).
+    Unknown field names result in a 400 error.
+
     A 404 error will be returned if the `transaction_id` is unknown.
     """
 
-    return helpers.get_one_of_model(transaction_id, models.Transaction, local)
+    return helpers.get_one_of_model(transaction_id, models.Transaction, local, fields=fields)
 
 
 @router.get(
     "/user/{user_id}",
     response_model=List[schemas.Transaction],
-    responses={404: {"model": schemas.APIError}}
+    responses={400: {"model": schemas.APIError}, 404: {"model": schemas.APIError}}
 )
-def get_all_transactions_of_user(user_id: pydantic.NonNegativeInt):
+def get_all_transactions_of_user(
+        user_id: pydantic.NonNegativeInt,
+        since: Optional[pydantic.NonNegativeInt] = None,
+        until: Optional[pydantic.NonNegativeInt] = None,
+        pagination: Pagination = Depends(Pagination),
+        fields: SparseFields = Depends(SparseFields),
+        local: LocalRequestData = Depends(LocalRequestData)
+):
     """
     Return a list of all transactions made by a specific user identified by its user ID.
 
     Note that this list includes both sent and received transactions.
-
-    A 404 error will be returned if the user ID is unknown.
+    The optional `since` (inclusive) and `until` (exclusive) query parameters
+    restrict the list to a time range, given in seconds since the epoch.
+    Use the `limit`, `after_id` and `before_id` query parameters to get only one
+    page of the list, ordered by ID. The `Link` header of the response points
+    to the next and previous pages (if there are any). Use the `fields` query
+    parameter (a comma-separated list of field names) to return only those
+    fields of the objects (the `id` is always included).
+
+    A 400 error will be returned if `until` is not after `since` or for
+    unknown field names. A 404 error will be returned if the user ID is unknown.
     """
 
-    raise MissingImplementation("get_all_transactions_of_user")
+    helpers.return_one(user_id, models.User, local.session)
+    since, until = _get_time_range(since, until)
+
+    bounds = []
+    if since is not None:
+        bounds.append(models.Transaction.registered >= since)
+    if until is not None:
+        bounds.append(models.Transaction.registered < until)
+
+    # The sent and received transactions are selected separately, so that each
+    # part can use the index of its column (an OR would result in a full scan);
+    # the latest transaction is found in the order of the index, too
+    latest = []
+    parts = []
+    for column in (models.Transaction.sender_id, models.Transaction.receiver_id):
+        latest.append(local.session.execute(
+            sqlalchemy.select(models.Transaction.id).where(column == user_id).order_by(
+                models.Transaction.registered.desc(),
+                models.Transaction.id.desc()
+            ).limit(1)
+        ).scalar() or 0)
+        part = sqlalchemy.select(models.Transaction.id).where(
+            column == user_id,
+            *bounds,
+            *pagination.get_criteria(models.Transaction)
+        )
+        if pagination.enabled:
+            part = part.order_by(pagination.get_order(models.Transaction))
+            part = part.limit(pagination.query_limit)
+        parts.append(sqlalchemy.select(part.subquery().c.id))
+
+    # Transactions are never changed, so a user's list only changes with new transactions
+    # and the embedded transaction types (whose counters include their transactions);
+    # the ETag only consists of counters, so conditional requests don't run the query
+    versions = [
+        ("User.transactions", user_id, max(latest)),
+        *tracking.get_versions(local.session, models.TransactionType)
+    ]
+    return helpers.get_all_of_model(
+        models.Transaction,
+        local,
+        pagination=pagination,
+        fields=fields,
+        criteria=[models.Transaction.id.in_(sqlalchemy.union(*parts))],
+        versions=versions,
+        variant=f"since={since}&until={until}"
+    )
 
 
 @router.post(
@@ -172,6 +433,10 @@ def consume_goods(
     Note that its the client's duty to select the appropriate response to
     the successful consumption, since one consumable type may have any number
     of consumable messages which may be used as a reply template to the user.
+    If the community account is sharded (see `community_shards` in the general
+    config), the payment is credited to one of its shards, chosen by the
+    user's ID, so that concurrent consumptions don't wait for each other.
+    The balance of the community user always includes all of its shards.
 
     A 400 error will be returned when the specified user who should consume
     the good is the special community user. A 404 error will be returned
@@ -191,20 +456,28 @@ def consume_goods(
             detail=str(user.schema)
         )
 
-    wastage = 0
-    if consumption.respect_stock:
-        if consumable.stock < consumption.amount:
-            raise Conflict(
-                f"Not enough {consumable.name} in stock to consume the goods.",
-                f"requested={consumption.amount}, stock={consumable.stock}",
-                repeat=True
-            )
-        if consumption.adjust_stock:
-            wastage = consumption.amount
+    out_of_stock = Conflict(
+        f"Not enough {consumable.name} in stock to consume the goods.",
+        f"requested={consumption.amount}, stock={consumable.stock}",
+        repeat=True
+    )
+    if consumption.respect_stock and consumable.stock < consumption.amount:
+        raise out_of_stock
 
     community = helpers.return_unique(models.User, local.session, special=True)
+    shards = local.config.general.community_shards
+    shard_id = None
+    if shards > 0:
+        shard_id = helpers.get_shard_id(local.session, community.id, user.id % shards)
+
+    # The stock is checked again by the update itself, since it may have
+    # been changed by concurrent requests after loading the consumable
+    if consumption.respect_stock and consumption.adjust_stock:
+        if not helpers.take_from_column(
+                local.session, models.Consumable.stock, consumable.id, consumption.amount
+        ):
+            raise out_of_stock
 
     reason = f"consume: {consumption.amount}x {consumable.name}"
     total = consumable.price * consumption.amount
-    consumable.stock -= wastage
-    return _make_transaction(user, community, total, reason, local, [consumable])
+    return _make_transaction(user, community, total, reason, local, receiver_shard=shard_id)
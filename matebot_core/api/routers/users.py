@@ -9,7 +9,8 @@ import pydantic
 from fastapi import APIRouter, Depends
 
 from ..base import Conflict, MissingImplementation
-from ..dependency import LocalRequestData
+from ..dependency import AsyncLocalRequestData, LocalRequestData, SparseFields
+from ..filters import FILTERS, Filtering
 from .. import helpers
 from ...persistence import models
 from ... import schemas
@@ -25,14 +26,30 @@ router = APIRouter(
 
 @router.get(
     "",
-    response_model=List[schemas.User]
+    response_model=List[schemas.User],
+    openapi_extra=FILTERS[models.User].openapi
 )
-def get_all_users(local: LocalRequestData = Depends(LocalRequestData)):
+async def get_all_users(
+        filtering: Filtering = Depends(FILTERS[models.User]),
+        fields: SparseFields = Depends(SparseFields),
+        local: AsyncLocalRequestData = Depends(AsyncLocalRequestData)
+):
     """
     Return a list of all internal user models with their aliases.
+
+    Filter the list by the fields `id`, `balance`, `permission`, `active`,
+    `external` and `voucher` and sort it using the `sort` query parameter (see
+    the descriptions of the query parameters). A 400 error will be returned
+    for invalid filters.
+
+    Use the `fields` query parameter (a comma-separated list of field names)
+    to return only those fields of the objects (the `id` is always included).
+    Unknown field names result in a 400 error.
     """
 
-    return helpers.get_all_of_model(models.User, local)
+    return await helpers.get_all_of_model_async(
+        models.User, local, filtering=filtering, fields=fields
+    )
 
 
 @router.post(
@@ -100,7 +117,7 @@ def delete_existing_user(
     """
 
     def hook(model, *args):
-        if model.balance != 0:
+        if model.total_balance != 0:
             raise Conflict(f"Balance of {user.name} is not zero. Can't delete user.", str(user))
 
         active_created_refunds = local.session.query(models.Refund).filter_by(
@@ -140,15 +157,20 @@ def delete_existing_user(
 )
 def get_user_by_id(
         user_id: pydantic.NonNegativeInt,
+        fields: SparseFields = Depends(SparseFields),
         local: LocalRequestData = Depends(LocalRequestData)
 ):
     """
     Return the internal model of the user specified by its user ID.
 
+    Use the `fields` query parameter (a comma-separated list of field names)
+    to return only those fields of the object (the `id` is always included).
+    Unknown field names result in a 400 error.
+
     A 404 error will be returned in case the user ID is unknown.
     """
 
-    return helpers.get_one_of_model(user_id, models.User, local)
+    return helpers.get_one_of_model(user_id, models.User, local, fields=fields)
 
 
 @router.delete(
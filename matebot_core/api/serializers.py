@@ -0,0 +1,411 @@
+"""
+Raw row serializers for the core REST API
+
+The serializers in this module select plain columns using SQLAlchemy Core
+and build the JSON-compatible representation of a model's schema directly
+from the resulting rows. This skips the identity map of the ORM as well as
+the creation and validation of pydantic models, which would otherwise be
+paid for every single row of a collection. Relationships are loaded with
+one additional query per relationship (not per row) and merged afterwards.
+
+The produced dictionaries are equal to the ``dict()`` of the schemas built
+by the ORM models' ``schema`` property, including the order of the keys.
+Alternatively, only a subset of the fields can be selected (sparse fieldsets),
+which skips the columns and relationships of the other fields altogether.
+"""
+
+import datetime
+from typing import Any, Callable, Collection, Dict, Iterable, List, Optional, Set, Type
+
+import sqlalchemy
+import sqlalchemy.orm
+from sqlalchemy.sql.elements import ColumnElement
+
+from ..persistence import models
+
+
+# Upper bound of parameters in one IN clause, to respect the limits of old sqlite3 versions
+_MAX_IN_PARAMETERS = 500
+
+
+def _timestamp(value: Optional[datetime.datetime]) -> Optional[int]:
+    return value and int(value.timestamp())
+
+
+def _chunks(keys: Set[Any]) -> Iterable[List[Any]]:
+    keys = sorted(keys)
+    for i in range(0, len(keys), _MAX_IN_PARAMETERS):
+        yield keys[i:i + _MAX_IN_PARAMETERS]
+
+
+class Relation:
+    """
+    Field of a serialized row whose value is loaded by a separate query
+
+    The ``key`` is a column of the serialized model's row (e.g. its ID or a foreign key),
+    whose distinct values of all selected rows will be given to the ``loader``. The
+    loader returns a mapping of those keys to the field's value. Rows whose key is
+    missing in that mapping get the value returned by the ``default`` factory instead.
+    """
+
+    def __init__(
+            self,
+            key: ColumnElement,
+            loader: Callable[[sqlalchemy.orm.Session, Set[Any]], Dict[Any, Any]],
+            default: Callable[[], Any] = lambda: None
+    ):
+        self.key = key
+        self.loader = loader
+        self.default = default
+
+
+class RowSerializer:
+    """
+    Serializer of the rows of one model into the representation of its schema
+
+    The ``fields`` map the name of every field of the schema to either a column
+    expression (whose value may be converted by the function given in the
+    ``converters``), a ``Relation`` or ``None`` (for fields that are always null).
+    The optional ``from_clause`` can be used to join other tables for columns.
+    The methods accept an optional collection of field names to serialize only
+    those fields (the ``id`` is always included), see ``get_fields``.
+    """
+
+    def __init__(
+            self,
+            model: Type[models.Base],
+            fields: Dict[str, Any],
+            converters: Optional[Dict[str, Callable[[Any], Any]]] = None,
+            from_clause: Optional[Any] = None
+    ):
+        self.model = model
+        self.fields = fields
+        self.converters = converters or {}
+        self.from_clause = from_clause if from_clause is not None else model.__table__
+
+    def get_fields(self, fields: Optional[Collection[str]] = None) -> Dict[str, Any]:
+        """
+        Return the specifications of the given fields (or all fields) in the schema's order
+
+        :raises KeyError: when one of the given fields is unknown
+        """
+
+        if fields is None:
+            return self.fields
+        unknown = set(fields) - set(self.fields)
+        if unknown:
+            raise KeyError(", ".join(sorted(unknown)))
+        return {
+            name: spec for name, spec in self.fields.items()
+            if name == "id" or name in fields
+        }
+
+    def select(self, fields: Optional[Collection[str]] = None) -> sqlalchemy.sql.Select:
+        """
+        Return the statement selecting all columns required for serialization
+        """
+
+        columns = []
+        for name, spec in self.get_fields(fields).items():
+            if isinstance(spec, Relation):
+                columns.append(spec.key.label(f"_key_{name}"))
+            elif spec is not None:
+                columns.append(spec.label(name))
+        return sqlalchemy.select(*columns).select_from(self.from_clause)
+
+    def serialize(
+            self,
+            session: sqlalchemy.orm.Session,
+            rows: List[sqlalchemy.engine.Row],
+            fields: Optional[Collection[str]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Serialize the rows selected by the statement of ``select`` (and load the relations)
+        """
+
+        specs = self.get_fields(fields)
+        relations = {}
+        for name, spec in specs.items():
+            if isinstance(spec, Relation):
+                keys = {row._mapping[f"_key_{name}"] for row in rows} - {None}
+                relations[name] = spec.loader(session, keys) if keys else {}
+
+        result = []
+        for row in rows:
+            mapping = row._mapping
+            item = {}
+            for name, spec in specs.items():
+                if isinstance(spec, Relation):
+                    key = mapping[f"_key_{name}"]
+                    item[name] = relations[name][key] if key in relations[name] else spec.default()
+                elif spec is None:
+                    item[name] = None
+                elif name in self.converters:
+                    item[name] = self.converters[name](mapping[name])
+                else:
+                    item[name] = mapping[name]
+            result.append(item)
+        return result
+
+    def load(
+            self,
+            session: sqlalchemy.orm.Session,
+            *criteria: ColumnElement,
+            order_by: Optional[List[ColumnElement]] = None,
+            limit: Optional[int] = None,
+            fields: Optional[Collection[str]] = None,
+            **kwargs
+    ) -> List[Dict[str, Any]]:
+        """
+        Load and serialize all rows matching the criteria and filter arguments
+
+        :param session: database session which should be used to perform the queries
+        :param criteria: optional SQL expressions to filter the rows
+        :param order_by: optional list of SQL expressions to sort the rows (default: by ID)
+        :param limit: optional maximum number of rows
+        :param fields: optional collection of the names of the serialized fields
+        :param kwargs: optional filter arguments (column names of the model's table)
+        :return: list of the serialized rows
+        """
+
+        table = self.model.__table__
+        statement = self.select(fields).where(
+            *criteria,
+            *[table.c[key] == value for key, value in kwargs.items()]
+        ).order_by(*(order_by or [self.model.id])).limit(limit)
+        return self.serialize(session, session.execute(statement).all(), fields)
+
+
+def _load_aliases(key: ColumnElement, many: bool):
+    def loader(session: sqlalchemy.orm.Session, keys: Set[Any]) -> Dict[Any, Any]:
+        result = {}
+        for chunk in _chunks(keys):
+            statement = sqlalchemy.select(
+                models.UserAlias.id,
+                models.UserAlias.user_id,
+                models.Application.name,
+                models.UserAlias.app_user_id,
+                key.label("_key")
+            ).join(
+                models.Application, models.UserAlias.app_id == models.Application.id
+            ).where(key.in_(chunk)).order_by(models.UserAlias.id)
+
+            for row in session.execute(statement):
+                alias = {
+                    "id": row.id,
+                    "user_id": row.user_id,
+                    "application": row.name,
+                    "app_user_id": row.app_user_id
+                }
+                if many:
+                    result.setdefault(row._key, []).append(alias)
+                else:
+                    result[row._key] = alias
+        return result
+
+    return loader
+
+
+def _load_transaction_types(session: sqlalchemy.orm.Session, keys: Set[Any]) -> Dict[Any, Any]:
+    statement = sqlalchemy.select(
+        models.TransactionType.id,
+        models.TransactionType.name,
+        models.TransactionType.transaction_count
+    ).where(models.TransactionType.id.in_(keys))
+    return {
+        row.id: {"id": row.id, "name": row.name, "count": row.transaction_count}
+        for row in session.execute(statement)
+    }
+
+
+def _load_grouped(
+        key: ColumnElement,
+        columns: Dict[str, ColumnElement],
+        order_by: ColumnElement
+):
+    def loader(session: sqlalchemy.orm.Session, keys: Set[Any]) -> Dict[Any, Any]:
+        result = {}
+        for chunk in _chunks(keys):
+            statement = sqlalchemy.select(
+                key.label("_key"),
+                *[column.label(name) for name, column in columns.items()]
+            ).where(key.in_(chunk)).order_by(order_by)
+            for row in session.execute(statement):
+                mapping = row._mapping
+                result.setdefault(row._key, []).append({name: mapping[name] for name in columns})
+        return result
+
+    return loader
+
+
+def _load_messages(session: sqlalchemy.orm.Session, keys: Set[Any]) -> Dict[Any, Any]:
+    loader = _load_grouped(
+        models.ConsumableMessage.consumable_id,
+        {"message": models.ConsumableMessage.message},
+        models.ConsumableMessage.id
+    )
+    return {k: [m["message"] for m in v] for k, v in loader(session, keys).items()}
+
+
+def _load_participants(session: sqlalchemy.orm.Session, keys: Set[Any]) -> Dict[Any, Any]:
+    loader = _load_grouped(
+        models.CommunismUsers.communism_id,
+        {"user_id": models.CommunismUsers.user_id, "quantity": models.CommunismUsers.quantity},
+        models.CommunismUsers.id
+    )
+    return {k: {p["user_id"]: p["quantity"] for p in v} for k, v in loader(session, keys).items()}
+
+
+def _load_votes(session: sqlalchemy.orm.Session, keys: Set[Any]) -> Dict[Any, Any]:
+    loader = _load_grouped(
+        models.Vote.ballot_id,
+        {
+            "id": models.Vote.id,
+            "user_id": models.Vote.user_id,
+            "ballot_id": models.Vote.ballot_id,
+            "vote": models.Vote.vote,
+            "modified": models.Vote.modified
+        },
+        models.Vote.id
+    )
+    result = loader(session, keys)
+    for votes in result.values():
+        for vote in votes:
+            vote["modified"] = _timestamp(vote["modified"])
+    return result
+
+
+SERIALIZERS: Dict[Type[models.Base], RowSerializer] = {
+    models.User: RowSerializer(
+        models.User,
+        {
+            "id": models.User.id,
+            "name": models.User.name,
+            "balance": models.User.total_balance,
+            "permission": models.User.permission,
+            "active": models.User.active,
+            "external": models.User.external,
+            "voucher": models.User.voucher_id,
+            "aliases": Relation(
+                models.User.id,
+                _load_aliases(models.UserAlias.user_id, True),
+                list
+            ),
+            "created": models.User.created,
+            "accessed": models.User.accessed
+        },
+        {"created": _timestamp, "accessed": _timestamp}
+    ),
+    models.Application: RowSerializer(
+        models.Application,
+        {
+            "id": models.Application.id,
+            "name": models.Application.name,
+            "community_user": Relation(
+                models.Application.community_user_alias_id,
+                _load_aliases(models.UserAlias.id, False)
+            ),
+            "created": models.Application.created
+        },
+        {"created": _timestamp}
+    ),
+    models.UserAlias: RowSerializer(
+        models.UserAlias,
+        {
+            "id": models.UserAlias.id,
+            "user_id": models.UserAlias.user_id,
+            "application": models.Application.name,
+            "app_user_id": models.UserAlias.app_user_id
+        },
+        from_clause=sqlalchemy.join(
+            models.UserAlias, models.Application, models.UserAlias.app_id == models.Application.id
+        )
+    ),
+    models.Transaction: RowSerializer(
+        models.Transaction,
+        {
+            "id": models.Transaction.id,
+            "sender": models.Transaction.sender_id,
+            "receiver": models.Transaction.receiver_id,
+            "amount": models.Transaction.amount,
+            "reason": models.Transaction.reason,
+            "transaction_type": Relation(
+                models.Transaction.transaction_types_id,
+                _load_transaction_types
+            ),
+            "timestamp": models.Transaction.registered
+        },
+        {"timestamp": _timestamp}
+    ),
+    models.Consumable: RowSerializer(
+        models.Consumable,
+        {
+            "id": models.Consumable.id,
+            "name": models.Consumable.name,
+            "description": models.Consumable.description,
+            "price": models.Consumable.price,
+            "messages": Relation(models.Consumable.id, _load_messages, list),
+            "symbol": models.Consumable.symbol,
+            "stock": models.Consumable.stock,
+            "modified": models.Consumable.modified
+        },
+        {"modified": _timestamp}
+    ),
+    models.Refund: RowSerializer(
+        models.Refund,
+        {
+            "id": models.Refund.id,
+            "amount": models.Refund.amount,
+            "description": models.Refund.description,
+            "creator": models.Refund.creator_id,
+            "active": models.Refund.active,
+            "allowed": models.Ballot.result,
+            "ballot": models.Refund.ballot_id,
+            "transactions": None,
+            "timestamp": None
+        },
+        {"allowed": lambda result: None if result is None else bool(result)},
+        sqlalchemy.outerjoin(
+            models.Refund, models.Ballot, models.Refund.ballot_id == models.Ballot.id
+        )
+    ),
+    models.Ballot: RowSerializer(
+        models.Ballot,
+        {
+            "id": models.Ballot.id,
+            "question": models.Ballot.question,
+            "restricted": models.Ballot.restricted,
+            "active": models.Ballot.active,
+            "votes": Relation(models.Ballot.id, _load_votes, list),
+            "result": models.Ballot.result,
+            "closed": models.Ballot.closed
+        },
+        {"closed": _timestamp}
+    ),
+    models.Vote: RowSerializer(
+        models.Vote,
+        {
+            "id": models.Vote.id,
+            "user_id": models.Vote.user_id,
+            "ballot_id": models.Vote.ballot_id,
+            "vote": models.Vote.vote,
+            "modified": models.Vote.modified
+        },
+        {"modified": _timestamp}
+    ),
+    models.Communism: RowSerializer(
+        models.Communism,
+        {
+            "id": models.Communism.id,
+            "amount": models.Communism.amount,
+            "description": models.Communism.description,
+            "creator": models.Communism.creator_id,
+            "active": models.Communism.active,
+            "accepted": None,
+            "externals": models.Communism.externals,
+            "participants": Relation(models.Communism.id, _load_participants, dict),
+            "transactions": None,
+            "timestamp": None
+        }
+    )
+}
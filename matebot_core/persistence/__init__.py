@@ -1,3 +1,6 @@
 """
 MateBot core persistence (database) features
 """
+
+# Register the session events maintaining the version counters of the models
+from . import tracking
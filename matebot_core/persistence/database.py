@@ -3,20 +3,238 @@ MateBot database bindings and functions using sqlalchemy
 """
 
 import sys
-from typing import Optional
+import time
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Union
 
-from sqlalchemy import create_engine
+import sqlalchemy
+import sqlalchemy.exc
+from sqlalchemy import create_engine, event
 from sqlalchemy.engine import Engine as _Engine
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+try:
+    from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+except ImportError:
+    AsyncEngine = AsyncSession = create_async_engine = AsyncAdaptedQueuePool = None
 
 
 DEFAULT_DATABASE_URL = "sqlite://"
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "mysql": "mysql+aiomysql",
+    "mariadb": "mariadb+aiomysql",
+    "postgresql": "postgresql+asyncpg"
+}
 Base = declarative_base()
 _engine: Optional[_Engine] = None
 _make_session: Optional[sessionmaker] = None
+_async_engine: Optional["AsyncEngine"] = None
+_make_async_session: Optional[sessionmaker] = None
+_pool_metrics: Dict[str, "PoolMetrics"] = {}
+_replicas: List["Replica"] = []
+_replica_lock = threading.Lock()
+_replica_counter = 0
+
+
+class PoolMetrics:
+    """
+    Collector of connection pool statistics of one engine using SQLAlchemy pool events
+
+    The counters survive the recreation of the pool (e.g. by ``Engine.dispose``),
+    since the event listeners are carried over to the new pool. The wait times
+    are only available for pools that measure them, see ``_MeasuredPoolMixin``.
+    """
+
+    def __init__(self, name: str, engine: _Engine):
+        self.name = name
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.checked_out = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.waits = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+        pool = engine.pool
+        if isinstance(pool, _MeasuredPoolMixin):
+            pool.metrics = self
+        event.listen(pool, "connect", self._on_connect)
+        event.listen(pool, "close", self._on_close)
+        event.listen(pool, "close_detached", self._on_close)
+        event.listen(pool, "checkout", self._on_checkout)
+        event.listen(pool, "checkin", self._on_checkin)
+
+    def _on_connect(self, *_):
+        with self.lock:
+            self.connections += 1
+
+    def _on_close(self, *_):
+        with self.lock:
+            self.connections -= 1
+
+    def _on_checkout(self, *_):
+        with self.lock:
+            self.checked_out += 1
+            self.checkouts += 1
+
+    def _on_checkin(self, *_):
+        with self.lock:
+            self.checked_out -= 1
+
+    def record_wait(self, seconds: float, timeout: bool = False):
+        with self.lock:
+            self.waits += 1
+            self.wait_time_total += seconds
+            self.wait_time_max = max(self.wait_time_max, seconds)
+            if timeout:
+                self.timeouts += 1
+
+    def as_dict(self) -> Dict[str, Any]:
+        """
+        Return a snapshot of the current pool statistics as a dictionary
+        """
+
+        pool = self.engine.pool
+        with self.lock:
+            return {
+                "name": self.name,
+                "pool_class": type(pool).__name__,
+                "size": pool.size() if hasattr(pool, "size") else 0,
+                "connections": self.connections,
+                "checked_out": self.checked_out,
+                "idle": pool.checkedin() if hasattr(pool, "checkedin") else 0,
+                "overflow": max(pool.overflow(), 0) if hasattr(pool, "overflow") else 0,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_time_total": self.wait_time_total,
+                "wait_time_max": self.wait_time_max,
+                "wait_time_average": self.waits and self.wait_time_total / self.waits
+            }
+
+
+class _MeasuredPoolMixin:
+    """
+    Mixin for queue pools measuring the time spent waiting for a connection
+    """
+
+    metrics: Optional[PoolMetrics] = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            if self.metrics is not None:
+                self.metrics.record_wait(time.perf_counter() - start, True)
+            raise
+        if self.metrics is not None:
+            self.metrics.record_wait(time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+class Replica:
+    """
+    Read-only replica of the primary database with a simple health state
+
+    A replica is considered unhealthy for ``check_interval`` seconds after
+    any connection problem has been detected, either by the periodic health
+    check (a trivial query that is issued when the last check is older than
+    ``check_interval`` seconds) or by a failing statement during a request.
+    Sessions won't be bound to unhealthy replicas until they recovered.
+    """
+
+    def __init__(self, name: str, engine: _Engine, check_interval: float):
+        self.name = name
+        self.engine = engine
+        self.check_interval = check_interval
+        self.make_session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        self.last_check = 0.0
+        self.down_until = 0.0
+        event.listen(engine, "handle_error", self._on_error)
+
+    def _on_error(self, context):
+        if context.is_disconnect:
+            self.mark_down()
+
+    def mark_down(self):
+        logging.getLogger(__name__).warning(
+            f"Database replica {self.name!r} is unavailable, retrying in {self.check_interval}s"
+        )
+        self.down_until = time.monotonic() + self.check_interval
+
+    def is_available(self) -> bool:
+        """
+        Determine whether the replica is usable, checking its health if the last check is too old
+        """
+
+        now = time.monotonic()
+        if now < self.down_until:
+            return False
+        if now - self.last_check < self.check_interval:
+            return True
+
+        self.last_check = now
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(sqlalchemy.text("SELECT 1"))
+        except sqlalchemy.exc.DBAPIError:
+            self.mark_down()
+            return False
+        return True
+
+
+class _MeasuredQueuePool(_MeasuredPoolMixin, QueuePool):
+    pass
 
 
-def init(database_url: str, echo: bool = True, create_all: bool = True):
+if AsyncAdaptedQueuePool is not None:
+    class _MeasuredAsyncQueuePool(_MeasuredPoolMixin, AsyncAdaptedQueuePool):
+        pass
+else:
+    _MeasuredAsyncQueuePool = None
+
+
+def get_async_url(database_url: str) -> str:
+    """
+    Derive the URL of the database connection using an asyncio-capable driver
+
+    The dialect of the given URL is kept, but the driver will be replaced
+    by the asyncio driver found in the ``ASYNC_DRIVERS`` mapping.
+
+    :param database_url: the full URL to connect to the database synchronously
+    :return: the full URL to connect to the same database using asyncio
+    :raises ValueError: when no asyncio driver is known for the URL's dialect
+    """
+
+    scheme, separator, remainder = database_url.partition("://")
+    dialect = scheme.split("+")[0]
+    if dialect not in ASYNC_DRIVERS:
+        raise ValueError(f"No asyncio driver known for database dialect {dialect!r}")
+    return ASYNC_DRIVERS[dialect] + separator + remainder
+
+
+def init(
+        database_url: str,
+        echo: bool = True,
+        create_all: bool = True,
+        pool_options: Optional[Dict[str, Any]] = None,
+        sqlite_pragmas: Optional[Dict[str, Any]] = None,
+        replica_urls: Optional[List[str]] = None,
+        replica_check_interval: float = 10.0,
+        use_asyncio: bool = False,
+        async_database_url: Optional[str] = None
+):
     """
     Initialize the database bindings
 
@@ -27,38 +245,172 @@ def init(database_url: str, echo: bool = True, create_all: bool = True):
     about the default connection. Without initialization prior to database
     usage, a warning will be emitted once to prevent future errors.
 
+    All engines use a queue pool for their connections, whose behavior can
+    be adjusted using the ``pool_options`` (e.g. ``pool_size``, ``max_overflow``,
+    ``pool_timeout``, ``pool_recycle`` or ``pool_pre_ping``). The only exception
+    is the in-memory sqlite3 database, where SQLAlchemy's default pool is used.
+    Statistics about the usage of those pools are available via ``get_pool_metrics``.
+
+    The ``sqlite_pragmas`` will be set on every new connection to a sqlite3
+    database, which allows to tune the database (e.g. enable the WAL journal
+    mode via ``{"journal_mode": "WAL"}``). They are ignored for other databases.
+    Note that the pragma names and values are not escaped, so don't use any
+    values that haven't been validated before (e.g. by ``SQLiteProfile``).
+
+    The optional ``replica_urls`` point to read-only replicas of the primary
+    database, which are kept up-to-date by the database itself. Sessions
+    created with ``get_new_session(read_only=True)`` are bound to the healthy
+    replicas in a round-robin fashion, falling back to the primary database.
+    Note that the replicas are never used for writing.
+
+    The additional asyncio engine is only created if ``use_asyncio`` is set.
+    It connects to the primary database using an asyncio driver (which needs
+    to be installed separately, e.g. ``aiosqlite`` or ``aiomysql``) and uses
+    the same pool options. Its sessions are created by ``get_new_async_session``.
+
     :param database_url: the full URL to connect to the database
     :param echo: whether all SQLAlchemy magic should print to screen
     :param create_all: whether the metadata of the declarative base should
-        be used to create all non-existing tables in the database
-    """
-
-    global _engine, _make_session
-    if database_url.startswith("sqlite:"):
-        if ":memory:" in database_url or database_url == "sqlite://":
-            print(
-                "Using the in-memory sqlite3 may lead to later problems. "
-                "It's therefore recommended to create a persistent file.",
-                file=sys.stderr
-            )
-
-        _engine = create_engine(
-            database_url,
-            echo=echo,
-            connect_args={"check_same_thread": False}
+        be used to create all non-existing tables and indexes in the database
+    :param pool_options: optional keyword arguments to configure the connection pools
+    :param sqlite_pragmas: optional mapping of pragmas set on new sqlite3 connections
+    :param replica_urls: optional list of full URLs to connect to read-only replicas
+    :param replica_check_interval: number of seconds between the health checks of a
+        replica as well as the time span an unhealthy replica won't be used anymore
+    :param use_asyncio: whether the asyncio engine and session maker should be created
+    :param async_database_url: optional full URL to connect to the database using
+        asyncio (it will be derived from ``database_url`` if it's not given)
+    :raises RuntimeError: when the asyncio mode was requested, but is not available
+    """
+
+    global _engine, _make_session, _pool_metrics, _replicas
+    global _async_engine, _make_async_session
+    if _is_in_memory(database_url):
+        print(
+            "Using the in-memory sqlite3 may lead to later problems. "
+            "It's therefore recommended to create a persistent file.",
+            file=sys.stderr
         )
 
-    else:
-        _engine = create_engine(
-            database_url,
-            echo=echo
+    _pool_metrics = {}
+    _engine = _create_engine("primary", database_url, echo, pool_options, sqlite_pragmas)
+    _replicas = [
+        Replica(
+            f"replica{i}",
+            _create_engine(f"replica{i}", url, echo, pool_options, sqlite_pragmas),
+            replica_check_interval
         )
+        for i, url in enumerate(replica_urls or [])
+    ]
 
     if create_all:
         Base.metadata.create_all(bind=_engine)
+        create_missing_indexes(_engine)
 
     _make_session = sessionmaker(autocommit=False, autoflush=False, bind=_engine)
 
+    _async_engine = None
+    _make_async_session = None
+    if use_asyncio:
+        if create_async_engine is None:
+            raise RuntimeError("The asyncio extension of SQLAlchemy is not available")
+        if _is_in_memory(database_url):
+            raise RuntimeError("The asyncio mode can't share an in-memory sqlite3 database")
+
+        _async_engine = _create_engine(
+            "asyncio",
+            async_database_url or get_async_url(database_url),
+            echo,
+            pool_options,
+            sqlite_pragmas,
+            use_asyncio=True
+        )
+        _make_async_session = sessionmaker(
+            autocommit=False,
+            autoflush=False,
+            expire_on_commit=False,
+            bind=_async_engine,
+            class_=AsyncSession
+        )
+
+
+def create_missing_indexes(engine: _Engine) -> List[str]:
+    """
+    Create all indexes of the declarative base that don't exist in the database yet
+
+    Creating the tables only adds the indexes of newly created tables, so
+    this function is used to migrate databases created by older versions.
+    Note that creating an index on a large table may take a while.
+
+    :param engine: the engine connected to the database that should be migrated
+    :return: list of the names of the newly created indexes
+    """
+
+    inspector = sqlalchemy.inspect(engine)
+    created = []
+    for table in Base.metadata.tables.values():
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logging.getLogger(__name__).info(f"Creating missing index {index.name!r}...")
+                index.create(bind=engine)
+                created.append(index.name)
+    return created
+
+
+def _is_in_memory(database_url: str) -> bool:
+    return database_url.startswith("sqlite:") and (
+        ":memory:" in database_url or database_url == "sqlite://"
+    )
+
+
+def _create_engine(
+        name: str,
+        database_url: str,
+        echo: bool,
+        pool_options: Optional[Dict[str, Any]],
+        sqlite_pragmas: Optional[Dict[str, Any]],
+        use_asyncio: bool = False
+) -> Union[_Engine, "AsyncEngine"]:
+    """
+    Create a new (asyncio) engine and register it for the collection of pool metrics
+    """
+
+    sqlite = database_url.partition(":")[0].split("+")[0] == "sqlite"
+    engine_options = {"echo": echo}
+    if sqlite and not use_asyncio:
+        engine_options["connect_args"] = {"check_same_thread": False}
+    if not _is_in_memory(database_url):
+        engine_options.update(pool_options or {})
+        engine_options["poolclass"] = _MeasuredAsyncQueuePool if use_asyncio else _MeasuredQueuePool
+
+    if use_asyncio:
+        engine = create_async_engine(database_url, **engine_options)
+        sync_engine = engine.sync_engine
+    else:
+        engine = sync_engine = create_engine(database_url, **engine_options)
+    _pool_metrics[name] = PoolMetrics(name, sync_engine)
+    if sqlite_pragmas and sqlite:
+        _set_pragmas_on_connect(sync_engine, sqlite_pragmas)
+    return engine
+
+
+def _set_pragmas_on_connect(engine: _Engine, pragmas: Dict[str, Any]):
+    """
+    Register an event listener setting the given pragmas on every new sqlite3 connection
+    """
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        try:
+            for key, value in pragmas.items():
+                cursor.execute(f"PRAGMA {key}={value}")
+        finally:
+            cursor.close()
+
 
 def _warn(obj: str):
     print(
@@ -76,8 +428,51 @@ def get_engine() -> _Engine:
     return _engine
 
 
-def get_new_session():
+def get_new_session(read_only: bool = False):
+    """
+    Return a new session bound to the primary database or to a read-only replica
+
+    :param read_only: whether the session will only be used for reading, so that
+        it may be bound to one of the healthy replicas (chosen round-robin)
+    """
+
+    global _replica_counter
     if _make_session is None or _engine is None:
         _warn("engine or its session maker")
         init(DEFAULT_DATABASE_URL)
+
+    if read_only and _replicas:
+        with _replica_lock:
+            start = _replica_counter
+            _replica_counter = (_replica_counter + 1) % len(_replicas)
+        for i in range(len(_replicas)):
+            replica = _replicas[(start + i) % len(_replicas)]
+            if replica.is_available():
+                return replica.make_session()
     return _make_session()
+
+
+def has_async_engine() -> bool:
+    return _async_engine is not None and _make_async_session is not None
+
+
+def get_async_engine() -> "AsyncEngine":
+    if _async_engine is None:
+        raise RuntimeError("Database asyncio engine not initialized! Enable it in 'init'.")
+    return _async_engine
+
+
+def get_new_async_session() -> "AsyncSession":
+    """
+    Return a new asyncio session bound to the primary database (see ``init``)
+
+    :raises RuntimeError: when the asyncio mode hasn't been enabled
+    """
+
+    if _make_async_session is None or _async_engine is None:
+        raise RuntimeError("Database asyncio session maker not initialized! Enable it in 'init'.")
+    return _make_async_session()
+
+
+def get_pool_metrics() -> Dict[str, PoolMetrics]:
+    return _pool_metrics
@@ -2,13 +2,19 @@
 MateBot core database models
 """
 
+from typing import List, Type
+
 import pydantic
 from sqlalchemy import (
     Boolean, DateTime, Integer, SmallInteger, String,
-    CheckConstraint, Column, FetchedValue, ForeignKey, UniqueConstraint
+    CheckConstraint, Column, FetchedValue, ForeignKey, Index, UniqueConstraint
 )
-from sqlalchemy.orm import relationship, backref
-from sqlalchemy.sql import func
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import backref, column_property, joinedload, relationship, selectinload
+from sqlalchemy.orm.interfaces import LoaderOption
+from sqlalchemy.sql import func, select
+from sqlalchemy.sql.expression import ColumnElement
+from sqlalchemy.sql.visitors import InternalTraversal
 
 from .database import Base
 from .. import schemas
@@ -93,7 +99,7 @@ class User(Base):
         return schemas.User(
             id=self.id,
             name=self.name,
-            balance=self.balance,
+            balance=self.total_balance,
             permission=self.permission,
             active=self.active,
             external=self.external,
@@ -107,6 +113,112 @@ class User(Base):
         return f"User(id={self.id}, balance={self.balance}, aliases={self.aliases})"
 
 
+class CommunityShard(Base):
+    __tablename__ = "community_shards"
+
+    id = _make_id_column()
+
+    user_id = Column(
+        Integer,
+        ForeignKey("users.id", ondelete="CASCADE"),
+        nullable=False
+    )
+    shard = Column(
+        Integer,
+        nullable=False
+    )
+    balance = Column(
+        Integer,
+        nullable=False,
+        default=0
+    )
+    version = Column(
+        Integer,
+        nullable=False,
+        default=0
+    )
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "shard"),
+    )
+
+    def __repr__(self) -> str:
+        return "CommunityShard(user_id={}, shard={}, balance={})".format(
+            self.user_id, self.shard, self.balance
+        )
+
+
+# Whether the balances of the users include their shards (see ``set_community_shards``)
+_community_shards = False
+
+
+def set_community_shards(enabled: bool):
+    """
+    Enable or disable the shards in the total balance of users
+
+    The sum of the shards is only selected together with the users when enabled,
+    which must be the case as long as any shards exist in the database.
+    """
+
+    global _community_shards
+    _community_shards = enabled
+
+
+def community_shards_enabled() -> bool:
+    """
+    Determine whether the shards are part of the total balance of users
+    """
+
+    return _community_shards
+
+
+class _TotalBalance(ColumnElement):
+    """
+    Balance of a user including the sum of its shards, if they are enabled
+
+    The switch is part of the cache key, so that statements compiled with
+    and without the shards are never mixed up by the compiled cache.
+    """
+
+    _traverse_internals = [
+        ("enabled", InternalTraversal.dp_boolean),
+        ("balance", InternalTraversal.dp_clauseelement),
+        ("shards", InternalTraversal.dp_clauseelement)
+    ]
+
+    type = Integer()
+
+    def __init__(self, balance: ColumnElement, shards: ColumnElement):
+        self.balance = balance
+        self.shards = shards
+
+    @property
+    def enabled(self) -> bool:
+        return _community_shards
+
+    @property
+    def _from_objects(self) -> list:
+        return self.balance._from_objects
+
+
+@compiles(_TotalBalance)
+def _compile_total_balance(element: _TotalBalance, compiler, **kwargs) -> str:
+    if element.enabled:
+        return compiler.process(element.balance + func.coalesce(element.shards, 0), **kwargs)
+    return compiler.process(element.balance, **kwargs)
+
+
+# The balance of a user includes the balances of its shards, which split the balance of
+# the community user into multiple rows (other users don't have any shards at all)
+User.total_balance = column_property(_TotalBalance(
+    User.balance,
+    select(func.sum(CommunityShard.balance))
+    .where(CommunityShard.user_id == User.id)
+    .correlate_except(CommunityShard)
+    .scalar_subquery()
+))
+
+
 class Application(Base):
     __tablename__ = "applications"
 
@@ -173,7 +285,8 @@ class UserAlias(Base):
 
     __table_args__ = (
         UniqueConstraint("app_id", "app_user_id"),
-        UniqueConstraint("app_id", "user_id")
+        UniqueConstraint("app_id", "user_id"),
+        Index("ix_aliases_user_id", "user_id")
     )
 
     @property
@@ -207,12 +320,12 @@ class TransactionType(Base):
         return schemas.TransactionType(
             id=self.id,
             name=self.name,
-            count=len(self.transactions)
+            count=self.transaction_count
         )
 
     def __repr__(self) -> str:
         return "TransactionType(id={}, name={}, count={})".format(
-            self.id, self.name, len(self.transactions)
+            self.id, self.name, self.transaction_count
         )
 
 
@@ -265,7 +378,11 @@ class Transaction(Base):
 
     __table_args__ = (
         CheckConstraint("amount > 0"),
-        CheckConstraint("sender_id != receiver_id")
+        CheckConstraint("sender_id != receiver_id"),
+        Index("ix_transactions_sender_id_registered", "sender_id", "registered"),
+        Index("ix_transactions_receiver_id_registered", "receiver_id", "registered"),
+        Index("ix_transactions_registered", "registered"),
+        Index("ix_transactions_transaction_types_id", "transaction_types_id")
     )
 
     @property
@@ -286,6 +403,16 @@ class Transaction(Base):
         )
 
 
+# The number of transactions of a type is loaded together with the type as an aggregate,
+# so that each type (usually shared by many transactions) is counted once per session
+TransactionType.transaction_count = column_property(
+    select(func.count(Transaction.id))
+    .where(Transaction.transaction_types_id == TransactionType.id)
+    .correlate_except(Transaction)
+    .scalar_subquery()
+)
+
+
 class Consumable(Base):
     __tablename__ = "consumables"
 
@@ -367,6 +494,10 @@ class ConsumableMessage(Base):
         back_populates="messages"
     )
 
+    __table_args__ = (
+        Index("ix_consumables_messages_consumable_id", "consumable_id"),
+    )
+
     @property
     def schema(self) -> pydantic.constr(max_length=255):
         return self.message
@@ -429,6 +560,9 @@ class Refund(Base):
 
     __table_args__ = (
         CheckConstraint("amount > 0"),
+        Index("ix_refunds_creator_id_active", "creator_id", "active"),
+        Index("ix_refunds_active", "active"),
+        Index("ix_refunds_ballot_id", "ballot_id")
     )
 
     @property
@@ -535,6 +669,7 @@ class Vote(Base):
         CheckConstraint("vote <= 1"),
         CheckConstraint("vote >= -1"),
         UniqueConstraint("user_id", "ballot_id"),
+        Index("ix_votes_ballot_id", "ballot_id")
     )
 
     @property
@@ -602,6 +737,8 @@ class Communism(Base):
 
     __table_args__ = (
         CheckConstraint("amount >= 1"),
+        Index("ix_communisms_creator_id_active", "creator_id", "active"),
+        Index("ix_communisms_active", "active")
     )
 
     @property
@@ -613,7 +750,7 @@ class Communism(Base):
             creator=self.creator_id,
             active=self.active,
             externals=self.externals,
-            participants={u.users_id: u.quantity for u in self.participants}
+            participants={u.user_id: u.quantity for u in self.participants}
         )
 
     def __repr__(self) -> str:
@@ -642,9 +779,10 @@ class CommunismUsers(Base):
 
     user = relationship("User", backref="communisms")
 
-    __table_args = (
+    __table_args__ = (
         CheckConstraint("quantity >= 0"),
         UniqueConstraint("user_id", "communism_id"),
+        Index("ix_communisms_users_communism_id", "communism_id")
     )
 
     def __repr__(self) -> str:
@@ -690,3 +828,94 @@ class Callback(Base):
 
     def __repr__(self) -> str:
         return f"Callback(id={self.id}, base={self.base}, app_id={self.app_id})"
+
+
+class Version(Base):
+    __tablename__ = "versions"
+
+    model = Column(
+        String(255),
+        nullable=False,
+        primary_key=True
+    )
+    object_id = Column(
+        Integer,
+        nullable=False,
+        primary_key=True,
+        autoincrement=False
+    )
+    version = Column(
+        Integer,
+        nullable=False,
+        default=0
+    )
+
+    def __repr__(self) -> str:
+        return f"Version(model={self.model}, object_id={self.object_id}, version={self.version})"
+
+
+class Change(Base):
+    __tablename__ = "changes"
+
+    id = _make_id_column()
+
+    model = Column(
+        String(255),
+        nullable=False
+    )
+    object_id = Column(
+        Integer,
+        nullable=False
+    )
+    action = Column(
+        String(6),
+        nullable=False
+    )
+    timestamp = Column(
+        DateTime,
+        nullable=False,
+        server_default=func.now()
+    )
+
+    __table_args__ = (
+        CheckConstraint("action IN ('create', 'update', 'delete')"),
+        Index("ix_changes_model_id", "model", "id")
+    )
+
+    def __repr__(self) -> str:
+        return (
+            f"Change(id={self.id}, model={self.model}, "
+            f"object_id={self.object_id}, action={self.action})"
+        )
+
+
+def schema_loader_options(model: Type[Base]) -> List[LoaderOption]:
+    """
+    Return the loader options to eagerly load all relationships used by the model's schema
+
+    Building the schema of a model usually requires some of its relationships,
+    which would be loaded lazily with one query per instance and relationship
+    otherwise. Applying those options to the query of a list of instances
+    loads them with a constant number of queries instead.
+
+    :param model: class of a SQLAlchemy model
+    :return: list of loader options (which may be empty) to be applied to a query
+    """
+
+    if model is User:
+        return [selectinload(User.aliases).joinedload(UserAlias.app)]
+    if model is Application:
+        return [joinedload(Application.community_user_alias).joinedload(UserAlias.app)]
+    if model is UserAlias:
+        return [joinedload(UserAlias.app)]
+    if model is Transaction:
+        return [selectinload(Transaction.transaction_type)]
+    if model is Consumable:
+        return [selectinload(Consumable.messages)]
+    if model is Refund:
+        return [joinedload(Refund.ballot)]
+    if model is Ballot:
+        return [selectinload(Ballot.votes)]
+    if model is Communism:
+        return [selectinload(Communism.participants)]
+    return []
@@ -0,0 +1,737 @@
+"""
+MateBot core version tracking of the database models
+
+Every row of the tracked models has a version counter in the ``versions``
+table, which is incremented whenever the row is inserted, updated or deleted.
+The collection of a model has its own counter, which is incremented together
+with the counter of any of its rows. Rows of models embedding other rows in
+their schema (e.g. users and their aliases) are incremented together with
+the embedded rows as well. Furthermore, every change of a row is appended
+to the ``changes`` table, the change log, whose IDs serve as cursors for
+clients following the changes of the database.
+
+The entries of the change log are inserted right before the commit, so
+that their auto-incremented IDs are (nearly) in the order of the commits,
+without locking anything shared by concurrent transactions. A transaction
+which got its IDs but hasn't committed yet leaves a gap in the change log,
+though. Readers therefore only follow the change log up to the first gap
+(see ``get_cursor``), unless the gap is older than ``GAP_TIMEOUT``, which
+means the transaction has been rolled back. The change log may be pruned
+to its newest entries (see ``set_change_log_size`` and ``prune_changes``).
+
+Since every transaction would lock the same counter of a collection until
+its commit otherwise, the counter is split into stripes (using the object
+IDs ``0``, ``-1``, ``-2`` and so on). A transaction increments one randomly
+chosen stripe of every changed collection, while the version of the whole
+collection is the sum of all its stripes (reported using the object ID ``0``).
+
+The counters are maintained by an event listener of all ORM sessions, so
+they are part of the same transaction as the changes themselves. Changes
+which bypass the ORM (e.g. ``UPDATE`` statements using SQLAlchemy Core)
+need to call ``touch`` explicitly to increment the affected counters.
+
+The shards of the community user's balance are an exception: changing a
+shard must not lock any row shared by concurrent transactions, so it only
+appends the change of the user to the change log. Instead, every shard has
+its own version counter, which is incremented by the same statement that
+changes its balance. If the shards are enabled, their counters are part of
+the versions of the users and their collection (since there are only few).
+"""
+
+import random
+import datetime
+import itertools
+import weakref
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Type
+
+import sqlalchemy
+import sqlalchemy.exc
+from sqlalchemy import event
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.functions import FunctionElement
+
+from . import models
+
+
+# Object ID of the version counter of a whole model's collection
+COLLECTION = 0
+
+# Number of stripes of the version counter of a collection (see above)
+COLLECTION_STRIPES = 16
+
+# Number of seconds after which a gap in the IDs of the change log is assumed to be
+# caused by a rollback instead of a transaction which hasn't been committed yet
+GAP_TIMEOUT = 5.0
+
+# Upper bound of parameters in one IN clause, to respect the limits of old sqlite3 versions
+_MAX_IN_PARAMETERS = 500
+
+# Number of commits of this process after which the change log will be pruned again
+_PRUNE_INTERVAL = 100
+
+# Counter holding the ID of the latest entry removed from the change log
+_PRUNED = ("Change.pruned", COLLECTION)
+
+# Models whose rows embed rows of another model, with the name of the attribute
+# referencing the embedding row (changes of the rows propagate to those rows)
+_PARENTS: Dict[Type[models.Base], List[Tuple[Type[models.Base], str]]] = {
+    models.UserAlias: [(models.User, "user_id")],
+    models.ConsumableMessage: [(models.Consumable, "consumable_id")],
+    models.Vote: [(models.Ballot, "ballot_id")],
+    models.CommunismUsers: [(models.Communism, "communism_id")],
+    models.Transaction: [(models.TransactionType, "transaction_types_id")]
+}
+
+# Models whose rows are embedded in the schemas of a few rows of another model
+# referencing them by the given foreign key, which are looked up on changes (in
+# contrast to ``_REFERENCES``, the collections of both models stay independent)
+_REFERRERS = {
+    models.UserAlias: [(models.Application, models.Application.community_user_alias_id)]
+}
+
+# Models whose schemas contain data of rows of another model they reference by
+# foreign key (the versions of those rows are part of the version of a row)
+_REFERENCES = {
+    models.UserAlias: [(models.Application, models.UserAlias.app_id)],
+    models.Transaction: [(models.TransactionType, models.Transaction.transaction_types_id)],
+    models.Refund: [(models.Ballot, models.Refund.ballot_id)]
+}
+
+Key = Tuple[str, int]
+
+# Actions recorded in the change log, ordered by their precedence for the same row
+CREATE = "create"
+DELETE = "delete"
+UPDATE = "update"
+_PRECEDENCE = [CREATE, DELETE, UPDATE]
+
+# Key of the session's info dictionary marking uncommitted tracked changes
+_CHANGED = "tracking_changed"
+
+# Key of the session's info dictionary holding the change log entries written on commit
+_PENDING = "tracking_pending"
+
+# Key of the session's info dictionary holding the stripe of the current transaction
+_STRIPE = "tracking_stripe"
+
+_commit_listeners: List[Callable[[], None]] = []
+
+# Number of the newest entries kept in the change log (zero keeps all entries)
+_change_log_size = 0
+
+_commits = itertools.count(1)
+
+# Highest ID up to which the change log of a database is known to be complete
+_complete: "weakref.WeakKeyDictionary[sqlalchemy.engine.Engine, int]" = weakref.WeakKeyDictionary()
+
+
+class _Now(FunctionElement):
+    """
+    Current time of the database server when the statement is executed
+
+    PostgreSQL's ``CURRENT_TIMESTAMP`` is the start of the transaction instead.
+    """
+
+    type = sqlalchemy.DateTime()
+    inherit_cache = True
+
+
+@compiles(_Now)
+def _compile_now(*_, **__) -> str:
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(_Now, "postgresql")
+def _compile_now_postgresql(*_, **__) -> str:
+    return "CAST(clock_timestamp() AS TIMESTAMP WITHOUT TIME ZONE)"
+
+
+def _chunks(values: Iterable[int]) -> Iterable[List[int]]:
+    values = sorted(values)
+    for i in range(0, len(values), _MAX_IN_PARAMETERS):
+        yield values[i:i + _MAX_IN_PARAMETERS]
+
+
+def _group(keys: Iterable[Key]) -> Dict[str, Set[int]]:
+    grouped = {}
+    for name, object_id in keys:
+        grouped.setdefault(name, set()).add(object_id)
+    return grouped
+
+
+def _get_collection_names(model: Type[models.Base]) -> List[str]:
+    return [model.__name__, *[other.__name__ for other, _ in _REFERENCES.get(model, [])]]
+
+
+def _get_stripe(session: Session) -> int:
+    # A transaction always uses the same stripe, so that it doesn't lock
+    # multiple stripes of a collection and the lock order stays the same
+    if _STRIPE not in session.info:
+        session.info[_STRIPE] = -random.randrange(COLLECTION_STRIPES)
+    return session.info[_STRIPE]
+
+
+def _select_collections(names: Iterable[str]) -> sqlalchemy.sql.Select:
+    table = models.Version.__table__
+    return sqlalchemy.select(
+        table.c.model,
+        sqlalchemy.literal(COLLECTION).label("object_id"),
+        sqlalchemy.cast(sqlalchemy.func.sum(table.c.version), sqlalchemy.Integer).label("version")
+    ).where(
+        table.c.model.in_(sorted(names)),
+        table.c.object_id <= COLLECTION
+    ).group_by(table.c.model)
+
+
+def _get_upsert(connection: sqlalchemy.engine.Connection, table: sqlalchemy.Table):
+    """
+    Get an INSERT statement incrementing the version of already existing counters instead
+
+    Only sqlite3 (since 3.24), PostgreSQL and MySQL/MariaDB support such upserts,
+    ``None`` is returned for all other databases.
+    """
+
+    dialect = connection.dialect
+    if dialect.name == "sqlite" and (dialect.server_version_info or (0,)) >= (3, 24):
+        statement = sqlite_insert(table)
+        return statement.on_conflict_do_update(
+            index_elements=[table.c.model, table.c.object_id],
+            set_={"version": table.c.version + 1}
+        )
+    if dialect.name == "postgresql":
+        statement = postgresql_insert(table)
+        return statement.on_conflict_do_update(
+            index_elements=[table.c.model, table.c.object_id],
+            set_={"version": table.c.version + 1}
+        )
+    if dialect.name in ("mysql", "mariadb"):
+        return mysql_insert(table).on_duplicate_key_update(version=table.c.version + 1)
+    return None
+
+
+def _increment(connection: sqlalchemy.engine.Connection, keys: Set[Key]):
+    # The counters are always changed in the same order, so that concurrent
+    # transactions lock the rows in the same order and can't deadlock
+    table = models.Version.__table__
+    upsert = _get_upsert(connection, table)
+    for name, object_ids in sorted(_group(keys).items()):
+        if upsert is not None:
+            for chunk in _chunks(object_ids):
+                connection.execute(upsert, [
+                    {"model": name, "object_id": object_id, "version": 1} for object_id in chunk
+                ])
+            continue
+
+        for chunk in _chunks(object_ids):
+            existing = set(connection.execute(
+                sqlalchemy.select(table.c.object_id).where(
+                    table.c.model == name,
+                    table.c.object_id.in_(chunk)
+                )
+            ).scalars())
+            _update_versions(connection, name, existing)
+            for object_id in sorted(set(chunk) - existing):
+                # Another transaction may have inserted the counter in the meantime
+                try:
+                    with connection.begin_nested():
+                        connection.execute(
+                            sqlalchemy.insert(table),
+                            {"model": name, "object_id": object_id, "version": 1}
+                        )
+                except sqlalchemy.exc.IntegrityError:
+                    _update_versions(connection, name, {object_id})
+
+
+def _update_versions(connection: sqlalchemy.engine.Connection, name: str, object_ids: Set[int]):
+    if object_ids:
+        table = models.Version.__table__
+        connection.execute(
+            sqlalchemy.update(table).where(
+                table.c.model == name,
+                table.c.object_id.in_(sorted(object_ids))
+            ).values(version=table.c.version + 1)
+        )
+
+
+def _log(session: Session, actions: Dict[Key, str]):
+    session.info.setdefault(_PENDING, []).extend(
+        (name, object_id, action) for (name, object_id), action in sorted(actions.items())
+    )
+
+
+def touch(
+        session: Session,
+        model: Type[models.Base],
+        *object_ids: int,
+        action: str = UPDATE,
+        increment: bool = True
+):
+    """
+    Increment the version counters of the given rows of a model and log their changes
+
+    Use this function after changing rows without the ORM. The counters of the
+    rows embedding the given rows are not incremented, so they must be given, too.
+
+    :param session: database session which will be used to perform the changes
+    :param model: class of the changed rows' SQLAlchemy model
+    :param object_ids: IDs of the changed rows (may be empty to only touch the collection)
+    :param action: action recorded in the change log for the given rows
+    :param increment: whether to increment the counters (disable it when the versions
+        of the rows are derived from the changed data, e.g. the shards of a balance)
+    """
+
+    keys = {(model.__name__, object_id) for object_id in object_ids}
+    if keys:
+        _log(session, {key: action for key in keys})
+    if increment:
+        keys.add((model.__name__, _get_stripe(session)))
+        _increment(session.connection(), keys)
+    session.info[_CHANGED] = True
+
+
+def add_commit_listener(listener: Callable[[], None]):
+    """
+    Add a callable which will be called after every commit of tracked changes
+
+    Note that the listener will be called in the thread which committed the
+    session. It should return quickly and must not raise any exceptions.
+    """
+
+    _commit_listeners.append(listener)
+
+
+def remove_commit_listener(listener: Callable[[], None]):
+    """
+    Remove a callable previously added by ``add_commit_listener`` (if it's still present)
+    """
+
+    if listener in _commit_listeners:
+        _commit_listeners.remove(listener)
+
+
+def get_cursor(session: Session, cursor: int = 0) -> int:
+    """
+    Get the ID of the latest entry in the change log, up to which it's complete
+
+    The change log is complete up to an ID when all entries up to it have been
+    committed (or pruned), except for the gaps older than ``GAP_TIMEOUT``, which
+    are caused by rollbacks. A gap may also be caused by a transaction which is committed
+    right now, so the readers of the change log must not skip it too early.
+
+    :param session: database session which should be used to perform the query
+    :param cursor: ID of an entry up to which the change log is expected to be complete
+    :return: ID up to which the change log is complete (or zero if it's empty)
+    """
+
+    bind = session.get_bind()
+    known = _complete.get(bind, 0)
+    start = max(cursor, known)
+    table = models.Change.__table__
+    previous = table.alias("previous")
+    versions = models.Version.__table__
+    pruned = sqlalchemy.select(versions.c.version).where(
+        versions.c.model == _PRUNED[0],
+        versions.c.object_id == _PRUNED[1]
+    ).scalar_subquery()
+    after_gap = sqlalchemy.and_(
+        table.c.id > start + 1,
+        table.c.id - 1 > sqlalchemy.func.coalesce(pruned, 0),
+        ~sqlalchemy.exists().where(previous.c.id == table.c.id - 1)
+    )
+    latest = sqlalchemy.select(sqlalchemy.func.max(previous.c.id)).scalar_subquery()
+    statement = sqlalchemy.select(
+        table.c.id,
+        table.c.timestamp,
+        after_gap.label("after_gap"),
+        _Now().label("now")
+    ).where(
+        table.c.id > start,
+        sqlalchemy.or_(after_gap, table.c.id == latest)
+    ).order_by(table.c.id)
+
+    complete = start
+    for row in session.execute(statement):
+        if row.after_gap and row.timestamp > row.now - datetime.timedelta(seconds=GAP_TIMEOUT):
+            break
+        complete = row.id
+    # The given cursor isn't trusted, since it may be sent by clients
+    if start == known and complete > _complete.get(bind, 0):
+        _complete[bind] = complete
+    return complete
+
+
+def get_pruned(session: Session) -> int:
+    """
+    Get the ID of the latest entry which has been removed from the change log (or zero)
+    """
+
+    table = models.Version.__table__
+    return session.execute(sqlalchemy.select(table.c.version).where(
+        table.c.model == _PRUNED[0],
+        table.c.object_id == _PRUNED[1]
+    )).scalar() or 0
+
+
+def set_change_log_size(size: int):
+    """
+    Set the number of the newest entries kept in the change log (zero keeps all entries)
+
+    The change log will be pruned by every ``_PRUNE_INTERVAL``-th commit of this process.
+    """
+
+    global _change_log_size
+    _change_log_size = size
+
+
+def prune_changes(session: Session, size: int) -> int:
+    """
+    Remove all but the newest entries from the change log
+
+    The ID of the latest removed entry is stored, so that cursors pointing
+    before it can be detected (see ``get_pruned``). Don't remove entries
+    which might still be replayed by the clients (see the server config).
+
+    :param session: database session which will be used to perform the changes
+    :param size: number of the newest entries kept in the change log
+    :return: number of the removed entries
+    """
+
+    connection = session.connection()
+    table = models.Change.__table__
+    latest = connection.execute(sqlalchemy.select(sqlalchemy.func.max(table.c.id))).scalar()
+    bound = (latest or 0) - size
+    if bound <= get_pruned(session):
+        return 0
+
+    versions = models.Version.__table__
+    condition = sqlalchemy.and_(
+        versions.c.model == _PRUNED[0],
+        versions.c.object_id == _PRUNED[1],
+        versions.c.version < bound
+    )
+    update = sqlalchemy.update(versions).where(condition).values(version=bound)
+    if connection.execute(update).rowcount == 0:
+        # The counter doesn't exist yet or another transaction pruned the change log
+        try:
+            with connection.begin_nested():
+                connection.execute(sqlalchemy.insert(versions), {
+                    "model": _PRUNED[0],
+                    "object_id": _PRUNED[1],
+                    "version": bound
+                })
+        except sqlalchemy.exc.IntegrityError:
+            if connection.execute(update).rowcount == 0:
+                return 0
+    return connection.execute(sqlalchemy.delete(table).where(table.c.id <= bound)).rowcount
+
+
+def get_changes(
+        session: Session,
+        cursor: int,
+        limit: int,
+        names: Optional[List[str]] = None
+) -> List[models.Change]:
+    """
+    Get the entries of the change log after the given cursor in the order of their IDs
+
+    Only the entries up to the latest complete ID are returned (see ``get_cursor``).
+
+    :param session: database session which should be used to perform the query
+    :param cursor: ID of the last already known entry of the change log
+    :param limit: maximum number of entries to return
+    :param names: optional list of model names to restrict the entries to
+    :return: list of the change log entries
+    """
+
+    statement = sqlalchemy.select(models.Change).where(
+        models.Change.id > cursor,
+        models.Change.id <= get_cursor(session, cursor)
+    )
+    if names:
+        statement = statement.where(models.Change.model.in_(names))
+    return session.execute(statement.order_by(models.Change.id).limit(limit)).scalars().all()
+
+
+def get_model(name: str) -> Type[models.Base]:
+    """
+    Get the class of the SQLAlchemy model with the given name (as used in the change log)
+
+    :raises KeyError: when no such model exists
+    """
+
+    for mapper in models.Base.registry.mappers:
+        if mapper.class_.__name__ == name:
+            return mapper.class_
+    raise KeyError(name)
+
+
+def _select_shards(user_ids: Optional[Iterable[int]] = None) -> sqlalchemy.sql.Select:
+    table = models.CommunityShard.__table__
+    statement = sqlalchemy.select(
+        sqlalchemy.literal(models.CommunityShard.__name__).label("model"),
+        table.c.id.label("object_id"),
+        table.c.version
+    )
+    if user_ids is not None:
+        statement = statement.where(table.c.user_id.in_(sorted(user_ids)))
+    return statement
+
+
+def get_versions(
+        session: Session,
+        model: Type[models.Base],
+        object_id: Optional[int] = None
+) -> List[Tuple[str, int, int]]:
+    """
+    Get the version counters which determine the version of a row or a collection
+
+    The versions of the rows (or collections) referenced by a row (or collection)
+    will be included, too. Counters which don't exist yet are reported as zero.
+    The versions of the shards of users are included if they are enabled.
+
+    :param session: database session which should be used to perform the queries
+    :param model: class of a SQLAlchemy model
+    :param object_id: optional ID of a row (or the whole collection if omitted)
+    :return: sorted list of tuples of the model name, the object ID and the version
+    """
+
+    references = _REFERENCES.get(model, [])
+    if object_id is None:
+        keys = {(name, COLLECTION) for name in _get_collection_names(model)}
+    else:
+        keys = {(model.__name__, object_id)}
+    if object_id is not None and references:
+        row = session.execute(
+            sqlalchemy.select(*[column for _, column in references]).where(model.id == object_id)
+        ).first()
+        if row is not None:
+            keys.update(
+                (other.__name__, value)
+                for (other, _), value in zip(references, row) if value is not None
+            )
+
+    if object_id is None:
+        statement = _select_collections(name for name, _ in keys)
+    else:
+        table = models.Version.__table__
+        statement = sqlalchemy.select(table).where(sqlalchemy.or_(*[
+            sqlalchemy.and_(table.c.model == name, table.c.object_id == oid)
+            for name, oid in keys
+        ]))
+    found = {(row.model, row.object_id): row.version for row in session.execute(statement)}
+    if model is models.User and models.community_shards_enabled():
+        shards = _select_shards(None if object_id is None else [object_id])
+        for row in session.execute(shards):
+            keys.add((row.model, row.object_id))
+            found[(row.model, row.object_id)] = row.version
+    return sorted((name, oid, found.get((name, oid), 0)) for name, oid in keys)
+
+
+def _find_versions(session: Session, keys: Iterable[Key]) -> Dict[Key, int]:
+    table = models.Version.__table__
+    found = {}
+    for name, object_ids in sorted(_group(keys).items()):
+        for chunk in _chunks(object_ids):
+            found.update(
+                ((name, object_id), version)
+                for object_id, version in session.execute(
+                    sqlalchemy.select(table.c.object_id, table.c.version).where(
+                        table.c.model == name,
+                        table.c.object_id.in_(chunk)
+                    )
+                )
+            )
+    return found
+
+
+def get_row_versions(
+        session: Session,
+        model: Type[models.Base],
+        object_ids: Iterable[int]
+) -> List[Tuple[str, int, int]]:
+    """
+    Get the version counters of multiple rows of a model (without their references)
+
+    :param session: database session which should be used to perform the queries
+    :param model: class of a SQLAlchemy model
+    :param object_ids: IDs of the rows
+    :return: sorted list of tuples of the model name, the object ID and the version
+    """
+
+    keys = {(model.__name__, object_id) for object_id in object_ids}
+    found = _find_versions(session, keys)
+    return [(name, oid, found.get((name, oid), 0)) for name, oid in sorted(keys)]
+
+
+def get_changes_with_versions(
+        session: Session,
+        cursor: int,
+        limit: int
+) -> List[Tuple[models.Change, List[Tuple[str, int, int]]]]:
+    """
+    Get the entries of the change log after the cursor with the versions of their rows
+
+    The versions are those returned by ``get_versions`` for each row. The versions
+    of the rows themselves are joined to the entries, the versions of the referenced
+    rows are loaded with a few queries per model, independent of the number of entries.
+
+    :param session: database session which should be used to perform the queries
+    :param cursor: ID of the last already known entry of the change log
+    :param limit: maximum number of entries to return
+    :return: list of tuples of the change log entries and their versions
+    """
+
+    table = models.Version.__table__
+    rows = session.execute(
+        sqlalchemy.select(models.Change, table.c.version).outerjoin(table, sqlalchemy.and_(
+            table.c.model == models.Change.model,
+            table.c.object_id == models.Change.object_id
+        )).where(
+            models.Change.id > cursor,
+            models.Change.id <= get_cursor(session, cursor)
+        ).order_by(models.Change.id).limit(limit)
+    ).all()
+
+    references: Dict[Key, Set[Key]] = {}
+    for name, object_ids in sorted(_group((c.model, c.object_id) for c, _ in rows).items()):
+        model = get_model(name)
+        columns = [column for _, column in _REFERENCES.get(model, [])]
+        if not columns:
+            continue
+        for chunk in _chunks(object_ids):
+            for object_id, *values in session.execute(
+                sqlalchemy.select(model.id, *columns).where(model.id.in_(chunk))
+            ):
+                references[(name, object_id)] = {
+                    (other.__name__, value)
+                    for (other, _), value in zip(_REFERENCES[model], values) if value is not None
+                }
+    found = _find_versions(session, set().union(*references.values()))
+    user_ids = {c.object_id for c, _ in rows if c.model == models.User.__name__}
+    if user_ids and models.community_shards_enabled():
+        for row in session.execute(_select_shards(user_ids).add_columns(
+            models.CommunityShard.__table__.c.user_id
+        )):
+            references.setdefault((models.User.__name__, row.user_id), set()).add(
+                (row.model, row.object_id)
+            )
+            found[(row.model, row.object_id)] = row.version
+
+    return [
+        (change, sorted([
+            (change.model, change.object_id, version or 0),
+            *[
+                (name, oid, found.get((name, oid), 0))
+                for name, oid in references.get((change.model, change.object_id), ())
+            ]
+        ]))
+        for change, version in rows
+    ]
+
+
+def get_collection_versions(
+        session: Session,
+        all_models: Iterable[Type[models.Base]]
+) -> Dict[Type[models.Base], List[Tuple[str, int, int]]]:
+    """
+    Get the version counters of the collections of multiple models using one query
+
+    :param session: database session which should be used to perform the query
+    :param all_models: classes of SQLAlchemy models
+    :return: mapping of each model to its versions (see ``get_versions``)
+    """
+
+    names = {model: _get_collection_names(model) for model in all_models}
+    statement = _select_collections({name for n in names.values() for name in n})
+    if models.User in names and models.community_shards_enabled():
+        statement = sqlalchemy.union_all(statement, _select_shards())
+    found = {(row.model, row.object_id): row.version for row in session.execute(statement)}
+    shards = sorted(key for key in found if key[0] == models.CommunityShard.__name__)
+    return {
+        model: sorted([
+            *[(name, COLLECTION, found.get((name, COLLECTION), 0)) for name in model_names],
+            *[(name, oid, found[(name, oid)]) for name, oid in shards if model is models.User]
+        ])
+        for model, model_names in names.items()
+    }
+
+
+def _get_values(obj: models.Base, attribute: str) -> Set[int]:
+    history = sqlalchemy.inspect(obj).attrs[attribute].history
+    return {value for value in history.sum() if value is not None}
+
+
+@event.listens_for(Session, "after_flush")
+def _track_changes(session: Session, _):
+    actions = {}
+
+    def add(key: Key, action: str):
+        if key not in actions or _PRECEDENCE.index(action) < _PRECEDENCE.index(actions[key]):
+            actions[key] = action
+
+    changed = [(session.new, CREATE), (session.dirty, UPDATE), (session.deleted, DELETE)]
+    for objects, action in changed:
+        for obj in objects:
+            if isinstance(obj, (models.Version, models.Change)):
+                continue
+            if action == UPDATE and not session.is_modified(obj, include_collections=False):
+                continue
+            model = type(obj)
+            for object_id in _get_values(obj, "id"):
+                add((model.__name__, object_id), action)
+            for parent, attribute in _PARENTS.get(model, []):
+                for object_id in _get_values(obj, attribute):
+                    add((parent.__name__, object_id), UPDATE)
+
+    for model, referrers in _REFERRERS.items():
+        object_ids = [oid for (name, oid), _ in actions.items() if name == model.__name__]
+        for referrer, column in referrers:
+            for chunk in _chunks(object_ids):
+                for object_id in session.connection().execute(
+                    sqlalchemy.select(referrer.id).where(column.in_(chunk))
+                ).scalars():
+                    add((referrer.__name__, object_id), UPDATE)
+
+    if actions:
+        _log(session, actions)
+        keys = set(actions.keys())
+        keys.update((name, _get_stripe(session)) for name, _ in actions)
+        _increment(session.connection(), keys)
+        session.info[_CHANGED] = True
+
+
+@event.listens_for(Session, "before_commit")
+def _write_change_log(session: Session):
+    if session.in_nested_transaction():
+        return
+    session.flush()
+    pending = session.info.pop(_PENDING, None)
+    if pending:
+        session.connection().execute(
+            sqlalchemy.insert(models.Change.__table__).values(timestamp=_Now()),
+            [
+                {"model": name, "object_id": object_id, "action": action}
+                for name, object_id, action in pending
+            ]
+        )
+        if _change_log_size and next(_commits) % _PRUNE_INTERVAL == 0:
+            prune_changes(session, _change_log_size)
+
+
+@event.listens_for(Session, "after_commit")
+def _notify_listeners(session: Session):
+    session.info.pop(_STRIPE, None)
+    if session.info.pop(_CHANGED, False):
+        for listener in _commit_listeners:
+            listener()
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changes(session: Session):
+    session.info.pop(_CHANGED, None)
+    session.info.pop(_PENDING, None)
+    session.info.pop(_STRIPE, None)
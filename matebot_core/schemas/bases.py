@@ -10,6 +10,8 @@ from typing import List, Optional, Union
 
 import pydantic
 
+from .errors import APIError
+
 
 UUID_REGEX = r"^\b[0-9a-fA-F]{8}-([0-9a-fA-F]{4}-){3}[0-9a-fA-F]{12}\b$"
 
@@ -81,7 +83,7 @@ class Transaction(pydantic.BaseModel):
     receiver: pydantic.NonNegativeInt
     amount: pydantic.NonNegativeInt
     reason: Optional[pydantic.constr(max_length=255)]
-    transaction_type: TransactionType
+    transaction_type: Optional[TransactionType]
     timestamp: pydantic.NonNegativeInt
 
 
@@ -92,6 +94,16 @@ class TransactionCreation(pydantic.BaseModel):
     reason: pydantic.constr(max_length=255)
 
 
+class TransactionBatchCreation(pydantic.BaseModel):
+    transactions: pydantic.conlist(TransactionCreation, min_items=1, max_items=100)
+    atomic: bool = True
+
+
+class TransactionBatchResult(pydantic.BaseModel):
+    transaction: Optional[Transaction]
+    error: Optional[APIError]
+
+
 class Consumable(pydantic.BaseModel):
     id: pydantic.NonNegativeInt
     name: pydantic.constr(max_length=255)
@@ -2,7 +2,7 @@
 Special schemas for the configuration file and its properties
 """
 
-from typing import Dict
+from typing import Dict, List, Optional
 
 import pydantic
 
@@ -13,16 +13,51 @@ class GeneralConfig(pydantic.BaseModel):
     payment_consent: pydantic.PositiveInt = 2
     payment_denial: pydantic.PositiveInt = 2
     max_vouched: pydantic.PositiveInt = 3
+    community_shards: pydantic.NonNegativeInt = 0
+
+
+class CompressionConfig(pydantic.BaseModel):
+    enabled: bool = False
+    minimum_size: pydantic.NonNegativeInt = 1024
+    gzip_level: pydantic.conint(ge=1, le=9) = 6
+    brotli_quality: pydantic.conint(ge=0, le=11) = 4
+    precompress_static: bool = True
+    static_cache_directory: str = "static_cache"
+    static_max_age: pydantic.NonNegativeInt = 604800
 
 
 class ServerConfig(pydantic.BaseModel):
     host: str = "127.0.0.1"
     port: pydantic.conint(gt=0, lt=65536) = 8000
+    long_poll_timeout: pydantic.PositiveFloat = 60.0
+    long_poll_interval: pydantic.PositiveFloat = 5.0
+    event_replay_limit: pydantic.PositiveInt = 1000
+    change_log_size: pydantic.NonNegativeInt = 100000
+    compression: CompressionConfig = CompressionConfig()
+
+
+class SQLiteProfile(pydantic.BaseModel):
+    journal_mode: pydantic.constr(regex=r"^(DELETE|TRUNCATE|PERSIST|MEMORY|WAL|OFF)$") = "WAL"
+    synchronous: pydantic.constr(regex=r"^(OFF|NORMAL|FULL|EXTRA)$") = "NORMAL"
+    mmap_size: pydantic.NonNegativeInt = 268435456
+    cache_size: int = -65536
+    temp_store: pydantic.constr(regex=r"^(DEFAULT|FILE|MEMORY)$") = "MEMORY"
+    busy_timeout: pydantic.NonNegativeInt = 5000
 
 
 class DatabaseConfig(pydantic.BaseModel):
     connection: str = "sqlite://"
     echo: bool = True
+    pool_size: pydantic.PositiveInt = 5
+    max_overflow: pydantic.conint(ge=-1) = 10
+    pool_timeout: pydantic.PositiveFloat = 30.0
+    pool_recycle: int = -1
+    pool_pre_ping: bool = False
+    sqlite_profile: Optional[SQLiteProfile] = None
+    replicas: List[str] = []
+    replica_check_interval: pydantic.PositiveFloat = 10.0
+    asyncio: bool = False
+    async_connection: Optional[str] = None
 
 
 class LoggingConfig(pydantic.BaseModel):
@@ -1,14 +1,14 @@
 """
 MateBot extra schemas
 
-This module contains the special schemas for updates and the status.
+This module contains the special schemas for updates, changes, the status and metrics.
 """
 
 import sys
 import time
 import uuid
 import datetime
-from typing import Optional
+from typing import Any, Dict, List, Optional
 
 import pydantic
 
@@ -26,15 +26,50 @@ class Updates(pydantic.BaseModel):
     transactions: uuid.UUID
     users: uuid.UUID
     votes: uuid.UUID
+    cursor: pydantic.NonNegativeInt = 0
     timestamp: pydantic.NonNegativeInt
 
 
+class Change(pydantic.BaseModel):
+    id: pydantic.NonNegativeInt
+    model: pydantic.constr(max_length=255)
+    object_id: pydantic.NonNegativeInt
+    action: pydantic.constr(regex=r"^(create|update|delete)$")
+    data: Optional[Dict[str, Any]]
+
+
+class Changes(pydantic.BaseModel):
+    changes: List[Change]
+    cursor: pydantic.NonNegativeInt
+    more: bool
+
+
 class VersionInfo(pydantic.BaseModel):
     major: pydantic.NonNegativeInt
     minor: pydantic.NonNegativeInt
     micro: pydantic.NonNegativeInt
 
 
+class PoolStatus(pydantic.BaseModel):
+    name: str
+    pool_class: str
+    size: pydantic.NonNegativeInt
+    connections: int
+    checked_out: int
+    idle: pydantic.NonNegativeInt
+    overflow: pydantic.NonNegativeInt
+    checkouts: pydantic.NonNegativeInt
+    timeouts: pydantic.NonNegativeInt
+    wait_time_total: pydantic.NonNegativeFloat
+    wait_time_max: pydantic.NonNegativeFloat
+    wait_time_average: pydantic.NonNegativeFloat
+
+
+class Metrics(pydantic.BaseModel):
+    pools: List[PoolStatus]
+    timestamp: pydantic.NonNegativeInt
+
+
 class Status(pydantic.BaseModel):
     healthy: bool
     startup: pydantic.NonNegativeInt = int(datetime.datetime.now().timestamp())
@@ -48,6 +83,7 @@ class Status(pydantic.BaseModel):
     timezone: str = time.localtime().tm_zone
     localtime: datetime.datetime
     timestamp: pydantic.NonNegativeInt
+    pools: List[PoolStatus] = []
 
 
 class Callback(pydantic.BaseModel):
@@ -42,7 +42,12 @@ setuptools.setup(
     extra_requires={
         "full": [
             "aiofiles>=0.7",
+            "cbor2>=5.0",
+            "msgpack>=1.0",
             "ujson>=4.0"
+        ],
+        "asyncio": [
+            "aiosqlite>=0.17"
         ]
     },
     project_urls={},
@@ -2,21 +2,44 @@
 MateBot unit tests for the whole API in certain user actions
 """
 
+import io
 import os
+import asyncio
+import csv
+import gzip
+import time
+import datetime
 import errno
 import random
+import socket
 import threading
+import concurrent.futures
 import http.server
+import json
+import tempfile
 import unittest as _unittest
-from typing import Iterable, List, Mapping, Optional, Tuple, Type, Union
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple, Type, Union
 
 import uvicorn
 import pydantic
 import requests
+import sqlalchemy
 
-from matebot_core import settings as _settings
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from matebot_core import schemas, settings as _settings
 from matebot_core.schemas import config as _config
+from matebot_core.api import compression, helpers, negotiation, notifier
 from matebot_core.api.api import create_app
+from matebot_core.persistence import database, models, tracking
 
 from . import conf, utils
 
@@ -102,14 +125,22 @@ class _BaseAPITests(utils.BaseTest):
 
         return response
 
+    def configure(self, config: _config.CoreConfig):
+        """
+        Adjust the configuration of the server before it's started
+        """
+
     def setUp(self) -> None:
         super().setUp()
-        self.server_port = random.randint(10000, 64000)
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.server_port = sock.getsockname()[1]
 
         config = _config.CoreConfig(**_settings._get_default_config())
         config.database.echo = conf.SQLALCHEMY_ECHOING
         config.database.connection = self.database_url
         config.server.port = self.server_port
+        self.configure(config)
         with open("config.json", "w") as f:
             f.write(config.json())
 
@@ -166,6 +197,989 @@ class WorkingAPITests(_BaseAPITests):
         )
         self.assertQuery(("GET", "/openapi.json"), r_headers={"Content-Type": "application/json"})
 
+    def test_pool_metrics(self):
+        status = self.assertQuery(("GET", "/status"), r_schema=schemas.Status).json()
+        self.assertEqual(["primary"], [pool["name"] for pool in status["pools"]])
+
+        for _ in range(3):
+            self.assertQuery(("GET", "/users"))
+        metrics = self.assertQuery(("GET", "/metrics"), r_schema=schemas.Metrics).json()
+        primary = metrics["pools"][0]
+        self.assertEqual("primary", primary["name"])
+        self.assertGreaterEqual(primary["checkouts"], 3)
+        self.assertEqual(0, primary["timeouts"])
+        self.assertGreaterEqual(primary["wait_time_max"], primary["wait_time_average"])
+
+    def test_version_etags(self):
+        collection_tag = self.assertQuery(("GET", "/users"), r_headers=["ETag"]).headers["ETag"]
+        self.assertEqual(collection_tag, self.assertQuery(("GET", "/users")).headers["ETag"])
+        self.assertEqual(
+            collection_tag.strip('"'),
+            self.assertQuery(("GET", "/updates")).json()["users"]
+        )
+
+        user = self.assertQuery(
+            ("POST", "/users"),
+            201,
+            json={"name": "user", "permission": True, "external": False},
+            r_headers=["ETag"]
+        )
+        row_tag = user.headers["ETag"]
+        self.assertEqual(row_tag, self.assertQuery(("GET", "/users/1")).headers["ETag"])
+        self.assertQuery(("GET", "/users/2"), 404)
+
+        new_collection_tag = self.assertQuery(("GET", "/users")).headers["ETag"]
+        self.assertNotEqual(collection_tag, new_collection_tag)
+
+    def test_if_none_match(self):
+        tag = self.assertQuery(("GET", "/users"), r_headers=["ETag"]).headers["ETag"]
+        response = self.assertQuery(
+            ("GET", "/users"),
+            304,
+            headers={"If-None-Match": tag},
+            r_headers={"ETag": tag}
+        )
+        self.assertEqual(b"", response.content)
+        self.assertQuery(("GET", "/users"), 304, headers={"If-None-Match": f'"foo", W/{tag}'})
+        self.assertQuery(("GET", "/users"), 304, headers={"If-None-Match": "*"})
+        self.assertQuery(("GET", "/users"), 200, headers={"If-None-Match": '"foo"'})
+
+        self.assertQuery(
+            ("POST", "/users"),
+            201,
+            json={"name": "user", "permission": True, "external": False},
+            headers={"If-None-Match": tag}
+        )
+        self.assertQuery(("GET", "/users"), 200, headers={"If-None-Match": tag})
+        user_tag = self.assertQuery(("GET", "/users/1")).headers["ETag"]
+        self.assertQuery(("GET", "/users/1"), 304, headers={"If-None-Match": user_tag})
+
+        # The wildcard only matches existing rows
+        self.assertQuery(("GET", "/users/1"), 304, headers={"If-None-Match": "*"})
+        self.assertQuery(("GET", "/users/999"), 404, headers={"If-None-Match": "*"})
+        self.assertQuery(("GET", "/users/999?fields=name"), 404, headers={"If-None-Match": "*"})
+
+    def test_long_polling_updates(self):
+        updates = self.assertQuery(("GET", "/updates"), r_schema=schemas.Updates).json()
+        cursor = updates["cursor"]
+
+        start = time.monotonic()
+        unchanged = self.assertQuery(("GET", f"/updates?cursor={cursor}&timeout=0.5")).json()
+        self.assertGreaterEqual(time.monotonic() - start, 0.5)
+        self.assertEqual(updates["users"], unchanged["users"])
+        self.assertEqual(cursor, unchanged["cursor"])
+
+        def create_user():
+            time.sleep(0.2)
+            self.assertQuery(
+                ("POST", "/users"),
+                201,
+                json={"name": "user", "permission": True, "external": False}
+            )
+
+        thread = threading.Thread(target=create_user, daemon=True)
+        thread.start()
+        start = time.monotonic()
+        changed = self.assertQuery(("GET", f"/updates?cursor={cursor}&timeout=30")).json()
+        self.assertLess(time.monotonic() - start, 4)
+        self.assertGreater(changed["cursor"], cursor)
+        self.assertNotEqual(updates["users"], changed["users"])
+        self.assertEqual(updates["votes"], changed["votes"])
+        thread.join()
+
+    def test_server_sent_events(self):
+        def read_events(headers: dict, count: int) -> List[Tuple[str, str, dict]]:
+            events = []
+            url = self.server + "events"
+            with requests.get(url, headers=headers, stream=True, timeout=10) as r:
+                self.assertEqual(200, r.status_code)
+                self.assertTrue(r.headers["Content-Type"].startswith("text/event-stream"))
+                fields = {}
+                for line in r.iter_lines(decode_unicode=True):
+                    if line and not line.startswith(":"):
+                        key, value = line.split(": ", 1)
+                        fields[key] = value
+                    elif not line and "event" in fields:
+                        events.append((fields["id"], fields["event"], json.loads(fields["data"])))
+                        fields = {}
+                        if len(events) == count:
+                            break
+            return events
+
+        cursor = self.assertQuery(("GET", "/updates")).json()["cursor"]
+
+        def create_user():
+            time.sleep(0.3)
+            self.assertQuery(
+                ("POST", "/users"),
+                201,
+                json={"name": "user", "permission": True, "external": False}
+            )
+
+        thread = threading.Thread(target=create_user, daemon=True)
+        thread.start()
+        (event_id, event, data), = read_events({}, 1)
+        thread.join()
+        self.assertEqual("create", event)
+        self.assertEqual({"model": "User", "object_id": 1, "action": "create"}, {
+            k: v for k, v in data.items() if k != "etag"
+        })
+        self.assertEqual(
+            self.assertQuery(("GET", "/users/1")).headers["ETag"].strip('"'),
+            data["etag"]
+        )
+
+        # Replaying the events after a known event ID and resetting unknown IDs
+        replayed = read_events({"Last-Event-ID": str(cursor)}, 1)
+        self.assertEqual([(event_id, event, data)], replayed)
+        reset = read_events({"Last-Event-ID": str(int(event_id) + 1000)}, 1)
+        self.assertEqual([(event_id, "reset", {"cursor": int(event_id)})], reset)
+
+        # Events which have been removed from the change log can't be replayed
+        session = database.get_new_session()
+        tracking.prune_changes(session, 0)
+        session.commit()
+        session.close()
+        reset = read_events({"Last-Event-ID": str(cursor)}, 1)
+        self.assertEqual([(event_id, "reset", {"cursor": int(event_id)})], reset)
+
+    def test_event_feed(self):
+        reads = []
+        log = [{"id": i} for i in range(1, 8)]
+
+        def read(cursor: int) -> List[dict]:
+            reads.append(cursor)
+            return [event for event in log if event["id"] > cursor][:2]
+
+        async def run():
+            broadcast = notifier.Notifier(recheck_interval=0.05)
+            feed = notifier.EventFeed(broadcast, read, lambda: 3, 2, buffer_size=1)
+            try:
+                fast, slow = await feed.subscribe(), await feed.subscribe()
+                self.assertEqual(3, fast.position)
+                received = []
+                while len(received) < 4:
+                    received.extend(await asyncio.wait_for(fast.queue.get(), 1))
+                self.assertEqual(log[3:], received)
+
+                # The pages are read once for all clients, slow clients are dropped
+                self.assertEqual([3, 5, 7], reads[:3])
+                self.assertTrue(slow.overflowed)
+                self.assertEqual(log[3:5], slow.queue.get_nowait())
+                self.assertFalse(fast.overflowed)
+                feed.unsubscribe(fast)
+            finally:
+                broadcast.close()
+
+        asyncio.run(run())
+
+    def test_changes_feed(self):
+        empty = self.assertQuery(("GET", "/changes"), r_schema=schemas.Changes).json()
+        self.assertEqual({"changes": [], "cursor": 0, "more": False}, empty)
+
+        for i in range(3):
+            self.assertQuery(
+                ("POST", "/users"),
+                201,
+                json={"name": f"user{i}", "permission": True, "external": False}
+            )
+        users = self.assertQuery(("GET", "/users")).json()
+
+        first = self.assertQuery(("GET", "/changes?limit=2"), r_schema=schemas.Changes).json()
+        self.assertTrue(first["more"])
+        self.assertEqual([1, 2], [c["object_id"] for c in first["changes"]])
+        self.assertEqual(users[:2], [c["data"] for c in first["changes"]])
+        self.assertEqual({"create"}, {c["action"] for c in first["changes"]})
+
+        second = self.assertQuery(("GET", f"/changes?limit=2&cursor={first['cursor']}")).json()
+        self.assertFalse(second["more"])
+        self.assertEqual([users[2]], [c["data"] for c in second["changes"]])
+        last = self.assertQuery(("GET", f"/changes?cursor={second['cursor']}")).json()
+        self.assertEqual({"changes": [], "cursor": second["cursor"], "more": False}, last)
+
+        self.assertEqual([], self.assertQuery(("GET", "/changes?model=Vote")).json()["changes"])
+        self.assertEqual(3, len(self.assertQuery(("GET", "/changes?model=User")).json()["changes"]))
+        self.assertQuery(("GET", "/changes?model=Foo"), 400)
+
+        # Clients whose cursor points before the pruned entries need to reload their data
+        session = database.get_new_session()
+        self.assertEqual(2, tracking.prune_changes(session, 1))
+        session.commit()
+        session.close()
+        self.assertQuery(("GET", "/changes"), 400)
+        self.assertQuery(("GET", f"/changes?cursor={first['cursor']}"))
+        latest = self.assertQuery(("GET", f"/changes?cursor={last['cursor']}")).json()
+        self.assertEqual(last, latest)
+
+    def test_keyset_pagination(self):
+        for i in range(2):
+            self.assertQuery(
+                ("POST", "/users"),
+                201,
+                json={"name": f"user{i}", "permission": True, "external": False}
+            )
+        session = database.get_new_session()
+        session.add_all([
+            models.Refund(
+                amount=i + 1,
+                description=f"refund{i}",
+                creator_id=1 + i % 2,
+                ballot=models.Ballot(question=f"refund{i}", restricted=False)
+            )
+            for i in range(5)
+        ])
+        session.commit()
+        session.close()
+        everything = self.assertQuery(("GET", "/refunds")).json()
+        self.assertEqual(5, len(everything))
+
+        def link(response: requests.Response, rel: str) -> str:
+            self.assertTrue(response.links[rel]["url"].startswith(self.server))
+            return response.links[rel]["url"][len(self.server):]
+
+        first = self.assertQuery(("GET", "/refunds?limit=2"), r_headers=["ETag", "Link"])
+        self.assertEqual(everything[:2], first.json())
+        self.assertEqual(["next"], list(first.links.keys()))
+        second = self.assertQuery(("GET", link(first, "next")), r_headers=["Link"])
+        self.assertEqual(everything[2:4], second.json())
+        self.assertEqual({"next", "prev"}, set(second.links.keys()))
+        self.assertNotEqual(first.headers["ETag"], second.headers["ETag"])
+        third = self.assertQuery(("GET", link(second, "next")))
+        self.assertEqual(everything[4:], third.json())
+        self.assertEqual(["prev"], list(third.links.keys()))
+
+        previous = self.assertQuery(("GET", link(third, "prev")))
+        self.assertEqual(everything[2:4], previous.json())
+        self.assertQuery(
+            ("GET", "/refunds?limit=2"),
+            304,
+            headers={"If-None-Match": first.headers["ETag"]}
+        )
+        self.assertEqual(everything[1:3], self.assertQuery(
+            ("GET", "/refunds?after_id=1&before_id=4")
+        ).json())
+        self.assertQuery(("GET", "/refunds?limit=0"), 422)
+
+    def test_filtering_and_sorting(self):
+        for i in range(3):
+            self.assertQuery(
+                ("POST", "/users"),
+                201,
+                json={"name": f"user{i}", "permission": i != 0, "external": False}
+            )
+        session = database.get_new_session()
+        session.add_all([
+            models.Refund(
+                amount=10 * (i % 4 + 1),
+                description=f"refund{i}",
+                creator_id=1 + i % 3,
+                active=i < 4,
+                ballot=models.Ballot(question=f"refund{i}", restricted=False)
+            )
+            for i in range(6)
+        ])
+        session.commit()
+        session.close()
+        everything = self.assertQuery(("GET", "/refunds")).json()
+        self.assertEqual(6, len(everything))
+
+        def query(params: str) -> List[int]:
+            return [r["id"] for r in self.assertQuery(("GET", f"/refunds?{params}")).json()]
+
+        self.assertEqual([1, 4], query("creator=1"))
+        self.assertEqual([2, 3, 5, 6], query("creator__ne=1"))
+        self.assertEqual([3, 4], query("amount__ge=30"))
+        self.assertEqual([2, 6], query("amount__gt=10&amount__lt=30"))
+        self.assertEqual([1, 3, 4, 6], query("creator__in=1,3"))
+        self.assertEqual([5, 6], query("active=false"))
+        self.assertEqual([4, 3, 2, 6, 1, 5], query("sort=-amount"))
+        self.assertEqual([6, 3, 5, 2, 1, 4], query("sort=-creator,amount"))
+        self.assertEqual([1, 2, 3, 4, 5, 6], query("sort=id&foo=bar"))
+        self.assertEqual(everything[2:4], self.assertQuery(
+            ("GET", "/refunds?amount__in=30,40&active=true")
+        ).json())
+
+        filtered = self.assertQuery(("GET", "/refunds?creator=1"), r_headers=["ETag"])
+        self.assertNotEqual(
+            filtered.headers["ETag"],
+            self.assertQuery(("GET", "/refunds?creator=2")).headers["ETag"]
+        )
+        self.assertQuery(
+            ("GET", "/refunds?creator=1"),
+            304,
+            headers={"If-None-Match": filtered.headers["ETag"]}
+        )
+        self.assertEqual([2, 3], query("amount__ge=20&limit=2"))
+
+        self.assertEqual([3, 2], [u["id"] for u in self.assertQuery(
+            ("GET", "/users?permission=true&sort=-id&id__le=3")
+        ).json()])
+
+        for params in [
+            "amount=foo", "amount__foo=1", "description__ge=a", "sort=description",
+            "active__ge=1", "active=maybe", "creator__in=", "sort=-amount&limit=2",
+            "sort=creator&after_id=1"
+        ]:
+            self.assertQuery(("GET", f"/refunds?{params}"), 400)
+
+        operation = self.assertQuery(("GET", "/openapi.json")).json()["paths"]["/refunds"]["get"]
+        names = [p["name"] for p in operation["parameters"]]
+        self.assertEqual(len(names), len(set(names)))
+        for name in ["id", "amount", "creator", "active", "ballot", "sort", "limit", "fields"]:
+            self.assertIn(name, names)
+        self.assertNotIn("epoch", operation["description"])
+        descriptions = [p.get("description", "") for p in operation["parameters"]]
+        self.assertFalse([d for d in descriptions if "epoch" in d])
+
+        paths = self.assertQuery(("GET", "/openapi.json")).json()["paths"]
+        parameters = {p["name"]: p for p in paths["/transactions"]["get"]["parameters"]}
+        self.assertIn("seconds since the epoch", parameters["timestamp"]["description"])
+        self.assertNotIn("epoch", parameters["amount"]["description"])
+
+    def test_transaction_export(self):
+        for i in range(2):
+            self.assertQuery(
+                ("POST", "/users"),
+                201,
+                json={"name": f"user{i}", "permission": True, "external": False}
+            )
+        session = database.get_new_session()
+        transaction_type = models.TransactionType(name="communism")
+        session.add_all([
+            models.Transaction(
+                sender_id=1 + i % 2,
+                receiver_id=2 - i % 2,
+                amount=i + 1,
+                reason=f"reason, number {i}",
+                registered=datetime.datetime.fromtimestamp(1640995200 + 86400 * i),
+                transaction_type=transaction_type if i == 3 else None
+            )
+            for i in range(5)
+        ])
+        session.commit()
+        session.close()
+
+        response = self.assertQuery(
+            ("GET", "/transactions/export"),
+            r_headers={"Content-Type": "application/x-ndjson"}
+        )
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual(list(range(1, 6)), [row["amount"] for row in rows])
+        self.assertEqual(1640995200 + 86400, rows[1]["timestamp"])
+        types = [row["transaction_type"] for row in rows]
+        self.assertEqual([None, None, None, "communism", None], types)
+
+        response = self.assertQuery(
+            ("GET", "/transactions/export?format=csv&since=1641081600&until=1641254400"),
+            r_headers=["Content-Disposition"]
+        )
+        self.assertTrue(response.headers["Content-Type"].startswith("text/csv"))
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        self.assertEqual(["2", "3"], [row["amount"] for row in rows])
+        self.assertEqual("reason, number 1", rows[0]["reason"])
+
+        empty = self.assertQuery(("GET", "/transactions/export?since=1700000000"))
+        self.assertEqual("", empty.text)
+        self.assertQuery(("GET", "/transactions/export?since=1641081600&until=1641081600"), 400)
+        self.assertQuery(("GET", "/transactions/export?format=xml"), 422)
+
+    def test_sparse_fieldsets(self):
+        for i in range(3):
+            self.assertQuery(
+                ("POST", "/users"),
+                201,
+                json={"name": f"user{i}", "permission": True, "external": False}
+            )
+        users = self.assertQuery(("GET", "/users"), r_headers=["ETag"])
+
+        balances = self.assertQuery(("GET", "/users?fields=balance"), r_headers=["ETag"])
+        self.assertEqual(
+            [{"id": u["id"], "balance": u["balance"]} for u in users.json()],
+            balances.json()
+        )
+        self.assertNotEqual(users.headers["ETag"], balances.headers["ETag"])
+        self.assertEqual(
+            [{"id": 2, "name": "user1", "active": True}],
+            self.assertQuery(("GET", "/users?fields=active,name&id=2")).json()
+        )
+        self.assertEqual(
+            {"id": 3, "aliases": []},
+            self.assertQuery(("GET", "/users/3?fields=aliases")).json()
+        )
+        self.assertEqual(users.json()[0], self.assertQuery(("GET", "/users/1")).json())
+        self.assertQuery(
+            ("GET", "/users?fields=balance"),
+            304,
+            headers={"If-None-Match": balances.headers["ETag"]}
+        )
+
+        self.assertQuery(("GET", "/users?fields=password"), 400)
+        self.assertQuery(("GET", "/users/1?fields=balance,password"), 400)
+        self.assertQuery(("GET", "/users/42?fields=balance"), 404)
+        self.assertEqual([], self.assertQuery(("GET", "/consumables?fields=stock")).json())
+
+    def test_transactions_of_user(self):
+        for i in range(3):
+            self.assertQuery(
+                ("POST", "/users"),
+                201,
+                json={"name": f"user{i}", "permission": True, "external": False}
+            )
+
+        def add_transactions(*pairs: Tuple[int, int]):
+            session = database.get_new_session()
+            for sender, receiver in pairs:
+                number = session.query(models.Transaction).count()
+                session.add(models.Transaction(
+                    sender_id=sender,
+                    receiver_id=receiver,
+                    amount=number + 1,
+                    reason=f"reason {number}",
+                    registered=datetime.datetime.fromtimestamp(1640995200 + 86400 * number)
+                ))
+                session.commit()
+            session.close()
+
+        add_transactions((1, 2), (2, 3), (3, 1), (2, 1), (3, 2), (1, 3))
+        everything = self.assertQuery(("GET", "/transactions")).json()
+
+        def ids(path: str) -> List[int]:
+            return [t["id"] for t in self.assertQuery(("GET", path)).json()]
+
+        self.assertEqual([1, 3, 4, 6], ids("/transactions/user/1"))
+        self.assertEqual([1, 2, 4, 5], ids("/transactions/user/2"))
+        self.assertEqual(
+            [t for t in everything if 3 in (t["sender"], t["receiver"])],
+            self.assertQuery(("GET", "/transactions/user/3")).json()
+        )
+        self.assertEqual([3, 4], ids("/transactions/user/1?since=1641081600&until=1641340800"))
+        self.assertEqual([4, 6], ids("/transactions/user/1?since=1641254400"))
+
+        first = self.assertQuery(("GET", "/transactions/user/1?limit=3"), r_headers=["Link"])
+        self.assertEqual([1, 3, 4], [t["id"] for t in first.json()])
+        self.assertEqual(["next"], list(first.links.keys()))
+        self.assertEqual([6], ids("/transactions/user/1?limit=3&after_id=4"))
+        self.assertEqual([3, 4], ids("/transactions/user/1?limit=2&before_id=6"))
+        self.assertEqual(
+            [{"id": 1, "amount": 1}, {"id": 3, "amount": 3}],
+            self.assertQuery(("GET", "/transactions/user/1?limit=2&fields=amount")).json()
+        )
+
+        tags = {
+            user_id: self.assertQuery(
+                ("GET", f"/transactions/user/{user_id}"), r_headers=["ETag"]
+            ).headers["ETag"]
+            for user_id in (1, 2)
+        }
+        self.assertNotEqual(tags[1], tags[2])
+
+        # New transactions of other users don't change the list
+        session = database.get_new_session()
+        session.add(models.Transaction(sender_id=2, receiver_id=3, amount=7, reason="reason 6"))
+        session.commit()
+        statements = []
+
+        def record(*args):
+            statements.append(args[2])
+
+        sqlalchemy.event.listen(database.get_engine(), "before_cursor_execute", record)
+        try:
+            self.assertQuery(
+                ("GET", "/transactions/user/1"),
+                304,
+                headers={"If-None-Match": tags[1]}
+            )
+        finally:
+            sqlalchemy.event.remove(database.get_engine(), "before_cursor_execute", record)
+        self.assertTrue(statements)
+        self.assertFalse([statement for statement in statements if "UNION" in statement])
+        tags[2] = self.assertQuery(
+            ("GET", "/transactions/user/2"), headers={"If-None-Match": tags[2]}
+        ).headers["ETag"]
+        self.assertEqual([1, 2, 4, 5, 7], ids("/transactions/user/2"))
+
+        # Typed transactions embed the number of transactions of their type
+        session.add(models.Transaction(
+            sender_id=3,
+            receiver_id=2,
+            amount=8,
+            reason="reason 7",
+            transaction_type=models.TransactionType(name="other")
+        ))
+        session.commit()
+        session.close()
+        self.assertQuery(("GET", "/transactions/user/2"), headers={"If-None-Match": tags[2]})
+        self.assertEqual([1, 2, 4, 5, 7, 8], ids("/transactions/user/2"))
+
+        self.assertQuery(("GET", "/transactions/user/42"), 404)
+        self.assertQuery(("GET", "/transactions/user/1?since=1641081600&until=1641081600"), 400)
+
+    def test_transaction_batches(self):
+        for i in range(3):
+            self.assertQuery(
+                ("POST", "/users"),
+                201,
+                json={"name": f"user{i}", "permission": True, "external": False}
+            )
+
+        def batch(*transactions: Tuple[int, int, int], atomic: bool = True, status: int = 201):
+            return self.assertQuery(
+                ("POST", "/transactions/batch"),
+                status,
+                json={
+                    "transactions": [
+                        {"sender": s, "receiver": r, "amount": a, "reason": f"tab {i}"}
+                        for i, (s, r, a) in enumerate(transactions)
+                    ],
+                    "atomic": atomic
+                }
+            ).json()
+
+        results = batch((1, 2, 5), (3, 2, 7), (1, 3, 2))
+        self.assertEqual([None] * 3, [r["error"] for r in results])
+        self.assertEqual([1, 2, 3], [r["transaction"]["id"] for r in results])
+        self.assertEqual("tab 1", results[1]["transaction"]["reason"])
+        self.assertEqual(
+            [r["transaction"] for r in results],
+            self.assertQuery(("GET", "/transactions")).json()
+        )
+        balances = [u["balance"] for u in self.assertQuery(("GET", "/users")).json()]
+        self.assertEqual([-7, 12, -5], balances)
+
+        error = self.assertQuery(
+            ("POST", "/transactions/batch"),
+            404,
+            json={"transactions": [
+                {"sender": 1, "receiver": 2, "amount": 1, "reason": "ok"},
+                {"sender": 1, "receiver": 42, "amount": 1, "reason": "unknown"}
+            ]}
+        ).json()
+        self.assertTrue(error["details"].startswith("transactions[1]"))
+        self.assertEqual(409, batch((2, 2, 1), status=409)["status"])
+        self.assertEqual(3, len(self.assertQuery(("GET", "/transactions")).json()))
+
+        results = batch((2, 1, 4), (1, 1, 1), (3, 42, 1), (2, 3, 1), atomic=False)
+        self.assertEqual([4, None, None, 5], [(r["transaction"] or {}).get("id") for r in results])
+        errors = [(r["error"] or {}).get("status") for r in results]
+        self.assertEqual([None, 409, 404, None], errors)
+        balances = [u["balance"] for u in self.assertQuery(("GET", "/users")).json()]
+        self.assertEqual([-3, 7, -4], balances)
+
+        results = batch((1, 42, 1), atomic=False)
+        self.assertEqual(404, results[0]["error"]["status"])
+        single = self.assertQuery(
+            ("POST", "/transactions"),
+            201,
+            json={"sender": 3, "receiver": 1, "amount": 3, "reason": "single"},
+            r_schema=schemas.Transaction
+        )
+        self.assertIsNone(single.json()["transaction_type"])
+        self.assertQuery(
+            ("POST", "/transactions"),
+            409,
+            json={"sender": 3, "receiver": 3, "amount": 3, "reason": "self"}
+        )
+        self.assertQuery(("POST", "/transactions/batch"), 422, json={"transactions": []})
+
+    def test_concurrent_transfers(self):
+        for i in range(4):
+            self.assertQuery(
+                ("POST", "/users"),
+                201,
+                json={"name": f"user{i}", "permission": True, "external": False}
+            )
+
+        def transfer(i: int) -> List[Tuple[int, int, int]]:
+            made = [(1 + i % 4, 1 + (i + 1 + i // 4 % 3) % 4, 1 + i % 7)]
+            if i % 10 == 0:
+                made.append((made[0][1], made[0][0], 2))
+                self.assertQuery(("POST", "/transactions/batch"), 201, json={"transactions": [
+                    {"sender": s, "receiver": r, "amount": a, "reason": f"batch {i}"}
+                    for s, r, a in made
+                ]})
+            else:
+                s, r, a = made[0]
+                self.assertQuery(
+                    ("POST", "/transactions"),
+                    201,
+                    json={"sender": s, "receiver": r, "amount": a, "reason": f"transfer {i}"}
+                )
+            return made
+
+        with concurrent.futures.ThreadPoolExecutor(16) as pool:
+            made = [t for transactions in pool.map(transfer, range(200)) for t in transactions]
+
+        expected = {user_id: 0 for user_id in range(1, 5)}
+        for sender, receiver, amount in made:
+            expected[sender] -= amount
+            expected[receiver] += amount
+        users = self.assertQuery(("GET", "/users")).json()
+        self.assertEqual(expected, {u["id"]: u["balance"] for u in users})
+        self.assertEqual(0, sum(u["balance"] for u in users))
+        self.assertEqual(len(made), len(self.assertQuery(("GET", "/transactions")).json()))
+
+    def test_balances_without_shards(self):
+        self.assertQuery(
+            ("POST", "/users"),
+            201,
+            json={"name": "user", "permission": True, "external": False}
+        )
+        statements = []
+        sqlalchemy.event.listen(
+            database.get_engine(),
+            "before_cursor_execute",
+            lambda *args: statements.append(args[2])
+        )
+        self.assertQuery(("GET", "/users"))
+        self.assertQuery(("GET", "/users/1"))
+        self.assertTrue(statements)
+        self.assertFalse([s for s in statements if "community_shards" in s])
+
+    def test_concurrent_consumption(self):
+        for i in range(4):
+            self.assertQuery(
+                ("POST", "/users"),
+                201,
+                json={"name": f"user{i}", "permission": True, "external": False}
+            )
+        session = database.get_new_session()
+        session.add(models.User(name="community", external=False, special=True))
+        session.add(models.Consumable(name="Mate", price=150, symbol="m", stock=25))
+        session.commit()
+        session.close()
+
+        def consume(i: int) -> int:
+            return self.assertQuery(
+                ("POST", "/transactions/consume"),
+                [201, 409],
+                json={"user": i % 4 + 1, "amount": 1 + i % 2, "consumable_id": 1}
+            ).status_code
+
+        with concurrent.futures.ThreadPoolExecutor(16) as pool:
+            statuses = list(pool.map(consume, range(40)))
+
+        consumable = self.assertQuery(("GET", "/consumables/1")).json()
+        users = self.assertQuery(("GET", "/users")).json()
+        consumed = sum(1 + i % 2 for i, status in enumerate(statuses) if status == 201)
+        self.assertLessEqual(24, consumed)
+        self.assertEqual(25 - consumed, consumable["stock"])
+        self.assertEqual(150 * consumed, users[4]["balance"])
+        self.assertEqual(0, sum(u["balance"] for u in users))
+
+        self.assertQuery(
+            ("POST", "/transactions/consume"),
+            409,
+            json={"user": 1, "amount": 2, "consumable_id": 1}
+        )
+        self.assertQuery(
+            ("POST", "/transactions/consume"),
+            201,
+            json={"user": 1, "amount": 2, "consumable_id": 1, "respect_stock": False}
+        )
+        self.assertEqual(25 - consumed, self.assertQuery(("GET", "/consumables/1")).json()["stock"])
+
+    @_unittest.skipIf(negotiation.msgpack is None, "msgpack is not installed")
+    def test_binary_content_negotiation(self):
+        binary = {"Accept": "application/msgpack", "Content-Type": "application/msgpack"}
+        for i in range(3):
+            created = self.assertQuery(
+                ("POST", "/users"),
+                201,
+                data=msgpack.packb({"name": f"user{i}", "permission": True, "external": False}),
+                headers=binary,
+                r_headers={"Content-Type": "application/msgpack"}
+            )
+            self.assertEqual(f"user{i}", msgpack.unpackb(created.content)["name"])
+
+        users = self.assertQuery(("GET", "/users"), r_headers=["ETag", "Vary"])
+        self.assertIn("Accept", users.headers["Vary"])
+        packed = self.assertQuery(("GET", "/users"), headers=binary, r_headers=["ETag"])
+        self.assertEqual(users.json(), msgpack.unpackb(packed.content))
+        self.assertEqual(users.headers["ETag"][:-1] + '-msgpack"', packed.headers["ETag"])
+        balances = self.assertQuery(("GET", "/users?fields=balance"), headers=binary)
+        self.assertEqual(
+            [{"id": u["id"], "balance": u["balance"]} for u in users.json()],
+            msgpack.unpackb(balances.content)
+        )
+        self.assertEqual(
+            users.json()[0],
+            msgpack.unpackb(self.assertQuery(("GET", "/users/1"), headers=binary).content)
+        )
+
+        self.assertQuery(
+            ("GET", "/users"),
+            304,
+            headers={**binary, "If-None-Match": packed.headers["ETag"]},
+            r_headers={"ETag": packed.headers["ETag"]}
+        )
+        self.assertQuery(("GET", "/users"), headers={"If-None-Match": packed.headers["ETag"]})
+        self.assertQuery(
+            ("GET", "/users"),
+            headers={"Accept": "application/json, application/msgpack;q=0.5"},
+            r_headers={"Content-Type": "application/json"}
+        )
+
+        error = self.assertQuery(("GET", "/users/42"), 404, headers=binary)
+        self.assertEqual(404, msgpack.unpackb(error.content)["status"])
+        self.assertQuery(("POST", "/users"), 400, data=b"\xc1", headers=binary)
+
+    def test_precompressed_static_files(self):
+        self.assertEqual("gzip", compression.choose_encoding("deflate, gzip;q=0.5", ["gzip"]))
+        self.assertIsNone(compression.choose_encoding("gzip;q=0", ["gzip"]))
+        self.assertEqual("gzip", compression.choose_encoding("*", ["gzip"]))
+
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "large.js"), "w") as f:
+                f.write("function f() { return 42; }\n" * 100)
+            with open(os.path.join(directory, "small.css"), "w") as f:
+                f.write("body {}")
+            cache = os.path.join(directory, "cache")
+            written = compression.compress_static_files(directory, cache)
+            self.assertIn(os.path.join(cache, "large.js.gz"), written)
+            self.assertEqual(len(compression.ENCODINGS), len(written))
+            self.assertEqual([], compression.compress_static_files(directory, cache))
+            self.assertEqual(["cache", "large.js", "small.css"], sorted(os.listdir(directory)))
+            with gzip.open(os.path.join(cache, "large.js.gz"), "rt") as f:
+                self.assertEqual("function f() { return 42; }\n" * 100, f.read())
+
+        # The compression of responses is disabled by default
+        self.assertNotIn("Content-Encoding", self.assertQuery(
+            ("GET", "/openapi.json"),
+            headers={"Accept-Encoding": "gzip"}
+        ).headers)
+
+
+@_tested
+class ShardedAPITests(_BaseAPITests):
+    def configure(self, config: _config.CoreConfig):
+        config.general.community_shards = 2
+
+    def tearDown(self) -> None:
+        models.set_community_shards(False)
+        super().tearDown()
+
+    def test_sharded_community_account(self):
+        for i in range(3):
+            self.assertQuery(
+                ("POST", "/users"),
+                201,
+                json={"name": f"user{i}", "permission": True, "external": False}
+            )
+        session = database.get_new_session()
+        session.add(models.User(name="community", external=False, special=True, balance=150))
+        session.add(models.Consumable(name="Mate", price=150, symbol="m", stock=100))
+        session.commit()
+        session.close()
+
+        def consume(user_id: int, amount: int = 1):
+            self.assertQuery(
+                ("POST", "/transactions/consume"),
+                201,
+                json={"user": user_id, "amount": amount, "consumable_id": 1}
+            )
+
+        community = self.assertQuery(("GET", "/users/4"), r_headers=["ETag"])
+        self.assertEqual(150, community.json()["balance"])
+        consume(1, 2)
+        consume(2)
+        consume(3)
+        self.assertQuery(
+            ("GET", "/users/4"),
+            headers={"If-None-Match": community.headers["ETag"]},
+            r_headers=["ETag"]
+        )
+
+        # Crediting a shard doesn't increment any version counter of the community user,
+        # but the version counters of the shards are part of its ETag and the collection's
+        def get_counter() -> int:
+            counter_session = database.get_new_session()
+            try:
+                return counter_session.get(models.Version, ("User", 4)).version
+            finally:
+                counter_session.close()
+
+        single = self.assertQuery(("GET", "/users/4"), r_headers=["ETag"]).headers["ETag"]
+        collection = self.assertQuery(("GET", "/users"), r_headers=["ETag"]).headers["ETag"]
+        cursor = self.assertQuery(("GET", "/changes")).json()["cursor"]
+        counter = get_counter()
+        consume(1)
+        self.assertEqual(counter, get_counter())
+        self.assertQuery(("GET", "/users/4"), headers={"If-None-Match": single})
+        self.assertQuery(("GET", "/users"), headers={"If-None-Match": collection})
+        single = self.assertQuery(("GET", "/users/4")).headers["ETag"]
+        self.assertQuery(("GET", "/users/4"), 304, headers={"If-None-Match": single})
+        changes = self.assertQuery(("GET", f"/changes?cursor={cursor}&model=User")).json()
+        self.assertIn(
+            (4, 900),
+            [(c["object_id"], c["data"]["balance"]) for c in changes["changes"]]
+        )
+
+        users = self.assertQuery(("GET", "/users")).json()
+        self.assertEqual([-450, -150, -150, 900], [u["balance"] for u in users])
+        self.assertEqual(users[3], self.assertQuery(("GET", "/users/4")).json())
+        rich = self.assertQuery(("GET", "/users?balance__gt=0")).json()
+        self.assertEqual([4], [u["id"] for u in rich])
+
+        session = database.get_new_session()
+        shards = session.query(models.CommunityShard).order_by(models.CommunityShard.shard).all()
+        self.assertEqual(
+            [(0, 150, 1), (1, 600, 3)],
+            [(s.shard, s.balance, s.version) for s in shards]
+        )
+        self.assertEqual(150, session.get(models.User, 4).balance)
+        session.close()
+
+        # A credit and a debit which cancel each other out still change the ETags
+        collection = self.assertQuery(("GET", "/users")).headers["ETag"]
+        session = database.get_new_session()
+        helpers.add_to_shard(session, 4, shards[0].id, 150)
+        helpers.add_to_shard(session, 4, shards[0].id, -150)
+        session.commit()
+        session.close()
+        self.assertEqual(900, self.assertQuery(("GET", "/users/4"), headers={
+            "If-None-Match": single
+        }).json()["balance"])
+        self.assertQuery(("GET", "/users"), headers={"If-None-Match": collection})
+
+    def test_shards_enabled_by_existing_rows(self):
+        session = database.get_new_session()
+        session.add(models.User(name="community", external=False, special=True))
+        session.commit()
+        session.add(models.CommunityShard(user_id=1, shard=0, balance=42))
+        session.commit()
+        session.close()
+
+        # Shards which exist remain part of the balances after disabling the sharding
+        config = _config.CoreConfig.parse_file("config.json")
+        config.general.community_shards = 0
+        with open("config.json", "w") as f:
+            f.write(config.json())
+        models.set_community_shards(False)
+        create_app(settings=_settings.Settings(), configure_logging=False)
+        self.assertTrue(models.community_shards_enabled())
+        self.assertEqual(42, self.assertQuery(("GET", "/users/1")).json()["balance"])
+
+
+@_tested
+class AsyncioAPITests(_BaseAPITests):
+    def configure(self, config: _config.CoreConfig):
+        if aiosqlite is None:
+            self.skipTest("aiosqlite is not installed")
+        if self._database_file is None:
+            self.skipTest("The asyncio mode requires a persistent sqlite3 database")
+        config.database.asyncio = True
+
+    def test_async_read_paths(self):
+        for i in range(3):
+            self.assertQuery(
+                ("POST", "/users"),
+                201,
+                json={"name": f"user{i}", "permission": True, "external": False}
+            )
+        session = database.get_new_session()
+        sync_users = [user.schema.dict() for user in session.query(models.User).all()]
+        session.close()
+
+        def get_checkouts() -> Dict[str, int]:
+            pools = self.assertQuery(("GET", "/metrics")).json()["pools"]
+            return {pool["name"]: pool["checkouts"] for pool in pools}
+
+        # The collections are loaded by the asyncio engine, the changes by the synchronous one
+        checkouts = get_checkouts()
+        users = self.assertQuery(("GET", "/users"), r_headers=["ETag"])
+        self.assertEqual(sync_users, users.json())
+        self.assertQuery(("GET", "/users"), 304, headers={"If-None-Match": users.headers["ETag"]})
+        filtered = self.assertQuery(("GET", "/users?id__gt=1&fields=name")).json()
+        self.assertEqual([{"id": 2, "name": "user1"}, {"id": 3, "name": "user2"}], filtered)
+        self.assertQuery(("GET", "/users?fields=foo"), 400)
+        self.assertEqual([], self.assertQuery(("GET", "/transactions?limit=2")).json())
+        self.assertEqual(
+            {"primary": checkouts["primary"], "asyncio": checkouts["asyncio"] + 4},
+            get_checkouts()
+        )
+
+        updates = self.assertQuery(("GET", "/updates"), r_schema=schemas.Updates).json()
+        self.assertEqual(users.headers["ETag"].strip('"'), updates["users"])
+
+        def create_user():
+            time.sleep(0.2)
+            self.assertQuery(
+                ("POST", "/users"),
+                201,
+                json={"name": "user", "permission": True, "external": False}
+            )
+
+        thread = threading.Thread(target=create_user, daemon=True)
+        thread.start()
+        changed = self.assertQuery(("GET", f"/updates?cursor={updates['cursor']}&timeout=30"))
+        thread.join()
+        self.assertGreater(changed.json()["cursor"], updates["cursor"])
+        self.assertNotEqual(updates["users"], changed.json()["users"])
+        self.assertEqual(4, len(self.assertQuery(("GET", "/users")).json()))
+
+
+@_tested
+class CompressedAPITests(_BaseAPITests):
+    def configure(self, config: _config.CoreConfig):
+        config.server.compression.enabled = True
+
+    def test_response_compression(self):
+        for i in range(20):
+            self.assertQuery(
+                ("POST", "/users"),
+                201,
+                json={"name": f"user{i}", "permission": True, "external": False}
+            )
+        plain = self.assertQuery(("GET", "/users"), headers={"Accept-Encoding": "identity"})
+        self.assertNotIn("Content-Encoding", plain.headers)
+        self.assertGreater(len(plain.content), 1024)
+
+        compressed = self.assertQuery(
+            ("GET", "/users"),
+            headers={"Accept-Encoding": "gzip"},
+            r_headers={"Content-Encoding": "gzip"}
+        )
+        self.assertIn("Accept-Encoding", compressed.headers["Vary"])
+        self.assertEqual(plain.json(), compressed.json())
+        self.assertLess(int(compressed.headers["Content-Length"]), len(plain.content))
+        self.assertEqual(plain.headers["ETag"][:-1] + '-gzip"', compressed.headers["ETag"])
+        self.assertQuery(
+            ("GET", "/users"),
+            304,
+            headers={"Accept-Encoding": "gzip", "If-None-Match": compressed.headers["ETag"]},
+            r_headers={"ETag": compressed.headers["ETag"]}
+        )
+        self.assertQuery(
+            ("GET", "/users"),
+            headers={"Accept-Encoding": "identity", "If-None-Match": compressed.headers["ETag"]}
+        )
+        self.assertQuery(
+            ("GET", "/users"),
+            304,
+            headers={"Accept-Encoding": "identity", "If-None-Match": plain.headers["ETag"]},
+            r_headers={"ETag": plain.headers["ETag"]}
+        )
+
+        small = self.assertQuery(("GET", "/users/1"), headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", small.headers)
+        refused = self.assertQuery(("GET", "/users"), headers={"Accept-Encoding": "gzip;q=0"})
+        self.assertNotIn("Content-Encoding", refused.headers)
+
+        session = database.get_new_session()
+        session.add_all([
+            models.Transaction(sender_id=1, receiver_id=2, amount=i + 1, reason=f"reason {i}")
+            for i in range(100)
+        ])
+        session.commit()
+        session.close()
+        export = self.assertQuery(
+            ("GET", "/transactions/export"),
+            headers={"Accept-Encoding": "gzip"},
+            r_headers={"Content-Encoding": "gzip"}
+        )
+        self.assertNotIn("Content-Length", export.headers)
+        self.assertEqual(100, len(export.text.splitlines()))
+
 
 @_tested
 class FailingAPITests(_BaseAPITests):
@@ -0,0 +1,425 @@
+"""
+MateBot benchmarks comparing different configurations of the core
+
+The benchmarks are not part of the default unit test suite, since they take
+a lot more time. Execute them explicitly using ``python3 -m unittest tests.benchmark``.
+"""
+
+import os
+import time
+import asyncio
+import datetime
+import unittest as _unittest
+import concurrent.futures
+from typing import Callable, List, Optional, Type
+
+import pydantic
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.orm
+from fastapi.encoders import jsonable_encoder
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+from matebot_core import schemas
+from matebot_core.api import helpers, serializers
+from matebot_core.persistence import database, models, tracking
+from matebot_core.schemas import config
+
+from . import conf, utils
+
+
+benchmark_suite = _unittest.TestSuite()
+
+
+def _tested(cls: Type):
+    global benchmark_suite
+    for fixture in filter(lambda f: f.startswith("test_"), dir(cls)):
+        benchmark_suite.addTest(cls(fixture))
+    return cls
+
+
+class _BaseBenchmark(utils.BaseTest):
+    def report(self, title: str, operations: int, seconds: float):
+        print(
+            f"\n{type(self).__name__}: {title}: {operations} operations in {seconds:.3f}s "
+            f"({operations / seconds:.1f} op/s, {database.get_engine().url.drivername})",
+            flush=True
+        )
+
+    @staticmethod
+    def measure(func: Callable[[], None]) -> float:
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
+
+
+@_tested
+class AsyncioSessionBenchmark(_BaseBenchmark):
+    """
+    Compare synchronous sessions in a thread pool with asyncio sessions under concurrent load
+
+    Every request does the database work of ``helpers.get_all_of_model`` for the
+    list of users, i.e. it looks up the version counters and loads the users.
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        if self._database_file is None:
+            self.skipTest("The benchmark requires a persistent sqlite3 database")
+        try:
+            database.init(self.database_url, conf.SQLALCHEMY_ECHOING, use_asyncio=True)
+        except (ImportError, RuntimeError) as exc:
+            self.skipTest(f"The asyncio mode is not available: {exc}")
+
+        session = database.get_new_session()
+        session.add_all([models.User(name=f"user{i}", external=False) for i in range(100)])
+        session.commit()
+        session.close()
+
+    def tearDown(self) -> None:
+        database.get_engine().dispose()
+        super().tearDown()
+
+    @staticmethod
+    def _read_users(session: sqlalchemy.orm.Session) -> list:
+        tracking.get_collection_versions(session, [models.User])
+        return serializers.SERIALIZERS[models.User].load(session)
+
+    def test_concurrent_reads(self):
+        def sync_request(_):
+            session = database.get_new_session(read_only=True)
+            try:
+                return self._read_users(session)
+            finally:
+                session.close()
+
+        def run_sync():
+            with concurrent.futures.ThreadPoolExecutor(conf.BENCHMARK_CONCURRENCY) as pool:
+                self.assertEqual(
+                    {100},
+                    set(map(len, pool.map(sync_request, range(conf.BENCHMARK_REQUESTS))))
+                )
+
+        async def async_request(semaphore: asyncio.Semaphore):
+            async with semaphore:
+                async with database.get_new_async_session() as session:
+                    return await session.run_sync(self._read_users)
+
+        async def gather_async():
+            semaphore = asyncio.Semaphore(conf.BENCHMARK_CONCURRENCY)
+            try:
+                results = await asyncio.gather(*[
+                    async_request(semaphore) for _ in range(conf.BENCHMARK_REQUESTS)
+                ])
+                self.assertEqual({100}, set(map(len, results)))
+            finally:
+                await database.get_async_engine().dispose()
+
+        self.report("sync sessions in threads", conf.BENCHMARK_REQUESTS, self.measure(run_sync))
+        self.report(
+            "asyncio sessions",
+            conf.BENCHMARK_REQUESTS,
+            self.measure(lambda: asyncio.run(gather_async()))
+        )
+
+
+@_tested
+class SQLiteProfileBenchmark(_BaseBenchmark):
+    """
+    Compare the read and write throughput of sqlite3 with and without the tuned profile
+    """
+
+    initialized: bool = False
+
+    def setUp(self) -> None:
+        super().setUp()
+        if self._database_file is None:
+            self.skipTest("The benchmark requires a persistent sqlite3 database")
+
+    def tearDown(self) -> None:
+        self._remove_database_files()
+        super().tearDown()
+
+    def _remove_database_files(self):
+        if self.initialized:
+            database.get_engine().dispose()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self._database_file + suffix):
+                os.remove(self._database_file + suffix)
+
+    def _run(self, title: str, profile: Optional[config.SQLiteProfile]):
+        self._remove_database_files()
+        database.init(
+            self.database_url,
+            conf.SQLALCHEMY_ECHOING,
+            pool_options={"pool_size": conf.BENCHMARK_CONCURRENCY},
+            sqlite_pragmas=profile and profile.dict()
+        )
+        self.initialized = True
+        failures = []
+
+        def write(i: int):
+            session = database.get_new_session()
+            try:
+                session.add(models.User(name=f"user{i}", external=False))
+                session.commit()
+            except sqlalchemy.exc.OperationalError as exc:
+                failures.append(exc)
+            finally:
+                session.close()
+
+        def read(_):
+            session = database.get_new_session()
+            try:
+                session.execute(sqlalchemy.select(models.User).limit(50)).scalars().all()
+            except sqlalchemy.exc.OperationalError as exc:
+                failures.append(exc)
+            finally:
+                session.close()
+
+        def run():
+            with concurrent.futures.ThreadPoolExecutor(conf.BENCHMARK_CONCURRENCY) as pool:
+                list(pool.map(
+                    lambda i: write(i) if i % 2 else read(i),
+                    range(conf.BENCHMARK_REQUESTS)
+                ))
+
+        self.report(
+            f"{title} ({len(failures)} failures)" if failures else title,
+            conf.BENCHMARK_REQUESTS,
+            self.measure(run)
+        )
+
+    def test_mixed_read_write_throughput(self):
+        self._run("default sqlite3 settings", None)
+        self._run("tuned sqlite3 profile", config.SQLiteProfile())
+
+        session = database.get_new_session()
+        self.assertEqual("wal", session.execute(sqlalchemy.text("PRAGMA journal_mode")).scalar())
+        session.close()
+
+
+@_tested
+class IndexBenchmark(_BaseBenchmark):
+    """
+    Compare typical queries on a large transactions table with and without secondary indexes
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        database.init(self.database_url, conf.SQLALCHEMY_ECHOING)
+        users = 1000
+        session = database.get_new_session()
+        session.execute(sqlalchemy.insert(models.User), [
+            {"name": f"user{i}", "external": False} for i in range(users)
+        ])
+        start = datetime.datetime(2020, 1, 1)
+        batch = 50000
+        for offset in range(0, conf.BENCHMARK_TRANSACTIONS, batch):
+            session.execute(sqlalchemy.insert(models.Transaction), [
+                {
+                    "sender_id": i % users + 1,
+                    "receiver_id": (i * 7 + 3) % users + 1,
+                    "amount": i % 500 + 1,
+                    "reason": "benchmark",
+                    "registered": start + datetime.timedelta(minutes=i)
+                }
+                for i in range(offset, min(offset + batch, conf.BENCHMARK_TRANSACTIONS))
+            ])
+        session.commit()
+        session.close()
+
+    def tearDown(self) -> None:
+        database.get_engine().dispose()
+        super().tearDown()
+
+    def _run_queries(self, title: str):
+        queries = 200
+        session = database.get_new_session()
+        since = datetime.datetime(2020, 1, 1) + datetime.timedelta(
+            minutes=conf.BENCHMARK_TRANSACTIONS - 1440
+        )
+
+        def run():
+            for i in range(queries):
+                # Same query shape as the history of a user (see the transactions router)
+                user_id = i * 13 % 1000 + 1
+                session.execute(sqlalchemy.select(models.Transaction).where(
+                    models.Transaction.id.in_(sqlalchemy.union(*[
+                        sqlalchemy.select(models.Transaction.id).where(column == user_id)
+                        for column in (models.Transaction.sender_id, models.Transaction.receiver_id)
+                    ]))
+                )).all()
+                session.execute(sqlalchemy.select(models.Transaction).where(
+                    models.Transaction.registered >= since
+                )).all()
+                session.execute(sqlalchemy.select(models.Refund).filter_by(
+                    creator_id=user_id, active=True
+                )).all()
+
+        self.report(title, 3 * queries, self.measure(run))
+        session.close()
+
+    def test_queries_with_and_without_indexes(self):
+        engine = database.get_engine()
+        for table in models.Base.metadata.tables.values():
+            for index in table.indexes:
+                index.drop(bind=engine)
+        self._run_queries(f"without indexes ({conf.BENCHMARK_TRANSACTIONS} transactions)")
+
+        self.assertTrue(database.create_missing_indexes(engine))
+        self._run_queries(f"with indexes ({conf.BENCHMARK_TRANSACTIONS} transactions)")
+
+
+@_tested
+class SerializationBenchmark(_BaseBenchmark):
+    """
+    Compare the ORM and schema serialization of collections with the raw row serializers
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        database.init(self.database_url, conf.SQLALCHEMY_ECHOING)
+        session = database.get_new_session()
+        session.execute(sqlalchemy.insert(models.Application), [{"name": "app"}])
+        session.execute(sqlalchemy.insert(models.TransactionType), [{"name": "send"}])
+        session.execute(sqlalchemy.insert(models.User), [
+            {"name": f"user{i}", "external": False} for i in range(conf.BENCHMARK_ROWS)
+        ])
+        session.execute(sqlalchemy.insert(models.UserAlias), [
+            {"user_id": i + 1, "app_id": 1, "app_user_id": str(i)}
+            for i in range(conf.BENCHMARK_ROWS)
+        ])
+        session.execute(sqlalchemy.insert(models.Transaction), [
+            {
+                "sender_id": i + 1,
+                "receiver_id": (i + 1) % conf.BENCHMARK_ROWS + 1,
+                "amount": i % 500 + 1,
+                "reason": "benchmark",
+                "transaction_types_id": 1
+            }
+            for i in range(conf.BENCHMARK_ROWS)
+        ])
+        session.commit()
+        session.close()
+
+    def tearDown(self) -> None:
+        database.get_engine().dispose()
+        super().tearDown()
+
+    def _compare(self, model: Type[models.Base], schema: Type[pydantic.BaseModel]):
+        session = database.get_new_session()
+
+        def orm():
+            query = session.query(model).options(*models.schema_loader_options(model))
+            objects = pydantic.parse_obj_as(List[schema], [obj.schema for obj in query.all()])
+            json.dumps(jsonable_encoder(objects)).encode("UTF-8")
+            session.expunge_all()
+
+        def raw():
+            json.dumps(serializers.SERIALIZERS[model].load(session)).encode("UTF-8")
+
+        self.report(f"ORM schemas of {model.__name__}", conf.BENCHMARK_ROWS, self.measure(orm))
+        self.report(f"raw rows of {model.__name__}", conf.BENCHMARK_ROWS, self.measure(raw))
+        session.close()
+
+    def test_serialize_users(self):
+        self._compare(models.User, schemas.User)
+
+    def test_serialize_transactions(self):
+        self._compare(models.Transaction, schemas.Transaction)
+
+
+
+@_tested
+class CommunityShardBenchmark(_BaseBenchmark):
+    """
+    Compare concurrent consumptions crediting the community user's row or its shards
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        if self.database_url == "sqlite://":
+            self.skipTest("The benchmark requires a persistent database")
+        database.init(
+            self.database_url,
+            conf.SQLALCHEMY_ECHOING,
+            pool_options={"pool_size": conf.BENCHMARK_CONCURRENCY},
+            sqlite_pragmas=config.SQLiteProfile().dict()
+        )
+        session = database.get_new_session()
+        session.execute(sqlalchemy.insert(models.User), [
+            {"name": f"user{i}", "external": False} for i in range(100)
+        ])
+        session.add(models.User(name="community", external=False, special=True))
+        session.commit()
+        self.community_id = session.query(models.User).filter_by(special=True).one().id
+        session.close()
+        sqlalchemy.event.listen(database.get_engine(), "before_cursor_execute", self._delay)
+
+    @staticmethod
+    def _delay(*_):
+        time.sleep(conf.BENCHMARK_LATENCY)
+
+    def tearDown(self) -> None:
+        sqlalchemy.event.remove(database.get_engine(), "before_cursor_execute", self._delay)
+        database.get_engine().dispose()
+        models.set_community_shards(False)
+        super().tearDown()
+
+    def _run(self, shards: int) -> int:
+        failures = []
+
+        def consume(i: int):
+            user_id = i % 100 + 1
+            session = database.get_new_session()
+            try:
+                balances = {user_id: -1}
+                if shards > 0:
+                    shard_id = helpers.get_shard_id(session, self.community_id, user_id % shards)
+                    helpers.add_to_shard(session, self.community_id, shard_id, 1)
+                else:
+                    balances[self.community_id] = 1
+                helpers.add_to_column(session, models.User.balance, balances)
+                session.add(models.Transaction(
+                    sender_id=user_id,
+                    receiver_id=self.community_id,
+                    amount=1,
+                    reason="consume: 1x Mate"
+                ))
+                session.commit()
+            except sqlalchemy.exc.OperationalError as exc:
+                failures.append(exc)
+            finally:
+                session.close()
+
+        def run():
+            with concurrent.futures.ThreadPoolExecutor(conf.BENCHMARK_CONCURRENCY) as pool:
+                list(pool.map(consume, range(conf.BENCHMARK_REQUESTS)))
+
+        title = f"{shards} shards" if shards > 0 else "single community row"
+        self.report(
+            f"{title} ({len(failures)} failures)" if failures else title,
+            conf.BENCHMARK_REQUESTS,
+            self.measure(run)
+        )
+        return conf.BENCHMARK_REQUESTS - len(failures)
+
+    def test_consume_throughput(self):
+        successful = self._run(0) + self._run(conf.BENCHMARK_SHARDS)
+
+        session = database.get_new_session()
+        community = session.get(models.User, self.community_id)
+        self.assertEqual(successful, community.total_balance)
+        self.assertEqual(0, session.execute(sqlalchemy.select(
+            sqlalchemy.func.sum(models.User.total_balance)
+        )).scalar())
+        session.close()
+
+
+if __name__ == '__main__':
+    _unittest.main()
@@ -41,3 +41,24 @@ COMMAND_INITIALIZE_DATABASE: Optional[List[str]] = None
 # test! Also note that the argument of this field will be used by `subprocess.run`!
 # The command won't be executed if a temporary or in-memory sqlite database was used.
 COMMAND_CLEANUP_DATABASE: Optional[List[str]] = None
+
+# Number of concurrent clients simulated by the benchmarks (default: 40, which
+# equals the default size of the thread pool used for synchronous path operations)
+BENCHMARK_CONCURRENCY: int = 40
+
+# Number of requests or operations that will be measured per benchmark (default: 1000)
+BENCHMARK_REQUESTS: int = 1000
+
+# Number of rows inserted into the transactions table by the index benchmark (default: 1000000)
+BENCHMARK_TRANSACTIONS: int = 1000000
+
+# Number of rows per collection serialized by the serialization benchmark (default: 20000)
+BENCHMARK_ROWS: int = 20000
+
+# Number of shards of the community account compared with a single row (default: 8)
+BENCHMARK_SHARDS: int = 8
+
+# Simulated network latency of every statement of the benchmark of the community
+# shards in seconds, since the locks held by concurrent transactions matter most
+# when every statement has to travel to a remote database server (default: 0.002)
+BENCHMARK_LATENCY: float = 0.002
@@ -2,17 +2,23 @@
 MateBot database unit tests
 """
 
+import os
 import datetime
+import threading
 import unittest as _unittest
-from typing import List, Type
+from typing import List, Optional, Type
 
 import sqlalchemy
 import sqlalchemy.orm
 import sqlalchemy.exc
+import sqlalchemy.event
 from sqlalchemy.engine import Engine as _Engine
 
 from matebot_core import schemas
-from matebot_core.persistence import models
+from matebot_core.api import serializers
+from matebot_core.api.notifier import Notifier
+from matebot_core.persistence import database, models, tracking
+from matebot_core.schemas import config
 
 from . import conf, utils
 
@@ -588,6 +594,578 @@ class DatabaseSchemaTests(_BaseDatabaseTests):
         self.assertTrue("id" in model.schema.dict())
         self.assertTrue("modified" in model.schema.dict())
 
+    def test_transaction_type_count(self):
+        self.session.add_all(self.get_sample_users())
+        types = [models.TransactionType(name="consume"), models.TransactionType(name="send")]
+        self.session.add_all(types)
+        self.session.commit()
+        self.session.add_all([
+            models.Transaction(
+                sender_id=1, receiver_id=2, amount=i + 1, transaction_type=types[i % 2]
+            )
+            for i in range(5)
+        ])
+        self.session.add(models.Transaction(sender_id=2, receiver_id=1, amount=1))
+        self.session.commit()
+        self.session.expunge_all()
+
+        consume, send = self.session.query(models.TransactionType).order_by("id").all()
+        self.assertEqual(3, consume.schema.count)
+        self.assertEqual(2, send.schema.count)
+        self.assertNotIn("transactions", sqlalchemy.inspect(consume).dict)
+
+        self.session.add(
+            models.Transaction(sender_id=3, receiver_id=1, amount=1, transaction_type=send)
+        )
+        self.session.commit()
+        self.assertEqual(3, send.schema.count)
+
+    def test_eager_loading_of_schemas(self):
+        apps = [models.Application(name="app1"), models.Application(name="app2")]
+        self.session.add_all(apps)
+        users = [models.User(name=f"user{i}", external=False) for i in range(50)]
+        self.session.add_all(users)
+        self.session.commit()
+        self.session.add_all([
+            models.UserAlias(user_id=user.id, app_id=app.id, app_user_id=f"{app.name}{user.id}")
+            for user in users for app in apps
+        ])
+        consumable = models.Consumable(name="Mate", price=100, symbol="M", stock=1)
+        self.session.add(consumable)
+        self.session.add_all([
+            models.ConsumableMessage(message=str(i), consumable=consumable) for i in range(5)
+        ])
+        self.session.commit()
+        self.session.expunge_all()
+
+        statements = []
+        sqlalchemy.event.listen(
+            self.engine,
+            "before_cursor_execute",
+            lambda *args: statements.append(args[2])
+        )
+
+        query = self.session.query(models.User).options(
+            *models.schema_loader_options(models.User)
+        )
+        user_schemas = [user.schema for user in query.all()]
+        self.assertEqual(50, len(user_schemas))
+        self.assertEqual(["app1", "app2"], [a.application for a in user_schemas[-1].aliases])
+        self.assertLessEqual(len(statements), 2)
+
+        statements.clear()
+        query = self.session.query(models.Consumable).options(
+            *models.schema_loader_options(models.Consumable)
+        )
+        self.assertEqual(5, len(query.one().schema.messages))
+        self.assertLessEqual(len(statements), 2)
+
+    def test_raw_serializers(self):
+        self.session.add_all(self.get_sample_users())
+        app = models.Application(name="app")
+        self.session.add(app)
+        self.session.commit()
+        alias = models.UserAlias(user_id=7, app_id=app.id, app_user_id="community")
+        self.session.add(alias)
+        self.session.commit()
+        app.community_user_alias_id = alias.id
+        self.session.add(models.UserAlias(user_id=1, app_id=app.id, app_user_id="user1"))
+        transaction_type = models.TransactionType(name="send")
+        self.session.add(models.Transaction(
+            sender_id=1, receiver_id=2, amount=42, reason="foo", transaction_type=transaction_type
+        ))
+        consumable = models.Consumable(name="Mate", price=100, symbol="M", stock=1)
+        consumable.messages = [models.ConsumableMessage(message=str(i)) for i in range(3)]
+        self.session.add(consumable)
+        ballots = [
+            models.Ballot(question="Refund?", restricted=True),
+            models.Ballot(question="", restricted=False)
+        ]
+        self.session.add_all(ballots)
+        self.session.commit()
+        self.session.add_all([
+            models.Vote(user_id=1, ballot_id=ballots[0].id, vote=1),
+            models.Vote(user_id=2, ballot_id=ballots[0].id, vote=-1),
+            models.Refund(amount=1, description="a", creator_id=1, ballot_id=ballots[0].id),
+            models.Refund(
+                amount=2, description="b", creator_id=2, ballot_id=ballots[1].id, active=False
+            )
+        ])
+        ballots[1].result = 1
+        communism = models.Communism(amount=42, description="c", creator_id=1, externals=1)
+        communism.participants = [models.CommunismUsers(user_id=i, quantity=i) for i in (1, 3)]
+        self.session.add(communism)
+        self.session.commit()
+        self.session.expunge_all()
+
+        for model, serializer in serializers.SERIALIZERS.items():
+            objects = self.session.query(model).order_by(model.id).all()
+            self.assertGreater(len(objects), 0, model)
+            self.assertEqual(
+                [obj.schema.dict() for obj in objects],
+                serializer.load(self.session),
+                model
+            )
+            self.assertEqual(
+                [objects[0].schema.dict()],
+                serializer.load(self.session, model.id == objects[0].id)
+            )
+            for name in serializer.fields:
+                self.assertEqual(
+                    [obj.schema.dict(include={"id", name}) for obj in objects],
+                    serializer.load(self.session, fields=[name]),
+                    (model, name)
+                )
+            with self.assertRaises(KeyError):
+                serializer.load(self.session, fields=["unknown"])
+
+        statements = []
+        sqlalchemy.event.listen(
+            self.engine,
+            "before_cursor_execute",
+            lambda *args: statements.append(args[2])
+        )
+        balances = serializers.SERIALIZERS[models.User].load(self.session, fields=["balance"])
+        self.assertEqual(1, len(statements))
+        self.assertNotIn("aliases", statements[0])
+        self.assertEqual({("id", "balance")}, {tuple(balance) for balance in balances})
+
+
+@_tested
+class VersionTrackingTests(_BaseDatabaseTests):
+    """
+    Database test cases checking the version counters maintained by session events
+    """
+
+    def get_version(self, model: Type[models.Base], object_id: Optional[int] = None) -> int:
+        return dict(
+            (name, version)
+            for name, oid, version in tracking.get_versions(self.session, model, object_id)
+            if oid == (tracking.COLLECTION if object_id is None else object_id)
+        )[model.__name__]
+
+    def test_versions_of_rows_and_collections(self):
+        self.assertEqual(0, self.get_version(models.User))
+        self.session.add_all(self.get_sample_users())
+        self.session.commit()
+        self.assertEqual(1, self.get_version(models.User))
+        self.assertEqual(1, self.get_version(models.User, 1))
+
+        user = self.session.get(models.User, 1)
+        user.balance += 1
+        self.session.commit()
+        self.assertEqual(2, self.get_version(models.User, 1))
+        self.assertEqual(1, self.get_version(models.User, 2))
+        self.assertEqual(2, self.get_version(models.User))
+
+        app = models.Application(name="app")
+        self.session.add(app)
+        self.session.commit()
+        alias = models.UserAlias(user_id=2, app_id=app.id, app_user_id="foo")
+        self.session.add(alias)
+        self.session.commit()
+        self.assertEqual(2, self.get_version(models.User, 2))
+        self.assertEqual(3, self.get_version(models.User))
+        self.assertEqual(1, self.get_version(models.UserAlias, alias.id))
+
+        self.session.delete(alias)
+        self.session.commit()
+        self.assertEqual(3, self.get_version(models.User, 2))
+        self.assertEqual(2, self.get_version(models.UserAlias, 1))
+
+        # Unchanged dirty objects and changes without the ORM
+        user.balance = user.balance
+        self.session.commit()
+        self.assertEqual(2, self.get_version(models.User, 1))
+        self.session.execute(sqlalchemy.update(models.User).where(models.User.id == 1).values(
+            balance=models.User.balance + 1
+        ))
+        tracking.touch(self.session, models.User, 1)
+        self.session.commit()
+        self.assertEqual(3, self.get_version(models.User, 1))
+        self.assertEqual(5, self.get_version(models.User))
+
+    def test_versions_of_references(self):
+        self.session.add_all(self.get_sample_users())
+        transaction_type = models.TransactionType(name="send")
+        self.session.add(transaction_type)
+        self.session.commit()
+        self.session.add(models.Transaction(
+            sender_id=1, receiver_id=2, amount=1, transaction_type=transaction_type
+        ))
+        self.session.commit()
+        versions = tracking.get_versions(self.session, models.Transaction, 1)
+        self.assertEqual([("Transaction", 1, 1), ("TransactionType", 1, 2)], versions)
+
+        # Any new transaction changes the count of all transactions of the same type
+        self.session.add(models.Transaction(
+            sender_id=2, receiver_id=1, amount=1, transaction_type=transaction_type
+        ))
+        self.session.commit()
+        self.assertNotEqual(versions, tracking.get_versions(self.session, models.Transaction, 1))
+        self.assertEqual(
+            tracking.get_versions(self.session, models.Transaction),
+            tracking.get_collection_versions(self.session, [models.Transaction])[models.Transaction]
+        )
+
+    def test_versions_of_aliases_and_applications(self):
+        self.session.add_all(self.get_sample_users())
+        app = models.Application(name="app")
+        self.session.add(app)
+        self.session.flush()
+        community = models.UserAlias(user_id=1, app_id=app.id, app_user_id="community")
+        other = models.UserAlias(user_id=2, app_id=app.id, app_user_id="foo")
+        self.session.add_all([community, other])
+        self.session.flush()
+        app.community_user_alias_id = community.id
+        self.session.commit()
+
+        def get_versions():
+            return (
+                tracking.get_collection_versions(self.session, [models.Application]),
+                tracking.get_versions(self.session, models.Application, app.id)
+            )
+
+        versions = get_versions()
+        self.assertEqual(["Application"], [name for name, *_ in versions[0][models.Application]])
+        other.app_user_id = "bar"
+        self.session.commit()
+        self.assertEqual(versions, get_versions())
+
+        # Aliases embed the name of their application
+        aliases = tracking.get_versions(self.session, models.UserAlias)
+        app.name = "other"
+        self.session.commit()
+        self.assertNotEqual(aliases, tracking.get_versions(self.session, models.UserAlias))
+
+        # Applications embed their community user's alias
+        versions = get_versions()
+        community.app_user_id = "baz"
+        self.session.commit()
+        self.assertNotEqual(versions[1], get_versions()[1])
+
+    def test_change_log(self):
+        self.assertEqual(0, tracking.get_cursor(self.session))
+        self.session.add_all(self.get_sample_users()[:2])
+        self.session.commit()
+        cursor = tracking.get_cursor(self.session)
+        self.assertEqual(2, cursor)
+
+        app = models.Application(name="app")
+        self.session.add(app)
+        self.session.flush()
+        self.session.add(models.UserAlias(user_id=1, app_id=app.id, app_user_id="foo"))
+        self.session.delete(self.session.get(models.User, 2))
+        self.session.commit()
+
+        changes = self.session.execute(
+            sqlalchemy.select(models.Change).where(models.Change.id > cursor).order_by("id")
+        ).scalars().all()
+        self.assertEqual(
+            [("Application", 1, "create"), ("User", 1, "update"),
+             ("User", 2, "delete"), ("UserAlias", 1, "create")],
+            sorted((c.model, c.object_id, c.action) for c in changes)
+        )
+        self.assertEqual(changes[-1].id, tracking.get_cursor(self.session))
+
+        statements = []
+        sqlalchemy.event.listen(
+            self.engine,
+            "before_cursor_execute",
+            lambda *args: statements.append(args[2])
+        )
+        versions = tracking.get_collection_versions(self.session, [models.User, models.UserAlias])
+        self.assertEqual(1, len(statements))
+        self.assertEqual([("User", 0, 2)], versions[models.User])
+
+    def test_changes_with_versions(self):
+        self.session.add_all(self.get_sample_users())
+        app = models.Application(name="app")
+        self.session.add(app)
+        self.session.commit()
+        self.session.add_all([
+            models.UserAlias(user_id=i, app_id=app.id, app_user_id=str(i)) for i in range(1, 6)
+        ])
+        self.session.delete(self.session.get(models.User, 7))
+        self.session.add(models.CommunityShard(user_id=1, shard=0, balance=3))
+        self.session.commit()
+
+        statements = []
+        sqlalchemy.event.listen(
+            self.engine,
+            "before_cursor_execute",
+            lambda *args: statements.append(args[2])
+        )
+        changes = tracking.get_changes_with_versions(self.session, 0, 100)
+        self.assertLessEqual(len(statements), 5)
+        self.assertEqual(tracking.get_changes(self.session, 0, 100), [c for c, _ in changes])
+        for change, versions in changes:
+            self.assertEqual(
+                tracking.get_versions(
+                    self.session, tracking.get_model(change.model), change.object_id
+                ),
+                versions
+            )
+        self.assertEqual(2, len(tracking.get_changes_with_versions(self.session, 3, 2)))
+
+    def test_change_log_in_commit_order(self):
+        make_session = sqlalchemy.orm.sessionmaker(autoflush=False, bind=self.engine)
+        first, second, reader = make_session(), make_session(), make_session()
+        try:
+            # The first session flushes its changes before the second session, but commits later
+            first.add(models.Application(name="app"))
+            first.flush()
+            count = sqlalchemy.select(sqlalchemy.func.count(models.Change.id))
+            self.assertEqual(0, first.execute(count).scalar())
+
+            def commit_second():
+                second.add_all(self.get_sample_users()[:2])
+                second.commit()
+
+            # Databases with row locks commit the second session now, sqlite3 blocks it
+            thread = threading.Thread(target=commit_second, daemon=True)
+            thread.start()
+            thread.join(1)
+            changes = tracking.get_changes(reader, 0, 100)
+            reader.rollback()
+            first.commit()
+            thread.join()
+
+            cursor = changes[-1].id if changes else 0
+            changes.extend(tracking.get_changes(reader, cursor, 100))
+            self.assertEqual(
+                ["Application", "User", "User"],
+                sorted(change.model for change in changes)
+            )
+            self.assertEqual(list(range(1, 4)), [change.id for change in changes])
+            self.assertEqual(3, tracking.get_cursor(reader))
+        finally:
+            for session in (first, second, reader):
+                session.close()
+
+    def test_change_log_gaps(self):
+        self.session.add_all(self.get_sample_users()[:2])
+        self.session.commit()
+        self.assertEqual(2, tracking.get_cursor(self.session))
+
+        # An entry after a missing ID waits for the transaction which hasn't committed yet
+        table = models.Change.__table__
+        self.session.execute(sqlalchemy.insert(table).values(
+            id=4, model="User", object_id=1, action="update", timestamp=tracking._Now()
+        ))
+        self.session.commit()
+        self.assertEqual(2, tracking.get_cursor(self.session))
+        self.assertEqual([], tracking.get_changes(self.session, 2, 100))
+        self.assertEqual([], tracking.get_changes_with_versions(self.session, 2, 100))
+        self.assertEqual(2, tracking.get_cursor(self.session, 1))
+        self.assertEqual(4, tracking.get_cursor(self.session, 3))
+
+        # A gap older than the timeout is caused by a rollback and will be skipped
+        self.session.execute(sqlalchemy.update(table).where(table.c.id == 4).values(
+            timestamp=datetime.datetime(2000, 1, 1)
+        ))
+        self.session.commit()
+        self.assertEqual(4, tracking.get_cursor(self.session))
+        self.assertEqual([4], [c.id for c in tracking.get_changes(self.session, 2, 100)])
+        self.session.add(models.Application(name="app"))
+        self.session.commit()
+        changes = tracking.get_changes(self.session, 2, 100)
+        self.assertEqual(["Application", "User"], sorted(c.model for c in changes))
+        self.assertEqual(changes[-1].id, tracking.get_cursor(self.session))
+
+    def test_prune_change_log(self):
+        self.session.add_all(self.get_sample_users())
+        self.session.commit()
+        latest = tracking.get_cursor(self.session)
+        self.assertEqual(0, tracking.get_pruned(self.session))
+        self.assertEqual(0, tracking.prune_changes(self.session, latest))
+        self.assertEqual(latest - 3, tracking.prune_changes(self.session, 3))
+        self.session.commit()
+        self.assertEqual(latest - 3, tracking.get_pruned(self.session))
+        self.assertEqual(
+            list(range(latest - 2, latest + 1)),
+            [c.id for c in tracking.get_changes(self.session, 0, 100)]
+        )
+        self.assertEqual(0, tracking.prune_changes(self.session, 5))
+
+        # The change log is pruned automatically by some commits of this process
+        interval = tracking._PRUNE_INTERVAL
+        tracking._PRUNE_INTERVAL = 1
+        tracking.set_change_log_size(2)
+        try:
+            for i in range(3):
+                self.session.add(models.Application(name=f"app{i}"))
+                self.session.commit()
+        finally:
+            tracking._PRUNE_INTERVAL = interval
+            tracking.set_change_log_size(0)
+        count = sqlalchemy.select(sqlalchemy.func.count(models.Change.id))
+        self.assertEqual(2, self.session.execute(count).scalar())
+        self.assertEqual(latest + 3, tracking.get_cursor(self.session))
+        self.assertEqual(latest + 1, tracking.get_pruned(self.session))
+
+    def test_counter_upserts(self):
+        statements = []
+        sqlalchemy.event.listen(
+            self.engine,
+            "before_cursor_execute",
+            lambda *args: statements.append(args[2])
+        )
+        self.session.add_all(self.get_sample_users()[:2])
+        self.session.commit()
+        self.session.get(models.User, 1).balance += 1
+        self.session.commit()
+        self.assertFalse([s for s in statements if s.startswith("SELECT versions.object_id")])
+        self.assertEqual(2, self.get_version(models.User, 1))
+        self.assertEqual(1, self.get_version(models.User, 2))
+        self.assertEqual(2, self.get_version(models.User))
+
+    def test_collection_stripes(self):
+        stripe = 1 - tracking.COLLECTION_STRIPES
+        self.session.add_all(self.get_sample_users()[:2])
+        self.session.commit()
+        self.session.info[tracking._STRIPE] = stripe
+        self.session.get(models.User, 1).balance += 1
+        self.session.commit()
+        self.assertNotIn(tracking._STRIPE, self.session.info)
+        self.assertLessEqual(1, self.session.get(models.Version, ("User", stripe)).version)
+        self.assertEqual(2, self.get_version(models.User))
+        self.assertEqual(
+            [("User", tracking.COLLECTION, 2)],
+            tracking.get_collection_versions(self.session, [models.User])[models.User]
+        )
+
+    def test_concurrently_created_counters(self):
+        # Simulate another transaction creating a missing counter between the
+        # check for existing counters and the insertion of the missing ones
+        def insert_counter(connection, _cursor, statement, *_):
+            if statement.startswith("SELECT versions.object_id") and not inserted:
+                inserted.append(None)
+                connection.connection.cursor().execute(
+                    "INSERT INTO versions (model, object_id, version) VALUES ('User', 1, 41)"
+                )
+
+        inserted = []
+        get_upsert = tracking._get_upsert
+        tracking._get_upsert = lambda *_: None
+        sqlalchemy.event.listen(self.engine, "after_cursor_execute", insert_counter)
+        try:
+            self.session.add_all(self.get_sample_users()[:1])
+            self.session.commit()
+        finally:
+            tracking._get_upsert = get_upsert
+            sqlalchemy.event.remove(self.engine, "after_cursor_execute", insert_counter)
+        self.assertEqual(42, self.get_version(models.User, 1))
+        self.assertEqual(1, self.get_version(models.User))
+
+    def test_commit_listeners(self):
+        calls = []
+
+        def listener():
+            calls.append(None)
+
+        tracking.add_commit_listener(listener)
+        try:
+            self.session.add_all(self.get_sample_users()[:1])
+            self.session.commit()
+            self.session.commit()
+            self.assertEqual(1, len(calls))
+        finally:
+            tracking.remove_commit_listener(listener)
+        self.session.add_all(self.get_sample_users()[1:2])
+        self.session.commit()
+        self.assertEqual(1, len(calls))
+        tracking.remove_commit_listener(listener)
+
+        notifier = Notifier()
+        self.assertIn(notifier.notify, tracking._commit_listeners)
+        notifier.close()
+        self.assertNotIn(notifier.notify, tracking._commit_listeners)
+
+
+@_tested
+class DatabaseConfigurationTests(utils.BaseTest):
+    """
+    Database test cases checking the configuration of the engines during initialization
+    """
+
+    def tearDown(self) -> None:
+        database.get_engine().dispose()
+        for suffix in ("-wal", "-shm"):
+            if self._database_file and os.path.exists(self._database_file + suffix):
+                os.remove(self._database_file + suffix)
+        super().tearDown()
+
+    def test_sqlite_profile(self):
+        if self.database_type != utils.DatabaseType.SQLITE or self._database_file is None:
+            self.skipTest("The sqlite3 profile requires a persistent sqlite3 database")
+
+        database.init(
+            self.database_url,
+            conf.SQLALCHEMY_ECHOING,
+            sqlite_pragmas=config.SQLiteProfile(busy_timeout=1234).dict()
+        )
+        with database.get_engine().connect() as connection:
+            def pragma(name: str):
+                return connection.execute(sqlalchemy.text(f"PRAGMA {name}")).scalar()
+
+            self.assertEqual("wal", pragma("journal_mode"))
+            self.assertEqual(1, pragma("synchronous"))
+            self.assertEqual(2, pragma("temp_store"))
+            self.assertEqual(1234, pragma("busy_timeout"))
+            self.assertEqual(-65536, pragma("cache_size"))
+
+    def test_create_missing_indexes(self):
+        database.init(self.database_url, conf.SQLALCHEMY_ECHOING)
+        engine = database.get_engine()
+        for index in models.Transaction.__table__.indexes:
+            index.drop(bind=engine)
+        self.assertEqual([], sqlalchemy.inspect(engine).get_indexes("transactions"))
+
+        created = database.create_missing_indexes(engine)
+        self.assertEqual(
+            {index.name for index in models.Transaction.__table__.indexes},
+            set(created)
+        )
+        self.assertEqual([], database.create_missing_indexes(engine))
+
+        database.init(self.database_url, conf.SQLALCHEMY_ECHOING)
+        self.assertEqual(
+            len(models.Transaction.__table__.indexes),
+            len(sqlalchemy.inspect(database.get_engine()).get_indexes("transactions"))
+        )
+
+    def test_read_replicas(self):
+        if self.database_type != utils.DatabaseType.SQLITE or self._database_file is None:
+            self.skipTest("The replica test requires a persistent sqlite3 database")
+
+        broken_url = conf.DATABASE_URL_FORMAT.format("/nonexistent/directory/replica.db")
+        database.init(
+            self.database_url,
+            conf.SQLALCHEMY_ECHOING,
+            replica_urls=[self.database_url, broken_url]
+        )
+        metrics = database.get_pool_metrics()
+        self.assertEqual(["primary", "replica0", "replica1"], list(metrics.keys()))
+        primary = metrics["primary"].engine
+        replica = metrics["replica0"].engine
+
+        for _ in range(4):
+            session = database.get_new_session(read_only=True)
+            self.assertIs(replica, session.get_bind())
+            self.assertEqual([], session.query(models.User).all())
+            session.close()
+
+        session = database.get_new_session()
+        self.assertIs(primary, session.get_bind())
+        session.add(models.User(name="user", external=False))
+        session.commit()
+        session.close()
+
+        session = database.get_new_session(read_only=True)
+        self.assertEqual(1, len(session.query(models.User).all()))
+        session.close()
+
 
 if __name__ == '__main__':
     _unittest.main()